@@ -0,0 +1,367 @@
+import itertools
+import math
+import re
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from api import database, metadata, partitions, snapshot, summaries
+
+# where=column:op:value, e.g. at_fault:eq:1, vehicle_year:ge:1980, party_sex:in:male|female, party_race:notnull
+OPERATORS = {'eq': '=', 'ne': '!=', 'lt': '<', 'le': '<=', 'gt': '>', 'ge': '>='}
+NULL_OPERATORS = {'null': 'IS NULL', 'notnull': 'IS NOT NULL'}
+# agg=count, agg=func:column, or agg=q<p>:column for the p-quantile (median = q0.5)
+FUNCTIONS = {'count': 'COUNT({})', 'sum': 'SUM({})', 'mean': 'AVG({})', 'min': 'MIN({})', 'max': 'MAX({})'}
+MOMENTS = ('std', 'var')
+# the ones that do arithmetic on the values: text has no mean, and quantiles interpolate between values
+NUMERIC_FUNCTIONS = ('sum', 'mean', 'quantile', *MOMENTS)
+_QUANTILE = re.compile(r'^q(0(\.\d+)?|1(\.0+)?)$')
+
+
+class Aggregate(NamedTuple):
+    name: str
+    func: str
+    column: Optional[str]
+    quantile: Optional[float] = None
+
+
+def _bad_request(detail: str):
+    return HTTPException(status_code=400, detail=detail)
+
+
+def table_columns(table_name: str) -> List[str]:
+    if table_name not in database.TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table {table_name}")
+    return metadata.catalog.tables()[table_name].column_names
+
+
+def _column(name: str, columns: Sequence[str]) -> str:
+    if name not in columns:
+        raise _bad_request(f"unknown column {name}")
+    return f'"{name}"'
+
+
+def split_filters(where: List[str], columns: Sequence[str]) -> List[Tuple[str, str, object]]:
+    # (column, op, value) per filter, value a list for "in" and None for the null checks
+    filters = []
+    for spec in where:
+        column, _, rest = spec.partition(':')
+        op, _, value = rest.partition(':')
+        _column(column, columns)
+        if op in NULL_OPERATORS:
+            filters.append((column, op, None))
+        elif op in OPERATORS:
+            filters.append((column, op, _literal(value)))
+        elif op == 'in':
+            filters.append((column, op, [_literal(v) for v in value.split('|')]))
+        else:
+            raise _bad_request(f"bad filter {spec!r}, expected column:op:value with op in "
+                               f"{list(OPERATORS) + ['in'] + list(NULL_OPERATORS)}")
+    return filters
+
+
+def parse_filters(where: List[str], columns: Sequence[str]) -> Tuple[List[str], Dict[str, object]]:
+    clauses, params = [], {}
+    for i, (column, op, value) in enumerate(split_filters(where, columns)):
+        quoted = f'"{column}"'
+        if op in NULL_OPERATORS:
+            clauses.append(f'{quoted} {NULL_OPERATORS[op]}')
+        elif op in OPERATORS:
+            clauses.append(f'{quoted} {OPERATORS[op]} :w{i}')
+            params[f'w{i}'] = value
+        else:
+            names = [f'w{i}_{j}' for j in range(len(value))]
+            clauses.append(f'{quoted} IN ({", ".join(":" + n for n in names)})')
+            params.update(zip(names, value))
+    return clauses, params
+
+
+def _literal(value: str):
+    # sqlite compares integers and text differently, so pass numbers as numbers
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_aggregates(agg: List[str], table: metadata.Table) -> List[Aggregate]:
+    # checked against the declared column types before any backend runs, so every backend rejects the same requests
+    columns = table.column_names
+    numeric = {column.name for column in table.columns if column.numeric}
+    aggregates = []
+    for spec in agg:
+        func, _, column = spec.partition(':')
+        if func == 'median':
+            func = 'q0.5'
+        if func == 'count' and not column:
+            aggregates.append(Aggregate('count', 'count', None))
+            continue
+        _column(column, columns)
+        if func in FUNCTIONS or func in MOMENTS:
+            aggregates.append(Aggregate(f'{func}_{column}', func, column))
+        elif _QUANTILE.match(func):
+            aggregates.append(Aggregate(f'{func}_{column}', 'quantile', column, float(func[1:])))
+        else:
+            raise _bad_request(f"bad aggregate {spec!r}, expected one of "
+                               f"{list(FUNCTIONS) + list(MOMENTS)}, median or q<p> followed by :column")
+        if aggregates[-1].func in NUMERIC_FUNCTIONS and column not in numeric:
+            raise _bad_request(f"bad aggregate {spec!r}, {column} is not a numeric column")
+    if not aggregates:
+        raise _bad_request("at least one aggregate is required")
+    return aggregates
+
+
+def _quantiles(db: Session, table_name: str, keys: List[str], where_sql: str, params: Dict[str, object],
+               aggregate: Aggregate) -> Dict[tuple, float]:
+    # sqlite has no percentile function: rank the values per group with window functions and fetch only the
+    # (at most two) rows around position (n - 1) * p, then interpolate linearly like pandas does
+    column = f'"{aggregate.column}"'
+    partition = f'PARTITION BY {", ".join(keys)}' if keys else ''
+    not_null = f'{column} IS NOT NULL'
+    where_sql = f'{where_sql} AND {not_null}' if where_sql else f'WHERE {not_null}'
+    key_list = ''.join(f'{key}, ' for key in keys)
+    query = text(f'''
+        SELECT {key_list}rn, n, v FROM (
+            SELECT {key_list}{column} AS v,
+                   ROW_NUMBER() OVER ({partition} ORDER BY {column}) - 1 AS rn,
+                   COUNT(*) OVER ({partition}) AS n
+            FROM {table_name} {where_sql}
+        )
+        WHERE rn = CAST((n - 1) * :p AS INTEGER) OR rn = CAST((n - 1) * :p AS INTEGER) + 1
+    ''')
+    around: Dict[tuple, dict] = {}
+    for row in db.execute(query, {**params, 'p': aggregate.quantile}):
+        key, (rn, n, value) = tuple(row[:len(keys)]), row[len(keys):]
+        around.setdefault(key, {'n': n})[rn] = value
+
+    result = {}
+    for key, values in around.items():
+        position = (values['n'] - 1) * aggregate.quantile
+        low = int(position)
+        lower = values[low]
+        upper = values.get(low + 1, lower)
+        result[key] = lower + (position - low) * (upper - lower)
+    return result
+
+
+def _summary_for(table_name: str, group_by: List[str], where: List[str],
+                 aggregates: List[Aggregate]) -> Optional[Tuple[summaries.Summary, List[str]]]:
+    # a count summary can answer the request when it bakes in a subset of the filters and every other
+    # column the request touches is one of its group keys
+    for summary in summaries.REGISTRY.values():
+        keys = {column for column, _ in summary.keys}
+        rest = [spec for spec in where if spec not in summary.filters]
+        if (summary.table != table_name or [m for m, _ in summary.measures] != ['count']
+                or not set(summary.filters) <= set(where)
+                or not set(group_by) <= keys
+                or any(spec.partition(':')[0] not in keys for spec in rest)
+                or any(a.column is not None and a.column not in keys for a in aggregates)):
+            continue
+        if summaries.current(summary.name):
+            return summary, rest
+    return None
+
+
+def _weighted(aggregate: Aggregate, values: List[Tuple[object, int]]):
+    # the same statistics as the sql path, over (value, count) pairs instead of individual rows
+    if aggregate.func == 'count':
+        return sum(c for v, c in values if aggregate.column is None or v is not None)
+    present = sorted((v, c) for v, c in values if v is not None)
+    n = sum(c for _, c in present)
+    if not n:
+        return None
+    if aggregate.func == 'sum':
+        return sum(v * c for v, c in present)
+    if aggregate.func == 'mean':
+        return sum(v * c for v, c in present) / n
+    if aggregate.func == 'min':
+        return present[0][0]
+    if aggregate.func == 'max':
+        return present[-1][0]
+    if aggregate.func in MOMENTS:
+        if n < 2:
+            return None
+        total = sum(v * c for v, c in present)
+        variance = max((sum(v * v * c for v, c in present) - total * total / n) / (n - 1), 0.0)
+        return variance if aggregate.func == 'var' else math.sqrt(variance)
+
+    position = (n - 1) * aggregate.quantile
+    low = int(position)
+    lower = upper = None
+    seen = 0
+    for v, c in present:
+        if lower is None and low < seen + c:
+            lower = v
+        if low + 1 < seen + c:
+            upper = v
+            break
+        seen += c
+    upper = lower if upper is None else upper
+    return lower + (position - low) * (upper - lower)
+
+
+def _aggregate_summary(summary: summaries.Summary, group_by: List[str], where: List[str],
+                       aggregates: List[Aggregate], limit: int) -> List[dict]:
+    columns = [column for column, _ in summary.keys]
+    clauses, params = parse_filters(where, columns)
+    needed = group_by + sorted({a.column for a in aggregates if a.column} - set(group_by))
+    quoted = [f'"{column}"' for column in needed]
+    where_sql = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+    group_sql = f'GROUP BY {", ".join(quoted)} ORDER BY {", ".join(quoted)}' if quoted else ''
+    query = text(f'SELECT {"".join(q + ", " for q in quoted)}SUM("count") AS n '
+                 f'FROM {summary.name} {where_sql} {group_sql}')
+    with summaries.SessionLocal() as db:
+        rows = [row for row in db.execute(query, params) if row.n is not None]
+
+    groups = itertools.groupby(rows, key=lambda row: tuple(row[:len(group_by)]))
+    if not group_by:
+        # a global aggregate always yields one row, even when nothing matches
+        groups = [((), rows)]
+    output = []
+    for key, members in itertools.islice(groups, limit):
+        members = list(members)
+        item = dict(zip(group_by, key))
+        for a in aggregates:
+            index = needed.index(a.column) if a.column else None
+            item[a.name] = _weighted(a, [(row[index] if index is not None else None, row.n) for row in members])
+        output.append(item)
+    return output
+
+
+def precomputed(table_name: str, group_by: List[str], where: List[str], agg: List[str],
+                limit: int) -> Optional[Tuple[List[dict], str]]:
+    # the answer from a summary table or the columnar snapshot, None when only a scan of switrs.sqlite has it
+    columns = table_columns(table_name)
+    for column in group_by:
+        _column(column, columns)
+    filters = split_filters(where, columns)
+    aggregates = parse_aggregates(agg, metadata.catalog.tables()[table_name])
+
+    found = _summary_for(table_name, group_by, where, aggregates)
+    if found is not None:
+        summary, rest = found
+        return _aggregate_summary(summary, group_by, rest, aggregates, limit), f'summary:{summary.name}'
+
+    snap = snapshot.store.get(table_name)
+    touched = {*group_by, *(column for column, _, _ in filters), *(a.column for a in aggregates if a.column)}
+    if snap is not None and touched <= set(snap.columns):
+        rows = snap.aggregate(filters, group_by, aggregates, limit)
+        if rows is not None:
+            return rows, f'snapshot:{table_name}'
+    return None
+
+
+def _moment(aggregate: Aggregate, n: Optional[int], total, squares):
+    variance = (squares - total * total / n) / (n - 1) if n and n > 1 else None
+    if variance is not None:
+        variance = max(variance, 0.0)
+    return variance if aggregate.func == 'var' or variance is None else math.sqrt(variance)
+
+
+def partitioned(table_name: str, group_by: List[str], where: List[str], agg: List[str],
+                limit: int) -> Optional[Tuple[List[dict], str]]:
+    # the scan split into rowid ranges over the api.partitions processes, None when the table is too small for that;
+    # each range returns partial aggregates, value counts for the quantiles, that add up to the scan's answer
+    columns = table_columns(table_name)
+    table = metadata.catalog.tables()[table_name]
+    if not partitions.enabled(table.row_count):
+        return None
+    keys = [_column(column, columns) for column in group_by]
+    clauses, params = parse_filters(where, columns)
+    aggregates = parse_aggregates(agg, table)
+
+    measures = []
+    for a in aggregates:
+        column = f'"{a.column}"'
+        if a.func == 'count':
+            measures.append((f'COUNT({column if a.column else "*"})', 'sum'))
+        elif a.func in ('sum', 'min', 'max'):
+            measures.append((FUNCTIONS[a.func].format(column), a.func))
+        elif a.func == 'mean':
+            measures.extend([(f'COUNT({column})', 'sum'), (f'SUM({column})', 'sum')])
+        elif a.func in MOMENTS:
+            measures.extend([(f'COUNT({column})', 'sum'), (f'SUM({column})', 'sum'),
+                             (f'SUM({column} * {column})', 'sum')])
+    rows = partitions.grouped(table_name, table.max_rowid, keys, measures, ' AND '.join(clauses), params)[:limit]
+
+    counts: Dict[str, Dict[tuple, List[Tuple[object, int]]]] = {}
+    for a in aggregates:
+        if a.func == 'quantile' and a.name not in counts:
+            not_null = ' AND '.join([*clauses, f'"{a.column}" IS NOT NULL'])
+            counts[a.name] = {}
+            for *key, value, n in partitions.grouped(table_name, table.max_rowid, [*keys, f'"{a.column}"'],
+                                                     [('COUNT(*)', 'sum')], not_null, params):
+                counts[a.name].setdefault(tuple(key), []).append((value, n))
+
+    output = []
+    for row in rows:
+        key = tuple(row[:len(keys)])
+        item = dict(zip(group_by, key))
+        values = iter(row[len(keys):])
+        for a in aggregates:
+            if a.func == 'quantile':
+                item[a.name] = _weighted(a, counts[a.name][key]) if key in counts[a.name] else None
+            elif a.func == 'mean':
+                n, total = next(values), next(values)
+                item[a.name] = total / n if n else None
+            elif a.func in MOMENTS:
+                item[a.name] = _moment(a, next(values), next(values), next(values))
+            else:
+                item[a.name] = next(values)
+        output.append(item)
+    return output, f'partitions:{table_name}'
+
+
+def scan(db: Session, table_name: str, group_by: List[str], where: List[str], agg: List[str],
+         limit: int) -> Tuple[List[dict], str]:
+    columns = table_columns(table_name)
+    keys = [_column(column, columns) for column in group_by]
+    clauses, params = parse_filters(where, columns)
+    aggregates = parse_aggregates(agg, metadata.catalog.tables()[table_name])
+
+    where_sql = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+
+    selects = list(keys)
+    for a in aggregates:
+        if a.func == 'count':
+            selects.append(f'COUNT({_column(a.column, columns) if a.column else "*"})')
+        elif a.func in FUNCTIONS:
+            selects.append(FUNCTIONS[a.func].format(f'"{a.column}"'))
+        elif a.func in MOMENTS:
+            # variance from running sums, no sqlite extension needed
+            selects.extend([f'COUNT("{a.column}")', f'SUM("{a.column}")', f'SUM("{a.column}" * "{a.column}")'])
+    group_sql = f'GROUP BY {", ".join(keys)} ORDER BY {", ".join(keys)}' if keys else ''
+    query = text(f'SELECT {", ".join(selects) or "COUNT(*)"} FROM {table_name} {where_sql} {group_sql} LIMIT :limit')
+    rows = db.execute(query, {**params, 'limit': limit}).fetchall()
+
+    quantiles = {a.name: _quantiles(db, table_name, keys, where_sql, params, a)
+                 for a in aggregates if a.func == 'quantile'}
+
+    output = []
+    for row in rows:
+        key = tuple(row[:len(keys)])
+        item = dict(zip(group_by, key))
+        values = iter(row[len(keys):])
+        for a in aggregates:
+            if a.func == 'quantile':
+                item[a.name] = quantiles[a.name].get(key)
+            elif a.func in MOMENTS:
+                item[a.name] = _moment(a, next(values), next(values), next(values))
+            else:
+                item[a.name] = next(values)
+        output.append(item)
+    return output, f'table:{table_name}'
+
+
+def aggregate(db: Session, table_name: str, group_by: List[str], where: List[str], agg: List[str],
+              limit: int) -> Tuple[List[dict], str]:
+    found = precomputed(table_name, group_by, where, agg, limit)
+    if found is None:
+        found = partitioned(table_name, group_by, where, agg, limit)
+    if found is not None:
+        return found
+    return scan(db, table_name, group_by, where, agg, limit)
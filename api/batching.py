@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+# coalesces concurrent single-item calls into one `fn(items)` call on a dedicated worker thread;
+# items wait at most `max_wait_ms`, or until `max_size` of them are queued
+class MicroBatcher:
+    def __init__(self, fn: Callable[[List[Any]], List[Any]], max_wait_ms: float = 2, max_size: int = 64):
+        self.fn = fn
+        self.max_wait = max_wait_ms / 1000
+        self.max_size = max(1, max_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='micro-batch')
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+        self.batches = 0
+        self.items = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+
+    async def submit(self, item):
+        self._ensure_worker()
+        future = self._loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    def stats(self) -> dict:
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+        }
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+
+    def _ensure_worker(self):
+        # the queue and worker belong to one event loop; start them lazily on whichever loop serves requests
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._dispatch(batch)
+
+    async def _dispatch(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+
+        items = [item for item, _ in batch]
+        results = await asyncio.get_running_loop().run_in_executor(self._executor, self._score, items)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _score(self, items):
+        try:
+            return self.fn(items)
+        except Exception as e:
+            if len(items) == 1:
+                return [e]
+            # one bad item must not fail its neighbours: retry them one by one
+            logger.debug('batch of %d failed (%s), scoring items individually', len(items), e)
+            results = []
+            for item in items:
+                try:
+                    results.extend(self.fn([item]))
+                except Exception as e:
+                    results.append(e)
+            return results
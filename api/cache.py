@@ -0,0 +1,143 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from api import config
+
+# ext may be compound (.csv.gz); in-progress <artifact>.<pid>.<thread id>.part files never match
+_ARTIFACT = re.compile(r'^(?P<name>.+)-(?P<key>[0-9a-f]{16})(?P<ext>(?:\.[a-z]+)+)$')
+
+
+class ArtifactCache:
+    # derived datasets stored as <name>-<key><ext>, where the key covers the producing query and the
+    # version of the database file, so a new switrs.sqlite never serves stale exports
+
+    def __init__(self, folder: str, max_bytes: int, hash_db: bool = False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hash_db = hash_db
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, threading.Event] = {}
+        # acquire_async callers to wake when a flight ends, besides the threads waiting on its event
+        self._waiters: Dict[str, List[Callable[[], None]]] = {}
+        self._db_hash: Optional[Tuple[Tuple[int, int], str]] = None
+
+    def db_version(self) -> str:
+        st = os.stat(config.DATABASE_URL)
+        stat_key = (st.st_mtime_ns, st.st_size)
+        if not self.hash_db:
+            return f'{st.st_mtime_ns}:{st.st_size}'
+        if self._db_hash is None or self._db_hash[0] != stat_key:
+            digest = hashlib.sha256()
+            with open(config.DATABASE_URL, 'rb') as file:
+                for block in iter(lambda: file.read(1 << 20), b''):
+                    digest.update(block)
+            self._db_hash = (stat_key, digest.hexdigest())
+        return self._db_hash[1]
+
+    def path(self, name: str, ext: str, query: str) -> str:
+        key = hashlib.sha256(f'{query}\0{self.db_version()}'.encode()).hexdigest()[:16]
+        return os.path.join(self.folder, f'{name}-{key}{ext}')
+
+    def hit(self, path: str) -> bool:
+        try:
+            # mtime doubles as the last-access time for LRU eviction
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def acquire(self, path: str, timeout: float) -> bool:
+        # single-flight: True means the caller now produces `path` and must call release();
+        # False means another producer finished (successfully or not) while we waited.
+        # per process: pre-forked workers (api.serving) may each produce the same artifact at once, which only
+        # costs the duplicate work since every producer writes its own temp file and the last os.replace wins
+        with self._lock:
+            event = self._in_flight.get(path)
+            if event is None:
+                self._in_flight[path] = threading.Event()
+                return True
+        if not event.wait(timeout):
+            raise TimeoutError(f'{path} is still being produced')
+        return False
+
+    async def acquire_async(self, path: str, timeout: float) -> bool:
+        # acquire() for the event loop: the wait holds no thread, so requests waiting on another one's export
+        # can't use up a threadpool
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def wake():
+            if not done.done():
+                done.set_result(None)
+
+        def notify():
+            # from whichever thread releases the flight
+            try:
+                loop.call_soon_threadsafe(wake)
+            except RuntimeError:
+                # the loop is closed, nobody is waiting anymore
+                pass
+
+        with self._lock:
+            if path not in self._in_flight:
+                self._in_flight[path] = threading.Event()
+                return True
+            self._waiters.setdefault(path, []).append(notify)
+        try:
+            await asyncio.wait_for(done, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f'{path} is still being produced')
+        return False
+
+    def release(self, path: str):
+        with self._lock:
+            event = self._in_flight.pop(path, None)
+            waiters = self._waiters.pop(path, [])
+        if event is not None:
+            event.set()
+        for wake in waiters:
+            wake()
+
+    def temp_path(self, path: str) -> str:
+        # thread idents repeat across forked workers, so the pid keeps their temp files apart
+        return f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+
+    def commit(self, temp_path: str, path: str):
+        os.replace(temp_path, path)
+        self._evict(keep=path)
+
+    def _evict(self, keep: str):
+        name, ext = _ARTIFACT.match(os.path.basename(keep)).group('name', 'ext')
+        artifacts = []
+        for entry in os.scandir(self.folder):
+            match = _ARTIFACT.match(entry.name)
+            if not match or not entry.is_file() or entry.path == keep:
+                continue
+            if match.group('name', 'ext') == (name, ext):
+                # an older version of the artifact we just wrote
+                self._remove(entry.path)
+                continue
+            st = entry.stat()
+            artifacts.append((st.st_mtime, st.st_size, entry.path))
+
+        total = os.path.getsize(keep) + sum(size for _, size, _ in artifacts)
+        for _, size, path in sorted(artifacts):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+            logging.info('evicted cached artifact %s', path)
+        except FileNotFoundError:
+            pass
+
+
+artifacts = ArtifactCache(config.DATA_FOLDER, config.CACHE_MAX_BYTES, hash_db=config.CACHE_HASH_DB)
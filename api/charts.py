@@ -0,0 +1,203 @@
+import json
+import logging
+import os
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from api import aggregate, config, database, queries, summaries
+from api.cache import artifacts
+
+# part of every chart's cache key: bump it when a spec below changes
+SPEC_VERSION = 2
+SCHEMA = 'https://vega.github.io/schema/vega-lite/v5.json'
+AT_FAULT = 'at_fault:eq:1'
+PEOPLE_FILTER = [AT_FAULT, 'party_sex:in:female|male', 'party_age:notnull', 'cellphone_in_use:notnull',
+                 'party_race:notnull']
+
+
+def _counts(db: Session, column: str, where: Sequence[str]) -> List[Tuple[object, int]]:
+    # (value, count) pairs without nulls, answered from the summary tables when they are current
+    rows, _ = aggregate.aggregate(db, 'parties', [column], list(where), ['count'], 10_000)
+    return [(row[column], row['count']) for row in rows if row[column] is not None]
+
+
+def box_stats(counts: List[Tuple[object, int]]) -> dict:
+    # what a box plot draws, from value counts instead of the individual values: quartiles interpolated like
+    # numpy, whiskers at the furthest values within 1.5 IQR of the box, and every value beyond them
+    if not counts:
+        # nothing to draw, e.g. every row filtered out
+        return {'lower': None, 'q1': None, 'median': None, 'q3': None, 'upper': None, 'outliers': []}
+    values = np.array([v for v, _ in counts], dtype=np.float64)
+    weights = np.array([c for _, c in counts], dtype=np.int64)
+    order = np.argsort(values)
+    values, cumulative = values[order], np.cumsum(weights[order])
+
+    def quantile(p):
+        position = (cumulative[-1] - 1) * p
+        low = int(position)
+        lower = values[np.searchsorted(cumulative, low + 1)]
+        upper = values[np.searchsorted(cumulative, min(low + 2, cumulative[-1]))]
+        return float(lower + (position - low) * (upper - lower))
+
+    q1, median, q3 = quantile(0.25), quantile(0.5), quantile(0.75)
+    inside = values[(values >= q1 - 1.5 * (q3 - q1)) & (values <= q3 + 1.5 * (q3 - q1))]
+    lower, upper = float(inside.min()), float(inside.max())
+    return {'lower': lower, 'q1': q1, 'median': median, 'q3': q3, 'upper': upper,
+            'outliers': [float(v) for v in values if v < lower or v > upper]}
+
+
+def _box_plot(stats: dict, title: str, field: str, domain=None) -> dict:
+    y = {'type': 'quantitative', 'title': field}
+    if domain is not None:
+        y['scale'] = {'domain': domain, 'clamp': True}
+    box = [{k: v for k, v in stats.items() if k != 'outliers'}]
+    return {
+        '$schema': SCHEMA, 'title': title, 'width': 200, 'height': 400,
+        'layer': [
+            {'data': {'values': box}, 'mark': 'rule',
+             'encoding': {'y': {'field': 'lower', **y}, 'y2': {'field': 'upper'}}},
+            {'data': {'values': box}, 'mark': {'type': 'bar', 'size': 60, 'color': 'steelblue'},
+             'encoding': {'y': {'field': 'q1', **y}, 'y2': {'field': 'q3'}}},
+            {'data': {'values': box}, 'mark': {'type': 'tick', 'size': 60, 'color': 'white', 'thickness': 2},
+             'encoding': {'y': {'field': 'median', **y}}},
+            {'data': {'values': [{'value': v} for v in stats['outliers']]},
+             'mark': {'type': 'point', 'color': 'black', 'size': 12},
+             'encoding': {'y': {'field': 'value', **y}}},
+        ],
+    }
+
+
+def _bar_chart(values: List[dict], x: str, y: str, title: str, x_title: str, y_title: str, **mark) -> dict:
+    return {
+        '$schema': SCHEMA, 'title': title, 'data': {'values': values},
+        'mark': {'type': 'bar', **mark},
+        'encoding': {'x': {'field': x, 'type': 'ordinal', 'title': x_title, 'axis': {'labelAngle': -45}},
+                     'y': {'field': y, 'type': 'quantitative', 'title': y_title}},
+    }
+
+
+def _pie(counts: List[Tuple[object, int]], title: str, labels: Dict[object, str] = None,
+         colors: Dict[str, str] = None) -> dict:
+    total = sum(c for _, c in counts)
+    values = [{'label': labels.get(v, str(v)) if labels else str(v), 'count': c,
+               'share': f'{100 * c / total:.1f}%'} for v, c in counts]
+    color = {'field': 'label', 'type': 'nominal', 'title': None}
+    if colors is not None:
+        # colors per label: without the domain, vega-lite would pair the range with the labels sorted alphabetically
+        color['scale'] = {'domain': list(colors), 'range': list(colors.values())}
+    return {
+        'title': title, 'data': {'values': values},
+        'encoding': {'theta': {'field': 'count', 'type': 'quantitative', 'stack': True}, 'color': color},
+        'layer': [{'mark': {'type': 'arc', 'outerRadius': 110}},
+                  {'mark': {'type': 'text', 'radius': 130}, 'encoding': {'text': {'field': 'share'}}}],
+    }
+
+
+def vehicle_year_box(db: Session) -> dict:
+    return _box_plot(box_stats(_counts(db, 'vehicle_year', [AT_FAULT])), 'Vehicle Year Distribution',
+                     'Vehicle Year', domain=[1900, 2025])
+
+
+def cars_by_year(db: Session) -> dict:
+    counts = _counts(db, 'vehicle_year', [AT_FAULT, 'vehicle_year:ge:1980', 'vehicle_year:le:2022'])
+    return _bar_chart([{'year': v, 'count': c} for v, c in counts], 'year', 'count',
+                      'Number of Cars by Manufacture Year Involved in Accidents', 'Car Manufacture Year',
+                      'Number of Incidents', color='skyblue')
+
+
+def people_age_box(db: Session) -> dict:
+    return _box_plot(box_stats(_counts(db, 'party_age', [AT_FAULT])), 'People Age Distribution', 'Age')
+
+
+def people_pies(db: Session) -> dict:
+    # ordered like value_counts(): most frequent first
+    def counts(column):
+        return sorted(_counts(db, column, PEOPLE_FILTER), key=lambda item: -item[1])
+
+    return {
+        '$schema': SCHEMA,
+        'hconcat': [
+            _pie(counts('party_sex'), 'Gender Distribution', {'male': 'Male', 'female': 'Female'},
+                 {'Male': 'blue', 'Female': 'pink'}),
+            _pie(counts('party_race'), 'Race Distribution'),
+            _pie(counts('cellphone_in_use'), 'Phone Usage Distribution', {0: 'Not Used', 1: 'Used'}),
+        ],
+        'resolve': {'scale': {'color': 'independent'}},
+    }
+
+
+def traumas_comparison(db: Session) -> dict:
+    if summaries.current('traumas_by_age_group'):
+        rows = summaries.rows('traumas_by_age_group')
+    else:
+        rows = summaries.partitioned(summaries.REGISTRY['traumas_by_age_group'])
+        if rows is None:
+            rows = [dict(row._mapping) for row in db.execute(text(queries.TRAUMAS.sql))]
+    values = [{**row, 'fatality_prob': round(row['total_killed'] / row['total_people'], 5),
+               'trauma_prob': round(row['total_injured'] / row['total_people'], 5)} for row in rows]
+    charts = [('total_killed', 'Total Killed', 'Total People Killed by Age Group'),
+              ('fatality_prob', 'Fatality Probability', 'Fatality Probability'),
+              ('trauma_prob', 'Trauma Probability', 'Trauma Probability by Age Group')]
+    return {
+        '$schema': SCHEMA, 'data': {'values': values},
+        'hconcat': [{'title': title, 'mark': 'bar', 'width': 200, 'encoding': {
+            'x': {'field': 'age_group', 'type': 'nominal', 'title': 'Age Group'},
+            'y': {'field': field, 'type': 'quantitative', 'title': y_title},
+            'color': {'field': 'age_group', 'type': 'nominal', 'legend': None}}}
+            for field, y_title, title in charts],
+    }
+
+
+CHARTS: Dict[str, Callable[[Session], dict]] = {
+    'vehicle_year_box': vehicle_year_box,
+    'cars_by_year': cars_by_year,
+    'people_age_box': people_age_box,
+    'people_pies': people_pies,
+    'traumas_comparison': traumas_comparison,
+}
+
+
+def path(name: str) -> str:
+    if name not in CHARTS:
+        raise HTTPException(status_code=404, detail=f"unknown chart {name}, expected one of {list(CHARTS)}")
+    # keyed by the database version like the exports, so a chart is built once per dataset
+    return artifacts.path(f'chart_{name}', '.json', f'chart:{name}:{SPEC_VERSION}')
+
+
+def _build(name: str) -> bytes:
+    with database.SessionLocal() as db:
+        return json.dumps(CHARTS[name](db)).encode()
+
+
+def spec(name: str) -> bytes:
+    # a Vega-Lite spec with the plot-ready summary inlined, rendered by the browser
+    os.makedirs(artifacts.folder, exist_ok=True)
+    cache_path = path(name)
+    # single-flight like the exports: one request builds it, concurrent ones wait and read the file
+    while not artifacts.hit(cache_path):
+        try:
+            if artifacts.acquire(cache_path, config.CACHE_WAIT_TIMEOUT):
+                break
+        except TimeoutError:
+            logging.warning('timed out waiting for %s, building it without the cache', cache_path)
+            return _build(name)
+    else:
+        with open(cache_path, 'rb') as file:
+            return file.read()
+    try:
+        if artifacts.hit(cache_path):
+            with open(cache_path, 'rb') as file:
+                return file.read()
+        data = _build(name)
+        tmp_path = artifacts.temp_path(cache_path)
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        artifacts.commit(tmp_path, cache_path)
+        logging.info('built chart %s', cache_path)
+        return data
+    finally:
+        artifacts.release(cache_path)
@@ -2,6 +2,81 @@ import logging
 import os
 
 DATABASE_URL = os.environ.get('DATABASE_URL')
+# read-replica mode for the static dataset: open it ?mode=ro&immutable=1 with the tuning below
+DATABASE_READ_ONLY = os.environ.get('DATABASE_READ_ONLY', '0') == '1'
+DATABASE_MMAP_SIZE = int(os.environ.get('DATABASE_MMAP_SIZE', 1024 ** 3))
+# page cache per connection, in KiB
+DATABASE_CACHE_SIZE_KB = int(os.environ.get('DATABASE_CACHE_SIZE_KB', 64 * 1024))
+# e.g. MEMORY; left to sqlite by default, in-memory temp b-trees made the GROUP BY sorts twice as slow here
+DATABASE_TEMP_STORE = os.environ.get('DATABASE_TEMP_STORE', '')
+# one connection per threadpool worker (anyio runs sync endpoints on 40 threads by default)
+DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 40))
+# where derived exports (parties.csv, traumas.csv) and summary tables are kept
+DATA_FOLDER = os.environ.get('DATA_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+# sidecar database with the materialized summary tables, see `python -m api.summaries`
+SUMMARY_DB = os.environ.get('SUMMARY_DB', os.path.join(DATA_FOLDER, 'summaries.sqlite'))
+# HyperLogLog and KLL sketches per column, see `python -m api.sketches`
+SKETCHES_FILE = os.environ.get('SKETCHES_FILE', os.path.join(DATA_FOLDER, 'sketches.json'))
+# dictionary-encoded, memory-mapped columns of the parties table, see `python -m api.snapshot`
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', os.path.join(DATA_FOLDER, 'parties.snapshot'))
+# COUNT(*) every table for the catalog instead of estimating the row count from MAX(rowid)
+CATALOG_EXACT_COUNTS = os.environ.get('CATALOG_EXACT_COUNTS', '0') == '1'
+# size bound for the cached exports, least recently used ones are evicted first
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# version cached exports by a sha256 of the database file instead of its mtime and size
+CACHE_HASH_DB = os.environ.get('CACHE_HASH_DB', '0') == '1'
+# how long a request waits for a concurrent request producing the same export before running the query itself
+CACHE_WAIT_TIMEOUT = float(os.environ.get('CACHE_WAIT_TIMEOUT', 600))
+# run the index advisor (api.indexes) in the background at startup: "report" logs its proposals; creating them
+# changes switrs.sqlite, and with it the version of every cached export, summary, sketch and snapshot, so that is
+# only done offline with `python -m api.indexes --apply`
+INDEX_ADVISOR = os.environ.get('INDEX_ADVISOR', '')
+# in-memory cache of small GET responses (see api.http_cache), keyed by url and data version
+HTTP_CACHE_MAX_BYTES = int(os.environ.get('HTTP_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+HTTP_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('HTTP_CACHE_MAX_ENTRY_BYTES', 1024 ** 2))
+HTTP_CACHE_TTL = float(os.environ.get('HTTP_CACHE_TTL', 300))
+# Cache-Control max-age for clients; 0 sends no-cache, so they revalidate with If-None-Match every time
+HTTP_CACHE_MAX_AGE = int(os.environ.get('HTTP_CACHE_MAX_AGE', 0))
+# negotiated gzip/zstd: bodies below this size are sent as they are
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+# rows fetched from sqlite and encoded per chunk when streaming an export
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 10_000))
+# threads the export scans may occupy at once, apart from the threadpool that serves interactive requests
+EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', 4))
+
+# queries slower than this are logged with their EXPLAIN QUERY PLAN
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 250))
+# GET /debug/profile samples every thread's stack for a while; off unless asked for
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', '0') == '1'
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 60))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 10))
+# how often each api.serving worker writes its metrics for the others to add up on a scrape
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 1))
+
+# the trained pipeline; joblib can memory-map the numpy arrays in it read-only with MODEL_MMAP_MODE=r
+MODEL_PATH = os.environ.get('MODEL_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model.pkl'))
+MODEL_MMAP_MODE = os.environ.get('MODEL_MMAP_MODE', '')
+# `python -m api.serving`: pre-forked workers sharing one loaded model, see api.serving
+API_HOST = os.environ.get('API_HOST', '0.0.0.0')
+API_PORT = int(os.environ.get('API_PORT', 8000))
+API_WORKERS = int(os.environ.get('API_WORKERS', os.cpu_count() or 1))
+# full-table scans (csv exports, aggregates, summary builds) split into rowid ranges run on this many processes,
+# see api.partitions; 1 keeps them on a single connection. Every api worker has its own pool, started on its first
+# scan: by default a scan gets every cpu, so workers scanning at the same time share them with up to
+# API_WORKERS * SCAN_PROCESSES processes; cpus // API_WORKERS never oversubscribes, but under api.serving's
+# default of a worker per cpu that is 1, no partitioning at all
+SCAN_PROCESSES = int(os.environ.get('SCAN_PROCESSES', os.cpu_count() or 1))
+# tables with fewer rows are scanned in-process, the pool's overhead would outweigh the gain
+SCAN_MIN_ROWS = int(os.environ.get('SCAN_MIN_ROWS', 200_000))
+SCAN_PARTITION_ROWS = int(os.environ.get('SCAN_PARTITION_ROWS', 50_000))
+# /predict micro-batching of the sklearn pipeline: wait at most this long for more requests, or until the batch is
+# full; with the fast path below it only gets the requests too close to the decision boundary for the folded model
+PREDICT_BATCH_WINDOW_MS = float(os.environ.get('PREDICT_BATCH_WINDOW_MS', 2))
+PREDICT_BATCH_MAX_SIZE = int(os.environ.get('PREDICT_BATCH_MAX_SIZE', 64))
+# score with the model's coefficients folded into a per-category lookup instead of the sklearn pipeline
+PREDICT_FAST_PATH = os.environ.get('PREDICT_FAST_PATH', '1') == '1'
 
 
 def check():
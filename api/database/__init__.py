@@ -1,10 +1,42 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from api import config, metrics
 from api.config import DATABASE_URL
 
-engine = create_engine(f'sqlite:///{DATABASE_URL}', connect_args={"check_same_thread": False})
+
+def _tune(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f'PRAGMA mmap_size = {config.DATABASE_MMAP_SIZE}')
+    cursor.execute(f'PRAGMA cache_size = -{config.DATABASE_CACHE_SIZE_KB}')
+    if config.DATABASE_TEMP_STORE:
+        cursor.execute(f'PRAGMA temp_store = {config.DATABASE_TEMP_STORE}')
+    cursor.execute('PRAGMA query_only = 1')
+    cursor.close()
+
+
+if config.DATABASE_READ_ONLY:
+    # immutable=1 lets sqlite skip locking and change detection entirely, so the file must not change underneath
+    _path = f'file:{DATABASE_URL}?mode=ro&immutable=1&uri=true'
+    _pool = {'pool_size': config.DATABASE_POOL_SIZE, 'max_overflow': 0}
+else:
+    _path = DATABASE_URL
+    _pool = {}
+
+engine = create_engine(f'sqlite:///{_path}', connect_args={"check_same_thread": False}, **_pool)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# the endpoints' engine: aiosqlite runs each connection on its own thread, so queries don't hold the event loop
+# or a threadpool token while sqlite works
+async_engine = create_async_engine(f'sqlite+aiosqlite:///{_path}', **_pool)
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+if config.DATABASE_READ_ONLY:
+    event.listen(engine, 'connect', _tune)
+    event.listen(async_engine.sync_engine, 'connect', _tune)
+metrics.instrument(engine)
+metrics.instrument(async_engine.sync_engine)
+
 Base = declarative_base()
 
 TABLES = ['case_ids', 'collisions', 'parties', 'victims']
@@ -16,3 +48,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
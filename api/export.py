@@ -0,0 +1,412 @@
+import csv
+import importlib.util
+import logging
+import os
+import threading
+import time
+from email.utils import formatdate
+from io import StringIO
+from typing import AsyncIterator, Iterator, List, NamedTuple, Optional, Sequence
+
+import anyio
+import numpy as np
+from fastapi import HTTPException
+from sqlalchemy import text
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, Response, StreamingResponse
+
+from api import (aggregate, compression, config, database, http_cache, metadata, metrics, partitions, snapshot,
+                 summaries)
+from api.cache import artifacts
+from api.queries import Query
+
+
+class Format(NamedTuple):
+    name: str
+    ext: str
+    media_type: str
+
+
+FORMATS = {
+    'csv': Format('csv', '.csv', 'text/csv'),
+    'arrow': Format('arrow', '.arrow', 'application/vnd.apache.arrow.stream'),
+    'parquet': Format('parquet', '.parquet', 'application/vnd.apache.parquet'),
+}
+_MEDIA_TYPES = {f.media_type: f for f in FORMATS.values()}
+_MEDIA_TYPES['application/x-parquet'] = FORMATS['parquet']
+# the columnar formats need pyarrow, which the csv-only deployments don't have to install
+HAS_ARROW = importlib.util.find_spec('pyarrow') is not None
+
+
+def negotiate(format: Optional[str], accept: Optional[str]) -> Format:
+    if format is not None:
+        if format not in FORMATS:
+            raise HTTPException(status_code=400, detail=f"unknown format {format}, expected one of {list(FORMATS)}")
+        if format != 'csv' and not HAS_ARROW:
+            raise HTTPException(status_code=406, detail=f"{format} export needs pyarrow installed on the server")
+        return FORMATS[format]
+    for media_type in (accept or '').split(','):
+        found = _MEDIA_TYPES.get(media_type.split(';')[0].strip())
+        if found is not None and (found.name == 'csv' or HAS_ARROW):
+            return found
+    return FORMATS['csv']
+
+
+class CsvEncoder:
+    def __init__(self, query: Query):
+        self.buffer = StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def _drain(self) -> bytes:
+        chunk = self.buffer.getvalue().encode('utf-8')
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return chunk
+
+    def header(self, keys: Sequence[str]) -> bytes:
+        self.writer.writerow(keys)
+        return self._drain()
+
+    def rows(self, rows: List[Sequence]) -> bytes:
+        self.writer.writerows(rows)
+        return self._drain()
+
+    def close(self) -> bytes:
+        return self._drain()
+
+
+class _Sink:
+    # file-like target for pyarrow writers that hands back whatever was written since the last drain
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.parts.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        chunk = b''.join(self.parts)
+        self.parts.clear()
+        return chunk
+
+
+def arrow_type(pa, alias: str):
+    if alias.startswith('dictionary:'):
+        return pa.dictionary(pa.int32(), pa.type_for_alias(alias.partition(':')[2]))
+    return pa.type_for_alias(alias)
+
+
+class ArrowEncoder:
+    # one record batch (or parquet row group) per fetched chunk, with the column types from the query definition
+
+    def __init__(self, query: Query, parquet: bool = False):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.schema = pa.schema([(name, arrow_type(pa, type_)) for name, type_ in query.columns.items()])
+        self.sink = _Sink()
+        if parquet:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(self.sink, self.schema)
+        else:
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def header(self, keys: Sequence[str]) -> bytes:
+        if list(keys) != self.schema.names:
+            raise ValueError(f'query returned columns {list(keys)}, expected {self.schema.names}')
+        return self.sink.drain()
+
+    def rows(self, rows: List[Sequence]) -> bytes:
+        columns = zip(*rows) if rows else [[] for _ in self.schema]
+        return self.arrays([self.pa.array(column, type=field.type) for column, field in zip(columns, self.schema)])
+
+    def arrays(self, arrays: list) -> bytes:
+        self.writer.write_batch(self.pa.record_batch(arrays, schema=self.schema))
+        return self.sink.drain()
+
+    def close(self) -> bytes:
+        self.writer.close()
+        return self.sink.drain()
+
+
+def _encoder(query: Query, fmt: Format):
+    if fmt.name == 'csv':
+        return CsvEncoder(query)
+    return ArrowEncoder(query, parquet=fmt.name == 'parquet')
+
+
+def from_snapshot(query: Query, fmt: Format) -> Optional[snapshot.Snapshot]:
+    # the columnar formats of a query over the snapshotted table, while the snapshot is current
+    if fmt.name == 'csv' or query.table is None:
+        return None
+    snap = snapshot.store.get(query.table)
+    if snap is None:
+        return None
+    for name, type_ in query.columns.items():
+        column = snap.columns.get(name)
+        if column is None or column.categorical != type_.endswith('string'):
+            return None
+    if not snap.comparable(aggregate.split_filters(list(query.where), list(snap.columns))):
+        return None
+    return snap
+
+
+def _encode_snapshot(query: Query, fmt: Format, snap: snapshot.Snapshot) -> Iterator[bytes]:
+    # query.sql's rows in the same order and batches, sliced out of the memory-mapped columns
+    encoder = ArrowEncoder(query, parquet=fmt.name == 'parquet')
+    pa = encoder.pa
+    yield encoder.header(list(query.columns))
+    start = time.perf_counter()
+    rows = np.flatnonzero(snap.where(aggregate.split_filters(list(query.where), list(snap.columns))))
+    dictionaries = {name: pa.array(snap.columns[name].categories, type=pa.binary()).cast(pa.string())
+                    for name in query.columns if snap.columns[name].categorical}
+    for offset in range(0, len(rows), config.EXPORT_CHUNK_ROWS):
+        chunk = rows[offset:offset + config.EXPORT_CHUNK_ROWS]
+        arrays = []
+        for field in encoder.schema:
+            column = snap.columns[field.name]
+            values = column.values[chunk]
+            if field.name in dictionaries:
+                codes = pa.array(values.astype(np.int32), mask=values < 0)
+                array = pa.DictionaryArray.from_arrays(codes, dictionaries[field.name])
+                arrays.append(array if pa.types.is_dictionary(field.type) else array.dictionary_decode())
+            else:
+                nulls = column.nulls[chunk] if column.nulls is not None else None
+                arrays.append(pa.array(values, mask=nulls, type=field.type))
+        data = encoder.arrays(arrays)
+        metrics.EXPORT_SECONDS.observe(time.perf_counter() - start, stage='fetch_encode')
+        yield data
+        start = time.perf_counter()
+    metrics.QUERY_ROWS.observe(len(rows), query=query.name)
+    chunk = encoder.close()
+    if chunk:
+        yield chunk
+
+
+def _encode_partitioned(query: Query, fmt: Format) -> Iterator[bytes]:
+    # the same bytes as the single scan: grouped queries merged from their summary's per-range partials, csv rows
+    # encoded by the scan processes and concatenated in rowid order
+    encoder = _encoder(query, fmt)
+    yield encoder.header(list(query.columns))
+    start = time.perf_counter()
+    if query.summary is not None:
+        rows = [tuple(row.values()) for row in summaries.partitioned(summaries.REGISTRY[query.summary])]
+        chunks = iter([(encoder.rows(rows), len(rows))])
+    else:
+        table = metadata.catalog.tables()[query.table]
+        clauses, params = aggregate.parse_filters(list(query.where), table.column_names)
+        chunks = partitions.rows_csv(table.name, table.max_rowid, [f'"{name}"' for name in query.columns],
+                                     ' AND '.join(clauses), params)
+    count = 0
+    for chunk, rows in chunks:
+        metrics.EXPORT_SECONDS.observe(time.perf_counter() - start, stage='fetch_encode')
+        count += rows
+        yield chunk
+        start = time.perf_counter()
+    metrics.QUERY_ROWS.observe(count, query=query.name)
+    chunk = encoder.close()
+    if chunk:
+        yield chunk
+
+
+def _partitioned(query: Query, fmt: Format) -> bool:
+    # only csv rows can be encoded in the scan processes, the columnar formats come from a single writer
+    if query.source != 'main' or (query.summary is None and (query.table is None or fmt.name != 'csv')):
+        return False
+    table = query.table or summaries.REGISTRY[query.summary].table
+    return partitions.enabled(metadata.catalog.tables()[table].row_count)
+
+
+def encode(query: Query, fmt: Format, snap: Optional[snapshot.Snapshot] = None) -> Iterator[bytes]:
+    # the query result, fetched and encoded chunk by chunk
+    if snap is not None:
+        yield from _encode_snapshot(query, fmt, snap)
+        return
+    if _partitioned(query, fmt):
+        yield from _encode_partitioned(query, fmt)
+        return
+    sessions = summaries.SessionLocal if query.source == 'summary' else database.SessionLocal
+    with sessions() as db:
+        result = db.execute(text(query.sql).execution_options(yield_per=config.EXPORT_CHUNK_ROWS))
+        encoder = _encoder(query, fmt)
+        yield encoder.header(list(result.keys()))
+        count = 0
+        start = time.perf_counter()
+        for rows in result.partitions(config.EXPORT_CHUNK_ROWS):
+            chunk = encoder.rows(rows)
+            metrics.EXPORT_SECONDS.observe(time.perf_counter() - start, stage='fetch_encode')
+            count += len(rows)
+            yield chunk
+            start = time.perf_counter()
+        chunk = encoder.close()
+        metrics.QUERY_ROWS.observe(count, query=query.name)
+        if chunk:
+            yield chunk
+
+
+def read(path: str) -> Iterator[bytes]:
+    with open(path, 'rb') as file:
+        yield from iter(lambda: file.read(1 << 20), b'')
+
+
+class Flight:
+    # our hold on the single-flight lock of cache_path, released once by whichever ends first: the export, or the
+    # response when its body never started (client gone before the first chunk, an error while building it)
+
+    def __init__(self, cache_path: str):
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._released = False
+
+    def release(self):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        artifacts.release(self.cache_path)
+
+
+def stream(chunks: Iterator[bytes], cache_path: Optional[str] = None,
+           flight: Optional[Flight] = None) -> Iterator[bytes]:
+    # sends each chunk to the client and the cache file as it goes;
+    # the cache file only appears (atomically) once the whole result has been written
+    tmp_path = artifacts.temp_path(cache_path) if cache_path else os.devnull
+    completed = False
+    try:
+        with open(tmp_path, 'wb') as file:
+            for chunk in chunks:
+                with metrics.EXPORT_SECONDS.time(stage='write'):
+                    file.write(chunk)
+                yield chunk
+        if cache_path:
+            artifacts.commit(tmp_path, cache_path)
+        completed = True
+    finally:
+        chunks.close()
+        if cache_path:
+            if not completed:
+                logging.info('export of %s aborted, discarding partial file', cache_path)
+                os.remove(tmp_path)
+        if flight is not None:
+            flight.release()
+
+
+def _key(query: Query, snap: Optional[snapshot.Snapshot]) -> str:
+    # exports cut from the snapshot hold the same rows, but not the same bytes
+    return f'{query.sql}\0snapshot' if snap is not None else query.sql
+
+
+def produce(query: Query, fmt: Format, encoding: Optional[compression.Encoding],
+            snap: Optional[snapshot.Snapshot] = None) -> Iterator[bytes]:
+    if encoding is None:
+        return encode(query, fmt, snap)
+    # compressing the cached plain export is much cheaper than running the query again
+    plain_path = artifacts.path(query.name, fmt.ext, _key(query, snap))
+    source = read(plain_path) if artifacts.hit(plain_path) else encode(query, fmt, snap)
+    return compression.compress(source, encoding)
+
+
+_limiter: Optional[anyio.CapacityLimiter] = None
+
+
+def limiter() -> anyio.CapacityLimiter:
+    # created on first use, inside the event loop
+    global _limiter
+    if _limiter is None:
+        _limiter = anyio.CapacityLimiter(config.EXPORT_WORKERS)
+    return _limiter
+
+
+async def offload(chunks: Iterator[bytes]) -> AsyncIterator[bytes]:
+    # drives the blocking export generator on threads bounded by EXPORT_WORKERS, instead of the default
+    # threadpool starlette would iterate it on; each step is uncancellable, so closing never races a fetch
+    try:
+        while True:
+            chunk = await anyio.to_thread.run_sync(next, chunks, None, limiter=limiter())
+            if chunk is None:
+                break
+            yield chunk
+    finally:
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(chunks.close, limiter=limiter())
+
+
+async def run(fn, *args):
+    # short blocking work of an export request (stats, the snapshot and summary lookups), on the export threads too
+    return await anyio.to_thread.run_sync(fn, *args, limiter=limiter())
+
+
+class Plan(NamedTuple):
+    encoding: Optional[compression.Encoding]
+    snap: Optional[snapshot.Snapshot]
+    cache_path: str
+    etag: str
+    validators: dict
+
+
+def plan(query: Query, fmt: Format, accept_encoding: Optional[str]) -> Plan:
+    os.makedirs(artifacts.folder, exist_ok=True)
+    # parquet pages are compressed already
+    encoding = compression.negotiate(accept_encoding) if fmt.name != 'parquet' else None
+    snap = from_snapshot(query, fmt)
+    cache_path = artifacts.path(query.name, fmt.ext + (encoding.ext if encoding else ''), _key(query, snap))
+    # the artifact name already covers the query, the format, the encoding and the database version; the file's
+    # own mtime can't be used since cache hits touch it, which would break If-Range on resumed downloads
+    etag = f'"{os.path.basename(cache_path)}"'
+    validators = {
+        'ETag': etag,
+        'Last-Modified': formatdate(os.stat(config.DATABASE_URL).st_mtime, usegmt=True),
+        'Cache-Control': http_cache.cache_control(),
+        'Vary': 'Accept, Accept-Encoding',
+    }
+    return Plan(encoding, snap, cache_path, etag, validators)
+
+
+async def respond(query: Query, fmt: Format, if_none_match: Optional[str] = None,
+                  accept_encoding: Optional[str] = None):
+    # async, so a request waiting for another one's export of the same artifact holds no thread while it waits
+    encoding, snap, cache_path, etag, validators = await run(plan, query, fmt, accept_encoding)
+    if http_cache.etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=validators)
+
+    filename = query.filename + fmt.ext
+    headers = {'Content-Disposition': f'attachment; filename="{filename}"', **validators}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding.name
+
+    while not await run(artifacts.hit, cache_path):
+        try:
+            if await artifacts.acquire_async(cache_path, config.CACHE_WAIT_TIMEOUT):
+                break
+        except TimeoutError:
+            logging.warning('timed out waiting for %s, exporting without the cache', cache_path)
+            return StreamingResponse(offload(stream(produce(query, fmt, encoding, snap))),
+                                     media_type=fmt.media_type, headers=headers)
+    else:
+        return FileResponse(path=cache_path, media_type=fmt.media_type, headers=headers)
+
+    # we own the flight now, but another producer may have finished right before we took it
+    flight = Flight(cache_path)
+    try:
+        if await run(artifacts.hit, cache_path):
+            flight.release()
+            return FileResponse(path=cache_path, media_type=fmt.media_type, headers=headers)
+        body = offload(stream(produce(query, fmt, encoding, snap), cache_path, flight))
+        return StreamingResponse(body, media_type=fmt.media_type, headers=headers,
+                                 background=BackgroundTask(flight.release))
+    except BaseException:
+        flight.release()
+        raise
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, NamedTuple, Optional, Tuple
+
+from starlette.datastructures import Headers
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api import config
+from api.cache import artifacts
+
+# GET endpoints whose response is a function of the url and the data files only
+CACHEABLE = ('/head', '/data_info', '/aggregate', '/stats/', '/summaries', '/charts', '/theory', '/preview_message')
+
+
+def data_version() -> str:
+    # everything a cacheable response can depend on: the database, the summary tables and the sketches
+    parts = [artifacts.db_version()]
+    for path in (config.SUMMARY_DB, config.SKETCHES_FILE):
+        try:
+            st = os.stat(path)
+            parts.append(f'{st.st_mtime_ns}:{st.st_size}')
+        except FileNotFoundError:
+            parts.append('-')
+    return '/'.join(parts)
+
+
+def cache_control() -> str:
+    # no-cache still lets clients store the response, they just revalidate it (cheaply, with a 304) every time
+    return f'max-age={config.HTTP_CACHE_MAX_AGE}' if config.HTTP_CACHE_MAX_AGE > 0 else 'no-cache'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    # weak comparison, as If-None-Match requires
+    return '*' in tags or etag in tags or f'W/{etag}' in tags
+
+
+class Entry(NamedTuple):
+    status: int
+    headers: List[Tuple[bytes, bytes]]
+    body: bytes
+    expires: float
+
+
+class ResponseCache:
+    # LRU over whole responses, bounded in bytes, with entries expiring after a ttl
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[str, Entry]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[Entry]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry.expires < time.monotonic():
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        # HTTP_CACHE_MAX_BYTES=0 turns the cache off, empty bodies included
+        if not self.max_bytes or len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = Entry(status, headers, body, time.monotonic() + self.ttl)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key: str):
+        self.size -= len(self._entries.pop(key).body)
+
+
+responses = ResponseCache(config.HTTP_CACHE_MAX_BYTES, config.HTTP_CACHE_TTL)
+
+
+class CacheMiddleware:
+    # strong ETags from the data version and the request, 304s without running the endpoint,
+    # and replay of small responses from memory
+
+    def __init__(self, app: ASGIApp, cache: Optional[ResponseCache] = None,
+                 max_entry_bytes: int = config.HTTP_CACHE_MAX_ENTRY_BYTES):
+        self.app = app
+        self.cache = cache or responses
+        self.max_entry_bytes = max_entry_bytes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['method'] != 'GET' or not scope['path'].startswith(CACHEABLE):
+            return await self.app(scope, receive, send)
+
+        headers = Headers(scope=scope)
+        # content negotiation headers are part of the key, so each representation gets its own tag
+        request = '\0'.join([scope['path'], scope['query_string'].decode('latin-1'),
+                             headers.get('accept', ''), headers.get('accept-encoding', '')])
+        key = hashlib.sha256(f'{data_version()}\0{request}'.encode()).hexdigest()
+        etag = f'"{key[:32]}"'
+        validators = [(b'etag', etag.encode()), (b'cache-control', cache_control().encode())]
+
+        if etag_matches(headers.get('if-none-match'), etag):
+            await send({'type': 'http.response.start', 'status': 304, 'headers': validators})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            await send({'type': 'http.response.start', 'status': entry.status, 'headers': entry.headers})
+            await send({'type': 'http.response.body', 'body': entry.body})
+            return
+
+        start: Optional[Message] = None
+        body: Optional[List[bytes]] = []
+        size = 0
+
+        async def capture(message: Message):
+            nonlocal start, body, size
+            if message['type'] == 'http.response.start':
+                start = message
+                if message['status'] == 200:
+                    message['headers'] = [h for h in message['headers']
+                                          if h[0].lower() not in (b'etag', b'cache-control')] + validators
+            elif message['type'] == 'http.response.body' and body is not None:
+                body.append(message.get('body', b''))
+                size += len(body[-1])
+                if size > self.max_entry_bytes:
+                    body = None
+                elif not message.get('more_body', False) and start['status'] == 200:
+                    self.cache.put(key, start['status'], list(start['headers']), b''.join(body))
+            await send(message)
+
+        await self.app(scope, receive, capture)
@@ -0,0 +1,157 @@
+import argparse
+import hashlib
+import logging
+import re
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from api import config, database, queries, summaries
+
+_EQUALS = re.compile(r'\b(\w+)\s*==?\s*(-?\d+(?:\.\d+)?|\'[^\']*\')')
+_RANGE = re.compile(r'\b(\w+)\s*(?:>=|<=|>|<|!=|<>)')
+_WHERE = re.compile(r'\bWHERE\b(.*?)(?:\bGROUP\s+BY\b|\bORDER\s+BY\b|\bLIMIT\b|;|$)', re.IGNORECASE | re.DOTALL)
+_TABLE = re.compile(r'\bFROM\s+(\w+)', re.IGNORECASE)
+
+
+class HotQuery(NamedTuple):
+    name: str
+    sql: str
+
+
+class Proposal(NamedTuple):
+    query: HotQuery
+    table: str
+    columns: List[str]
+    where: Optional[str]
+    plan: List[str]
+
+    @property
+    def index_name(self) -> str:
+        digest = hashlib.sha1(f'{self.columns}{self.where}'.encode()).hexdigest()[:8]
+        return f'ix_advisor_{self.table}_{digest}'
+
+    @property
+    def ddl(self) -> str:
+        where = f' WHERE {self.where}' if self.where else ''
+        columns = ', '.join(f'"{c}"' for c in self.columns)
+        return f'CREATE INDEX IF NOT EXISTS {self.index_name} ON {self.table} ({columns}){where}'
+
+
+def hot_queries() -> List[HotQuery]:
+    # the queries the api runs against switrs.sqlite: exports and the summary builds
+    hot = [HotQuery(f'export:{q.name}', q.sql) for q in queries.REGISTRY.values() if q.source == 'main']
+    for summary in summaries.REGISTRY.values():
+        query, _ = summaries.source_query(summary, None)
+        hot.append(HotQuery(f'summary:{summary.name}', query.text))
+    return hot
+
+
+def plan(conn: Connection, sql: str) -> List[str]:
+    return [row[-1] for row in conn.execute(text(f'EXPLAIN QUERY PLAN {sql}'))]
+
+
+def propose(conn: Connection, query: HotQuery) -> Optional[Proposal]:
+    # equality-with-constant terms become the partial index predicate, range terms lead the key,
+    # and every other referenced column follows so the index covers the query
+    steps = plan(conn, query.sql)
+    table = _TABLE.search(query.sql).group(1)
+    # a scan of a covering index is as good as this advisor gets
+    if not any(re.match(rf'SCAN {table}\b', step) and 'COVERING INDEX' not in step for step in steps):
+        return None
+
+    columns = [row[1] for row in conn.execute(text(f'PRAGMA table_info({table})'))]
+    where_match = _WHERE.search(query.sql)
+    where = where_match.group(1) if where_match else ''
+    equals = [(c, v) for c, v in _EQUALS.findall(where) if c in columns]
+    ranges = [c for c in _RANGE.findall(where) if c in columns and c not in dict(equals)]
+    referenced = [c for c in columns if re.search(rf'\b{c}\b', query.sql)]
+
+    key = list(dict.fromkeys(ranges))
+    key += [c for c in referenced if c not in key and c not in dict(equals)]
+    # sqlite only treats a partial index as covering when the predicate columns are in it too
+    key += [c for c, _ in equals if c not in key]
+    predicate = ' AND '.join(f'{c} = {v}' for c, v in equals) or None
+    return Proposal(query, table, key, predicate, steps)
+
+
+def _time(conn: Connection, sql: str) -> float:
+    start = time.perf_counter()
+    result = conn.execute(text(sql))
+    while result.fetchmany(10_000):
+        pass
+    return time.perf_counter() - start
+
+
+def advise(apply: bool = False, timings: bool = True) -> List[Dict[str, object]]:
+    if apply and config.DATABASE_READ_ONLY:
+        raise RuntimeError('cannot create indexes with DATABASE_READ_ONLY=1')
+    report = []
+    with database.engine.connect() as conn:
+        for query in hot_queries():
+            proposal = propose(conn, query)
+            entry = {'query': query.name, 'plan': plan(conn, query.sql), 'index': None, 'applied': False}
+            report.append(entry)
+            if proposal is None:
+                continue
+            entry['index'] = proposal.ddl
+            if timings:
+                entry['before_s'] = _time(conn, query.sql)
+            if apply:
+                conn.execute(text(proposal.ddl))
+                conn.commit()
+                entry['applied'] = True
+                entry['plan_after'] = plan(conn, query.sql)
+                if timings:
+                    entry['after_s'] = _time(conn, query.sql)
+        if apply:
+            conn.execute(text('ANALYZE'))
+            conn.commit()
+    return report
+
+
+def advise_and_log():
+    # report only: the api never writes to switrs.sqlite
+    try:
+        for entry in advise(timings=False):
+            if entry['index']:
+                logging.info('index advisor: %s -> %s (not applied)', entry['query'], entry['index'])
+    except Exception:
+        logging.exception('index advisor failed')
+
+
+def print_report(report: List[Dict[str, object]]):
+    for entry in report:
+        print(f"{entry['query']}")
+        print(f"  plan:   {'; '.join(entry['plan'])}")
+        if entry['index'] is None:
+            print('  no index needed')
+            continue
+        print(f"  index:  {entry['index']}{'' if entry['applied'] else '  (not applied)'}")
+        if 'plan_after' in entry:
+            print(f"  after:  {'; '.join(entry['plan_after'])}")
+        if 'before_s' in entry:
+            after = f", after {entry['after_s'] * 1000:.0f} ms" if 'after_s' in entry else ''
+            print(f"  timing: before {entry['before_s'] * 1000:.0f} ms{after}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m api.indexes',
+                                     description='propose (and create) indexes for the hot switrs.sqlite queries')
+    parser.add_argument('--apply', action='store_true',
+                        help='create the proposed indexes in the database file (it must be writable); this changes its '
+                             'version, so run it before building the summaries, sketches and snapshot')
+    parser.add_argument('--no-timings', action='store_true', help='skip running the queries')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not config.check():
+        sys.exit(1)
+    print_report(advise(apply=args.apply, timings=not args.no_timings))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import itertools
+import logging
+import math
+from typing import TYPE_CHECKING, List, Optional
+
+import numpy as np
+from pydantic import TypeAdapter
+
+from api.models.pyd import PartyData
+
+if TYPE_CHECKING:
+    import pandas
+
+FEATURES = ["party_age", "party_sex", "party_race"]
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+# decisions closer to the boundary than this are left to the real pipeline,
+# so float reordering in the folded sum can never flip a label
+BOUNDARY_MARGIN = 1e-6
+
+_batch_adapter = TypeAdapter(List[PartyData])
+
+
+def parse_batch(body: bytes, content_type: str) -> List[PartyData]:
+    if content_type.split(";")[0].strip() in NDJSON_TYPES:
+        return [PartyData.model_validate_json(line) for line in body.splitlines() if line.strip()]
+    return _batch_adapter.validate_json(body)
+
+
+def to_frame(records: List[PartyData]) -> "pandas.DataFrame":
+    # column-wise construction: one list per feature instead of a DataFrame per record
+    # pandas and sklearn are imported on first use, the api starts without them (see api.serving)
+    import pandas as pd
+    return pd.DataFrame({
+        "party_age": [r.age for r in records],
+        "party_sex": [r.sex for r in records],
+        "party_race": [r.race for r in records],
+    }, columns=FEATURES)
+
+
+def predict_many(model, records: List[PartyData]) -> List[int]:
+    if not records:
+        return []
+    return model.predict(to_frame(records)).astype(int).tolist()
+
+
+class FoldedLogit:
+    # the scaler -> one-hot -> logistic regression pipeline folded into
+    # decision = offsets[(sex, race)] + slope * age, so scoring needs no pandas or sklearn
+
+    def __init__(self, model):
+        from sklearn.compose import ColumnTransformer
+        from sklearn.linear_model import LogisticRegression
+        from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+        preprocessor, classifier = model.steps[0][1], model.steps[-1][1]
+        if (len(model.steps) != 2 or not isinstance(preprocessor, ColumnTransformer)
+                or not isinstance(classifier, LogisticRegression) or len(classifier.classes_) != 2):
+            raise ValueError("expected a ColumnTransformer + binary LogisticRegression pipeline")
+
+        coef = classifier.coef_[0]
+        intercept = float(classifier.intercept_[0])
+        slope = None
+        contributions = {}
+        position = 0
+        for name, transformer, columns in preprocessor.transformers_:
+            if name == "remainder":
+                if transformer != "drop":
+                    raise ValueError("remainder columns are not supported")
+                continue
+            if isinstance(transformer, StandardScaler) and list(columns) == ["party_age"]:
+                scale = transformer.scale_[0] if transformer.with_std else 1.0
+                mean = transformer.mean_[0] if transformer.with_mean else 0.0
+                slope = coef[position] / scale
+                intercept -= slope * mean
+                position += 1
+            elif isinstance(transformer, OneHotEncoder) and transformer.handle_unknown == "error" \
+                    and transformer.drop_idx_ is None:
+                for column, categories in zip(columns, transformer.categories_):
+                    contributions[column] = dict(zip(categories, coef[position:position + len(categories)]))
+                    position += len(categories)
+            else:
+                raise ValueError(f"unsupported transformer {name!r}: {transformer!r}")
+        if slope is None or set(contributions) != {"party_sex", "party_race"} or position != len(coef):
+            raise ValueError("pipeline features do not match party_age, party_sex, party_race")
+
+        self.model = model
+        self.slope = float(slope)
+        self.classes = [int(c) for c in classifier.classes_]
+        self.offsets = {
+            (sex, race): float(intercept + w_sex + w_race)
+            for (sex, w_sex), (race, w_race) in itertools.product(contributions["party_sex"].items(),
+                                                                  contributions["party_race"].items())
+        }
+
+    def decide(self, record: PartyData) -> Optional[int]:
+        # None when the decision is too close to the boundary for the folded arithmetic to settle it
+        if not math.isfinite(record.age):
+            raise ValueError("Input contains NaN or infinity")
+        try:
+            decision = self.offsets[(record.sex, record.race)] + self.slope * record.age
+        except KeyError:
+            raise ValueError(f"Found unknown categories in {(record.sex, record.race)}")
+        if abs(decision) < BOUNDARY_MARGIN:
+            return None
+        return self.classes[decision > 0]
+
+    def predict_one(self, record: PartyData) -> int:
+        label = self.decide(record)
+        return predict_many(self.model, [record])[0] if label is None else label
+
+    def predict(self, records: List[PartyData]) -> List[int]:
+        n = len(records)
+        if not n:
+            return []
+        ages = np.fromiter((r.age for r in records), dtype=float, count=n)
+        if not np.isfinite(ages).all():
+            raise ValueError("Input contains NaN or infinity")
+        try:
+            offsets = np.fromiter((self.offsets[(r.sex, r.race)] for r in records), dtype=float, count=n)
+        except KeyError as e:
+            raise ValueError(f"Found unknown categories in {e.args[0]}")
+        decision = offsets + self.slope * ages
+        labels = np.where(decision > 0, self.classes[1], self.classes[0])
+        ambiguous = np.flatnonzero(np.abs(decision) < BOUNDARY_MARGIN)
+        if len(ambiguous):
+            labels[ambiguous] = predict_many(self.model, [records[i] for i in ambiguous])
+        return labels.tolist()
+
+    def verify(self, ages=np.arange(0, 100.25, 0.25)) -> bool:
+        # exhaustive check over the form's feature space against the real pipeline
+        records = [PartyData(age=age, sex=sex, race=race)
+                   for (sex, race), age in itertools.product(self.offsets, ages)]
+        return self.predict(records) == predict_many(self.model, records)
+
+
+def fold(model) -> Optional[FoldedLogit]:
+    try:
+        folded = FoldedLogit(model)
+    except (ValueError, AttributeError, IndexError) as e:
+        logging.warning("fast inference path disabled: %s", e)
+        return None
+    if not folded.verify():
+        logging.warning("fast inference path disabled: folded model disagrees with model.predict")
+        return None
+    return folded
@@ -1,17 +1,20 @@
 import csv
+import functools
 import logging
-import os
+import threading
+from contextlib import asynccontextmanager
 from io import StringIO
+from typing import List, Optional
 
-import pandas as pd
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
 from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy import text
-from sqlalchemy.orm import Session
-from starlette.responses import FileResponse
-import joblib
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
-from api import config, database, models
+from api import (aggregate, batching, charts, compression, config, database, export, http_cache, indexes, inference,
+                 metadata, metrics, models, pagination, partitions, profiler, queries, serving, sketches, summaries)
 from api.models.pyd import PartyData
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -20,13 +23,60 @@ if not config.check():
     logging.error('bad initialization')
     exit(1)
 
-app = FastAPI()
-model = joblib.load('model.pkl')
-tables_len_cash = {}
+predictor = serving.predictor
+
+
+def scored(path: str, predict, records):
+    with metrics.INFERENCE_SECONDS.time(path=path):
+        predictions = predict(records)
+    metrics.INFERENCE_ITEMS.observe(len(records), path=path)
+    return predictions
+
+
+predict_batcher = batching.MicroBatcher(functools.partial(scored, 'batched', predictor.predict_many),
+                                        max_wait_ms=config.PREDICT_BATCH_WINDOW_MS,
+                                        max_size=config.PREDICT_BATCH_MAX_SIZE)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # a no-op in workers forked by api.serving, whose parent loaded the model already
+    await run_in_threadpool(predictor.load)
+    await run_in_threadpool(metadata.catalog.load)
+    if config.INDEX_ADVISOR == 'apply':
+        # N pre-forked workers would race to write the same indexes, and stale every derived artifact at once
+        logging.warning('INDEX_ADVISOR=apply is not supported by the api, only reporting; run '
+                        '`python -m api.indexes --apply` before building the summaries, sketches and snapshot')
+    if config.INDEX_ADVISOR in ('report', 'apply'):
+        threading.Thread(target=indexes.advise_and_log, name='index-advisor', daemon=True).start()
+    serving.report_ready()
+    yield
+    await predict_batcher.stop()
+    partitions.shutdown()
+    # what this worker counted since its last flush, for the workers still running
+    metrics.flush()
+
+
+app = FastAPI(lifespan=lifespan)
+# the response cache sits outside compression, so it keeps the compressed bodies per Accept-Encoding
+app.add_middleware(compression.CompressionMiddleware)
+app.add_middleware(http_cache.CacheMiddleware)
+# outermost, so cache hits and 304s are timed too
+app.add_middleware(metrics.TimingMiddleware)
+
+metrics.Gauge('http_cache_bytes', 'Bytes held by the in-memory response cache', lambda: http_cache.responses.size)
+metrics.Gauge('predict_queue_depth', '/predict requests waiting for a micro-batch',
+              lambda: predict_batcher.stats()['queue_depth'])
+# per worker, so under api.serving these are labelled with the worker's pid (see api.metrics): most of the rss is
+# shared with the parent and the other workers, private is not
+metrics.Gauge('process_resident_memory_bytes', 'Resident memory of this worker', lambda: serving.memory()['rss'])
+metrics.Gauge('process_private_memory_bytes', 'Memory only this worker maps', lambda: serving.memory()['private'])
+metrics.Gauge('worker_startup_seconds', 'Time from process (or fork) start until the worker was ready',
+              lambda: serving.startup_seconds)
 
 
 @app.get(path='/data_info', response_model=list[models.pyd.TableInfo])
-def datainfo():
+async def datainfo():
     info: list[models.TableInfo] = [
         models.pyd.TableInfo(
             table_name="case_ids",
@@ -45,109 +95,187 @@ def datainfo():
             description="Stores data about victims, including their role, gender, age, and other relevant details.",
         ),
     ]
+    tables = await metadata.catalog.tables_async()
+    for item in info:
+        table = tables[item.table_name]
+        item.row_count = table.row_count
+        item.row_count_exact = table.row_count_exact
+        item.columns = [models.pyd.ColumnInfo(name=c.name, type=c.type) for c in table.columns]
+        item.indexes = table.indexes
     return info
 
 
 @app.get("/head")
-def head(table_name: str, page: int = 0, page_size: int = 10, db: Session = Depends(database.get_db)):
-    query = text(f"SELECT * FROM {table_name} LIMIT :page_size OFFSET :offset")
-    results = db.execute(query, {"page_size": page_size, "offset": page * page_size}).fetchall()
-
-    column_names = [col[1] for col in db.execute(text(f'PRAGMA table_info({table_name})'))]
+async def head(table_name: str, page: int = 0, page_size: int = Query(10, ge=1), cursor: Optional[str] = None,
+               db: AsyncSession = Depends(database.get_async_db)):
+    if table_name not in database.TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table {table_name}")
+    table = (await metadata.catalog.tables_async())[table_name]
+
+    # rowid is selected first so the last row of the page can be turned into a cursor;
+    # seeking on it lets deep pages skip the rows OFFSET would have to walk through
+    if cursor is not None:
+        try:
+            after = pagination.decode_cursor(cursor, table_name)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"invalid cursor: {e}")
+        query = text(f"SELECT rowid, * FROM {table_name} WHERE rowid > :after ORDER BY rowid LIMIT :page_size")
+        params = {"after": after, "page_size": page_size}
+    else:
+        query = text(f"SELECT rowid, * FROM {table_name} ORDER BY rowid LIMIT :page_size OFFSET :offset")
+        params = {"page_size": page_size, "offset": page * page_size}
+    results = (await db.execute(query, params)).fetchall()
+    metrics.QUERY_ROWS.observe(len(results), query='head')
 
     output = StringIO()
     writer = csv.writer(output)
-    writer.writerow(column_names)
-    writer.writerows(results)
+    writer.writerow(table.column_names)
+    writer.writerows(row[1:] for row in results)
     output.seek(0)
 
+    headers = {
+        "Content-Disposition": f"attachment; filename={table_name}_head.csv",
+        pagination.TOTAL_COUNT_HEADER: str(table.row_count),
+        pagination.TOTAL_PAGES_HEADER: str(-(-table.row_count // page_size)),
+    }
+    if results and results[-1][0] < table.max_rowid:
+        headers[pagination.NEXT_CURSOR_HEADER] = pagination.encode_cursor(table_name, results[-1][0])
+
     return StreamingResponse(
         output,
         media_type="text/csv",
-        headers={"Content-Disposition": f"attachment; filename={table_name}_head.csv"}
+        headers=headers
     )
 
 
-@app.get('/data.csv')
-def vehicle_distribution_data(db: Session = Depends(database.get_db)):
-    data_folder = "./data"
-    os.makedirs(data_folder, exist_ok=True)
-
-    csv_file_path = os.path.join(data_folder, "parties.csv")
-    files = [f for f in os.listdir(data_folder) if os.path.isfile(os.path.join(data_folder, f))]
-
-    if "parties.csv" in files:
-        return FileResponse(
-            path=csv_file_path,
-            media_type="text/csv",
-            filename="vehicle_data.csv"
-        )
-    else:
-        query = text(
-            "SELECT case_id, vehicle_year, party_sex, party_age, cellphone_in_use, party_race FROM parties "
-            "WHERE at_fault = 1"
-        )
-        result = db.execute(query)
+def aggregate_rows(table_name: str, group_by: List[str], where: List[str], agg: List[str], limit: int):
+    # the session only connects when nothing precomputed answers
+    with database.SessionLocal() as db:
+        return aggregate.aggregate(db, table_name, group_by, where, agg, limit)
+
+
+@app.get('/aggregate')
+async def aggregate_table(response: Response, table_name: str, group_by: List[str] = Query([]),
+                          where: List[str] = Query([]), agg: List[str] = Query(['count']),
+                          limit: int = Query(10_000, ge=1)):
+    await metadata.catalog.tables_async()
+    # all of it on the threadpool, off the event loop: the summary lookups, the numpy work over the snapshot, the
+    # wait for the scan processes, and a scan's row handling and quantiles, which run_sync would keep on the loop
+    rows, source = await run_in_threadpool(aggregate_rows, table_name, group_by, where, agg, limit)
+    metrics.QUERY_ROWS.observe(len(rows), query='aggregate')
+    response.headers['X-Aggregate-Source'] = source
+    return rows
 
-        output = StringIO()
-        writer = csv.writer(output)
 
-        writer.writerow(result.keys())
+@app.get('/data.csv')
+async def vehicle_distribution_data(request: Request):
+    return await export.respond(queries.PARTIES, export.FORMATS['csv'], request.headers.get('if-none-match'),
+                                request.headers.get('accept-encoding'))
+
 
-        writer.writerows(result.fetchall())
+@app.get('/data')
+async def vehicle_distribution(request: Request, format: Optional[str] = None):
+    return await export.respond(queries.PARTIES, export.negotiate(format, request.headers.get('accept')),
+                                request.headers.get('if-none-match'), request.headers.get('accept-encoding'))
 
-        with open(csv_file_path, "w", newline='', encoding="utf-8") as file:
-            file.write(output.getvalue())
 
-        return FileResponse(
-            path=csv_file_path,
-            media_type="text/csv",
-            filename="vehicle_data.csv"
-        )
+def traumas_query():
+    if summaries.current('traumas_by_age_group'):
+        return queries.TRAUMAS_SUMMARY
+    return queries.TRAUMAS
 
 
 @app.get("/traumas.csv")
-def get_traumas(db: Session = Depends(database.get_db)):
-    data_folder = "./data"
-    os.makedirs(data_folder, exist_ok=True)
-    file_path = os.path.join(data_folder, "traumas.csv")
-    files = [f for f in os.listdir(data_folder) if os.path.isfile(os.path.join(data_folder, f))]
-    if "traumas.csv" in files:
-        return FileResponse(
-            path=file_path,
-            media_type="text/csv",
-            filename="vehicle_data.csv"
-        )
-    else:
-        sql_request = '''
-            SELECT CASE
-                       WHEN party_age >= 18 AND party_age <= 30 THEN 'youngs'
-                       WHEN party_age > 30 THEN 'adults'
-                       ELSE 'unknown'
-                       END                   AS age_group,
-                   COUNT(*)                  AS total_people,
-                   SUM(party_number_killed)  AS total_killed,
-                   SUM(party_number_injured) AS total_injured
-            FROM parties
-            WHERE party_age >= 18 and at_fault == 1
-            GROUP BY age_group;
-            '''
-        result = db.execute(text(sql_request))
-        output = StringIO()
-        writer = csv.writer(output)
-
-        writer.writerow(result.keys())
-
-        writer.writerows(result.fetchall())
-
-        with open(file_path, "w", newline='', encoding="utf-8") as file:
-            file.write(output.getvalue())
-
-        return FileResponse(
-            path=file_path,
-            media_type="text/csv",
-            filename="vehicle_data.csv"
-        )
+async def get_traumas(request: Request):
+    query = await export.run(traumas_query)
+    return await export.respond(query, export.FORMATS['csv'], request.headers.get('if-none-match'),
+                                request.headers.get('accept-encoding'))
+
+
+@app.get("/traumas")
+async def traumas(request: Request, format: Optional[str] = None):
+    query = await export.run(traumas_query)
+    return await export.respond(query, export.negotiate(format, request.headers.get('accept')),
+                                request.headers.get('if-none-match'), request.headers.get('accept-encoding'))
+
+
+@app.get("/summaries")
+def summaries_status():
+    return summaries.status()
+
+
+@app.get("/summaries/{name}")
+def summary_rows(name: str):
+    if name not in summaries.REGISTRY:
+        raise HTTPException(status_code=404, detail=f"unknown summary {name}")
+    if not summaries.current(name):
+        raise HTTPException(status_code=409, detail=f"summary {name} is not built for the current database, "
+                                                    f"run `python -m api.summaries refresh`")
+    return summaries.rows(name)
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.get("/debug/profile")
+async def profile(seconds: float = Query(10, gt=0), idle: bool = False):
+    # folded stacks of every thread while the profile runs; sampled off the event loop so it gets sampled too
+    if not config.PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        stacks = await run_in_threadpool(profiler.sample, min(seconds, config.PROFILE_MAX_SECONDS),
+                                         config.PROFILE_INTERVAL_MS / 1000, idle)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(stacks, media_type='text/plain; charset=utf-8')
+
+
+@app.get("/charts")
+def chart_names():
+    return list(charts.CHARTS)
+
+
+@app.get("/charts/{name}")
+def chart(name: str):
+    return Response(charts.spec(name), media_type='application/json')
+
+
+def check_quantiles(q: List[float]):
+    if any(not 0 <= p <= 1 for p in q):
+        raise HTTPException(status_code=400, detail="quantiles must be between 0 and 1")
+
+
+@app.get("/stats/{table_name}")
+async def table_stats(table_name: str, q: List[float] = Query([0.5])):
+    # answered from the catalog and the column sketches, never from the table itself
+    if table_name not in database.TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table {table_name}")
+    check_quantiles(q)
+    table = (await metadata.catalog.tables_async())[table_name]
+    sketched = sketches.store.table(table_name)
+    return {
+        'table_name': table_name,
+        'rows': {'count': table.row_count, 'exact': table.row_count_exact} if sketched is None else
+        {'count': sketched['rows'], 'exact': True},
+        'columns': None if sketched is None else
+        {column: sketches.column_stats(stats, q) for column, stats in sketched['columns'].items()},
+    }
+
+
+@app.get("/stats/{table_name}/{column}")
+async def column_stats(table_name: str, column: str, q: List[float] = Query([0.5])):
+    if table_name not in database.TABLES:
+        raise HTTPException(status_code=404, detail=f"unknown table {table_name}")
+    check_quantiles(q)
+    sketched = sketches.store.table(table_name)
+    if sketched is None:
+        raise HTTPException(status_code=409, detail="no sketches for the current database, "
+                                                    "run `python -m api.sketches`")
+    if column not in sketched['columns']:
+        raise HTTPException(status_code=404, detail=f"unknown column {column}")
+    return sketches.column_stats(sketched['columns'][column], q)
 
 
 @app.get('/theory')
@@ -168,12 +296,40 @@ This table has a lot of numeric fields. The most essential fields are `vehicle_y
 
 @app.post("/predict")
 async def predict(data: PartyData):
-    input_data = pd.DataFrame([[data.age, data.sex, data.race]],
-                              columns=["party_age", "party_sex", "party_race"])
-    input_data_encoded = input_data.copy()
     try:
-        prediction = model.predict(input_data_encoded)
-    except:
+        prediction = None
+        if predictor.fast is not None:
+            with metrics.INFERENCE_SECONDS.time(path='fast'):
+                prediction = predictor.fast.decide(data)
+        if prediction is None:
+            # the pipeline, batched with concurrent requests: every request when the model couldn't be folded (or
+            # PREDICT_FAST_PATH=0), otherwise the ones too close to the decision boundary for the folded model
+            prediction = await predict_batcher.submit(data)
+    except Exception:
         return {"message": "well... i can't accept this data. sry"}, 400
 
-    return {"at_fault": int(prediction[0])}
+    return {"at_fault": prediction}
+
+
+@app.get("/predict/stats")
+def predict_stats():
+    return predict_batcher.stats()
+
+
+@app.post("/predict/batch")
+async def predict_batch(request: Request):
+    # body is a JSON array of PartyData, or one PartyData per line with an NDJSON content type
+    try:
+        records = inference.parse_batch(await request.body(), request.headers.get("content-type", ""))
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_input=False))
+
+    try:
+        if predictor.fast is not None:
+            predictions = await run_in_threadpool(scored, 'fast_batch', predictor.fast.predict, records)
+        else:
+            predictions = await run_in_threadpool(scored, 'batch', predictor.predict_many, records)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"well... i can't accept this data. sry ({e})")
+
+    return {"at_fault": predictions}
@@ -0,0 +1,87 @@
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+from starlette.concurrency import run_in_threadpool
+
+from api import config, database, sketches
+from api.cache import artifacts
+
+
+class Column(NamedTuple):
+    name: str
+    type: str
+
+    @property
+    def numeric(self) -> bool:
+        # by the declared type, as sqlite would convert the values stored in it
+        return sketches.numeric(self.type)
+
+
+class Table(NamedTuple):
+    name: str
+    columns: List[Column]
+    row_count: int
+    row_count_exact: bool
+    # rows are numbered up to max_rowid, which tells a cursor whether anything follows it
+    max_rowid: int
+    indexes: List[str]
+
+    @property
+    def column_names(self) -> List[str]:
+        return [column.name for column in self.columns]
+
+
+class Catalog:
+    # the schema and sizes of database.TABLES, read once per version of the database file
+    # instead of running catalog queries on every request
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables: Dict[str, Table] = {}
+        self._version: Optional[str] = None
+
+    def stale(self) -> bool:
+        return self._version != artifacts.db_version()
+
+    def load(self):
+        with self._lock:
+            version = artifacts.db_version()
+            if version == self._version:
+                return
+            tables = {}
+            with database.SessionLocal() as db:
+                for name in database.TABLES:
+                    columns = [Column(row[1], row[2]) for row in db.execute(text(f'PRAGMA table_info({name})'))]
+                    max_rowid = db.execute(text(f'SELECT MAX(rowid) FROM {name}')).scalar() or 0
+                    count, exact = self._count(db, name, max_rowid)
+                    indexes = [row[1] for row in db.execute(text(f'PRAGMA index_list({name})'))]
+                    tables[name] = Table(name, columns, count, exact, max_rowid, indexes)
+            self._tables, self._version = tables, version
+            logging.info('catalog loaded for database version %s', version)
+
+    @staticmethod
+    def _count(db, name: str, max_rowid: int) -> Tuple[int, bool]:
+        # COUNT(*) is a full scan; a sketch pass over this version of the file already counted every row,
+        # and otherwise MAX(rowid) is a single b-tree seek that is exact unless rows were deleted
+        if config.CATALOG_EXACT_COUNTS:
+            return db.execute(text(f'SELECT COUNT(*) FROM {name}')).scalar(), True
+        sketched = sketches.store.table(name)
+        if sketched is not None:
+            return sketched['rows'], True
+        return max_rowid, False
+
+    def tables(self) -> Dict[str, Table]:
+        if self.stale():
+            self.load()
+        return self._tables
+
+    async def tables_async(self) -> Dict[str, Table]:
+        # a reload queries every table, so keep it off the event loop
+        if self.stale():
+            await run_in_threadpool(self.load)
+        return self._tables
+
+
+catalog = Catalog()
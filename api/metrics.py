@@ -0,0 +1,350 @@
+import bisect
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from api import config
+
+logger = logging.getLogger(__name__)
+
+# seconds; from a cached /head (sub-millisecond) to a cold full-table export
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ROW_BUCKETS = (1, 10, 100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+def _labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    pairs = (f'{n}="{v}"' for n, v in zip(names, escaped))
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> Dict[Tuple[str, ...], float]:
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def combine(a: float, b: float) -> float:
+        return a + b
+
+    def render(self, values: Optional[Dict[Tuple[str, ...], float]] = None) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for key, value in sorted((self.collect() if values is None else values).items()):
+            lines.append(f'{self.name}{_labels(self.labelnames, key)} {value}')
+        return lines
+
+
+class Histogram:
+    # cumulative buckets, like prometheus_client's, without the dependency
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        # per label values: a count per bucket (the last one is +Inf), then the sum
+        self._values: Dict[Tuple[str, ...], list] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[n]) for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def collect(self) -> Dict[Tuple[str, ...], list]:
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    @staticmethod
+    def combine(a: list, b: list) -> list:
+        return [x + y for x, y in zip(a, b)]
+
+    def render(self, values: Optional[Dict[Tuple[str, ...], list]] = None) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labelnames + ('le',)
+        for key, counts in sorted((self.collect() if values is None else values).items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(float(bound))
+                lines.append(f'{self.name}_bucket{_labels(names, key + (le,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, key)} {counts[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, key)} {cumulative}')
+        return lines
+
+
+class Gauge:
+    # read when scraped, from whatever already keeps the number
+    def __init__(self, name: str, documentation: str, fn: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.fn = fn
+        REGISTRY.append(self)
+
+    def value(self) -> Optional[float]:
+        try:
+            return self.fn()
+        except Exception:
+            logger.exception('gauge %s failed', self.name)
+            return None
+
+    def render(self, workers: Optional[Dict[int, Optional[float]]] = None) -> List[str]:
+        # one unlabelled value, or with shared metrics one per live worker, labelled with its pid
+        if workers is None:
+            values = {(): self.value()}
+        else:
+            values = {(str(pid),): value for pid, value in sorted(workers.items())}
+        values = {key: value for key, value in values.items() if value is not None}
+        if not values:
+            return []
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge',
+                *(f'{self.name}{_labels(("worker",) if key else (), key)} {value}' for key, value in values.items())]
+
+
+REGISTRY: list = []
+
+# with api.serving's pre-forked workers a scrape reaches whichever worker accepts it: each worker then writes its
+# counters, histograms and gauges to its own file in this directory every METRICS_FLUSH_SECONDS, and /metrics adds
+# up the counters and histograms of every file (those of exited workers included, so totals never go backwards)
+_directory: Optional[str] = None
+# this worker's file in it
+_file: Optional[str] = None
+
+
+def _state(gauges: bool = True) -> dict:
+    return {
+        'pid': os.getpid(),
+        'values': {metric.name: [[list(key), value] for key, value in metric.collect().items()]
+                   for metric in REGISTRY if not isinstance(metric, Gauge)},
+        'gauges': {metric.name: metric.value() for metric in REGISTRY if isinstance(metric, Gauge)} if gauges else {},
+    }
+
+
+def save(path: str, gauges: bool = True):
+    # replaced atomically, readers never see half a file
+    temp = f'{path}.{threading.get_ident()}.part'
+    with open(temp, 'w') as file:
+        json.dump(_state(gauges), file)
+    os.replace(temp, path)
+
+
+def flush():
+    if _file is not None:
+        save(_file)
+
+
+def share(directory: str):
+    # in a worker just forked by api.serving; what the parent counted before the fork is in its own file
+    global _directory, _file
+    for metric in REGISTRY:
+        if not isinstance(metric, Gauge):
+            metric.reset()
+    _directory = directory
+    _file = os.path.join(directory, f'worker-{os.getpid()}-{time.time_ns()}.json')
+    flush()
+
+    def flush_forever():
+        while True:
+            time.sleep(config.METRICS_FLUSH_SECONDS)
+            try:
+                flush()
+            except OSError as e:
+                logger.warning('could not write metrics to %s: %s', _file, e)
+
+    threading.Thread(target=flush_forever, name='metrics-flush', daemon=True).start()
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _others() -> List[dict]:
+    states = []
+    for name in os.listdir(_directory):
+        path = os.path.join(_directory, name)
+        if not name.endswith('.json') or path == _file:
+            continue
+        try:
+            with open(path) as file:
+                states.append(json.load(file))
+        except (OSError, ValueError):
+            # written by a worker that's just starting, or removed on shutdown
+            continue
+    return states
+
+
+def _shared() -> List[str]:
+    # this worker's own numbers as they are now, the others' as of their last flush
+    others = _others()
+    live = [state for state in others if state['gauges'] and _alive(state['pid'])]
+    lines = []
+    for metric in REGISTRY:
+        if isinstance(metric, Gauge):
+            workers = {os.getpid(): metric.value(), **{state['pid']: state['gauges'].get(metric.name) for state in live}}
+            lines.extend(metric.render(workers))
+            continue
+        values = metric.collect()
+        for state in others:
+            for key, value in state['values'].get(metric.name, ()):
+                key = tuple(key)
+                values[key] = value if key not in values else metric.combine(values[key], value)
+        lines.extend(metric.render(values))
+    return lines
+
+
+def render() -> str:
+    # the prometheus text exposition format, version 0.0.4
+    lines = [line for metric in REGISTRY for line in metric.render()] if _directory is None else _shared()
+    return '\n'.join(lines) + '\n'
+
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', 'Time from request to the last body byte',
+                            ('method', 'route', 'status'))
+QUERY_SECONDS = Histogram('db_query_duration_seconds', 'SQLAlchemy cursor execute time', ('operation', 'table'))
+SLOW_QUERIES = Counter('db_slow_queries_total', 'Queries slower than SLOW_QUERY_MS', ('operation', 'table'))
+QUERY_ROWS = Histogram('db_query_rows', 'Rows a query produced for the caller', ('query',), ROW_BUCKETS)
+EXPORT_SECONDS = Histogram('export_stage_duration_seconds',
+                           'Time per export chunk spent fetching and encoding it, and writing it to the cache file',
+                           ('stage',))
+INFERENCE_SECONDS = Histogram('inference_duration_seconds', 'Model scoring time', ('path',))
+INFERENCE_ITEMS = Histogram('inference_batch_size', 'Records scored per model call', ('path',),
+                            (1, 2, 4, 8, 16, 32, 64, 128, 1_024, 10_000))
+
+
+class TimingMiddleware:
+    # request latency by route template (not raw path, which would be one series per table and cursor)
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    @staticmethod
+    def _route(scope: Scope) -> str:
+        app = scope.get('app')
+        for route in getattr(app, 'routes', ()):
+            if route.matches(scope)[0] == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+
+        async def wrapped(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, wrapped)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, method=scope['method'], route=self._route(scope),
+                                    status=status)
+
+
+# the first table a statement reads or writes; FROM ( moves on to the subquery's own FROM
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+"?(\w+)|\b(?:table_info|index_list)\s*\(\s*"?(\w+)', re.IGNORECASE)
+
+
+def _describe(statement: str) -> Tuple[str, str]:
+    words = statement.lstrip().split(None, 1)
+    match = _TABLE.search(statement)
+    return (words[0].upper() if words else ''), (match.group(match.lastindex) if match else '')
+
+
+def _explain(conn, statement: str, parameters) -> Optional[List[tuple]]:
+    # on the connection that just ran the query, so it sees the same schema and indexes; a raw dbapi cursor
+    # doesn't go through these hooks again
+    if not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    try:
+        cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+            return [tuple(row) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+    except Exception as e:
+        logger.debug('could not explain slow query: %s', e)
+        return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    operation, table = _describe(statement)
+    QUERY_SECONDS.observe(elapsed, operation=operation, table=table)
+    if elapsed * 1000 >= config.SLOW_QUERY_MS:
+        SLOW_QUERIES.inc(operation=operation, table=table)
+        plan = _explain(conn, statement, parameters)
+        logger.warning('slow query (%.0f ms): %s %r%s', elapsed * 1000, ' '.join(statement.split()), parameters,
+                       ''.join(f'\n  plan: {row[-1]}' for row in plan or ()))
+
+
+def instrument(engine):
+    # execute time only: sqlite runs a SELECT lazily, so rows stepped later (yield_per exports) aren't counted
+    # here, QUERY_ROWS and EXPORT_SECONDS cover those
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
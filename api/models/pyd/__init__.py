@@ -1,13 +1,23 @@
-from typing import TypeVar, Generic, List
+from typing import TypeVar, Generic, List, Optional
 
 from pydantic import BaseModel
 
 T = TypeVar('T')
 
 
+class ColumnInfo(BaseModel):
+    name: str
+    type: str
+
+
 class TableInfo(BaseModel):
     table_name: str
     description: str
+    row_count: Optional[int] = None
+    # false when row_count is the MAX(rowid) estimate, an upper bound
+    row_count_exact: Optional[bool] = None
+    columns: List[ColumnInfo] = []
+    indexes: List[str] = []
 
 
 class Page(BaseModel, Generic[T]):
@@ -0,0 +1,23 @@
+import base64
+import binascii
+
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+TOTAL_COUNT_HEADER = 'X-Total-Count'
+TOTAL_PAGES_HEADER = 'X-Total-Pages'
+
+
+def encode_cursor(table_name: str, rowid: int) -> str:
+    raw = f'{table_name}:{rowid}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, table_name: str) -> int:
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        name, _, rowid = base64.urlsafe_b64decode(padded).decode().rpartition(':')
+        value = int(rowid)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError('malformed cursor')
+    if name != table_name:
+        raise ValueError(f'cursor belongs to table {name!r}, not {table_name!r}')
+    return value
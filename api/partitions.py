@@ -0,0 +1,156 @@
+import collections
+import csv
+import itertools
+import multiprocessing
+import sqlite3
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from io import StringIO
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from api import config
+
+# runs in the scan processes too, so nothing heavier than api.config is imported here: callers bring the table
+# sizes (api.metadata) and record the metrics
+
+# sqlite orders values of different storage classes as null < integer/real < text < blob, where python would raise
+_CLASSES = {int: 1, float: 1, str: 2, bytes: 3}
+
+
+def _rank(value) -> tuple:
+    # str and bytes compare like sqlite's BINARY collation: utf-8 byte order is code point order
+    return (0, 0) if value is None else (_CLASSES[type(value)], value)
+
+
+# how partial results of a grouped query combine
+MERGES: Dict[str, Callable] = {
+    'sum': lambda a, b: a + b,
+    'min': lambda a, b: min(a, b, key=_rank),
+    'max': lambda a, b: max(a, b, key=_rank),
+}
+
+_connection: Optional[sqlite3.Connection] = None
+_pool: Optional[ProcessPoolExecutor] = None
+_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    # in a scan process: its own read-only connection, opened on the first partition and kept
+    global _connection
+    if _connection is None:
+        flags = 'mode=ro&immutable=1' if config.DATABASE_READ_ONLY else 'mode=ro'
+        _connection = sqlite3.connect(f'file:{config.DATABASE_URL}?{flags}', uri=True)
+        _connection.execute(f'PRAGMA mmap_size = {config.DATABASE_MMAP_SIZE}')
+        _connection.execute(f'PRAGMA cache_size = -{config.DATABASE_CACHE_SIZE_KB}')
+        _connection.execute('PRAGMA query_only = 1')
+    return _connection
+
+
+def _fetch(sql: str, params: dict) -> List[tuple]:
+    return _connect().execute(sql, params).fetchall()
+
+
+def _csv(sql: str, params: dict) -> Tuple[bytes, int]:
+    # the partition encoded where it was read, so only bytes cross back to the api
+    buffer = StringIO()
+    cursor = _connect().execute(sql, params)
+    writer = csv.writer(buffer)
+    count = 0
+    while True:
+        rows = cursor.fetchmany(config.EXPORT_CHUNK_ROWS)
+        if not rows:
+            break
+        writer.writerows(rows)
+        count += len(rows)
+    return buffer.getvalue().encode('utf-8'), count
+
+
+def enabled(row_count: int) -> bool:
+    return config.SCAN_PROCESSES > 1 and row_count >= config.SCAN_MIN_ROWS
+
+
+def pool() -> ProcessPoolExecutor:
+    # created on first use; spawned rather than forked, since the api process has threads (an event loop,
+    # aiosqlite, the threadpool) whose locks a fork would copy in whatever state they are in
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(config.SCAN_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def shutdown():
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(cancel_futures=True)
+            _pool = None
+
+
+def ranges(max_rowid: int) -> List[Tuple[int, int]]:
+    # [low, high) rowid ranges: a few per process so a slow one doesn't hold up the rest, but none so small that
+    # the per-partition overhead shows
+    size = max(config.SCAN_PARTITION_ROWS, -(-(max_rowid + 1) // (config.SCAN_PROCESSES * 4)))
+    return [(low, min(low + size, max_rowid + 1)) for low in range(0, max_rowid + 1, size)]
+
+
+def _partitioned(table: str, select: str, where: str, tail: str = '') -> str:
+    bounds = 'rowid >= :low AND rowid < :high'
+    return f'SELECT {select} FROM {table} WHERE {f"({where}) AND " if where else ""}{bounds}{tail}'
+
+
+def _ordered(fn: Callable, sql: str, params: dict, partitions: List[Tuple[int, int]]) -> Iterator:
+    # results in partition order, with a bounded number in flight so a slow early partition can't make the
+    # later ones pile up in memory
+    window = config.SCAN_PROCESSES * 2
+    todo = iter(partitions)
+    pending: collections.deque = collections.deque()
+
+    def submit(low: int, high: int) -> Future:
+        return pool().submit(fn, sql, {**params, 'low': low, 'high': high})
+
+    try:
+        pending.extend(submit(*bounds) for bounds in itertools.islice(todo, window))
+        while pending:
+            result = pending.popleft().result()
+            pending.extend(submit(*bounds) for bounds in itertools.islice(todo, 1))
+            yield result
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def rows_csv(table: str, max_rowid: int, columns: Sequence[str], where: str = '',
+             params: Optional[dict] = None) -> Iterator[Tuple[bytes, int]]:
+    # the csv body of SELECT columns FROM table WHERE where, in rowid order, as (bytes, row count) per partition
+    sql = _partitioned(table, ', '.join(columns), where, ' ORDER BY rowid')
+    return _ordered(_csv, sql, params or {}, ranges(max_rowid))
+
+
+def _key(row: tuple) -> tuple:
+    # sqlite's ORDER BY
+    return tuple(_rank(value) for value in row)
+
+
+def grouped(table: str, max_rowid: int, keys: Sequence[str], measures: Sequence[Tuple[str, str]], where: str = '',
+            params: Optional[dict] = None) -> List[tuple]:
+    # SELECT keys, measures FROM table WHERE where GROUP BY keys ORDER BY keys, from per-partition partial results;
+    # measures are (expression, merge) pairs and must be decomposable, like COUNT/SUM with "sum" or MIN with "min"
+    group = f' GROUP BY {", ".join(str(i + 1) for i in range(len(keys)))}' if keys else ''
+    # something to select when only the groups themselves are asked for
+    select = [*keys, *(expression for expression, _ in measures)] or ['COUNT(*)']
+    sql = _partitioned(table, ', '.join(select), where, group)
+    merges = [MERGES[merge] for _, merge in measures]
+    merged: Dict[tuple, list] = {}
+    for rows in _ordered(_fetch, sql, params or {}, ranges(max_rowid)):
+        for row in rows:
+            key, values = row[:len(keys)], row[len(keys):len(keys) + len(measures)]
+            current = merged.get(key)
+            if current is None:
+                merged[key] = list(values)
+                continue
+            for i, (merge, value) in enumerate(zip(merges, values)):
+                # like sql aggregates, nulls are skipped and only an all-null group stays null
+                if value is not None:
+                    current[i] = value if current[i] is None else merge(current[i], value)
+    return [(*key, *values) for key, values in sorted(merged.items(), key=lambda item: _key(item[0]))]
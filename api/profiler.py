@@ -0,0 +1,42 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+# leaf frames of threads that are only waiting: idle pool workers and the event loop's select
+_IDLE = ('threading.py', 'selectors.py', 'queue.py', 'thread.py')
+
+_lock = threading.Lock()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def sample(seconds: float, interval: float, include_idle: bool = False) -> str:
+    # samples every other thread's stack and returns them as folded stacks ("thread;outer;...;inner count"),
+    # the input of flamegraph.pl and speedscope; one capture at a time
+    if not _lock.acquire(blocking=False):
+        raise RuntimeError('a profile is already being captured')
+    try:
+        me = threading.get_ident()
+        counts = collections.Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if not include_idle and os.path.basename(frame.f_code.co_filename) in _IDLE:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                counts[';'.join([names.get(ident, str(ident))] + stack[::-1])] += 1
+            time.sleep(interval)
+        return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+    finally:
+        _lock.release()
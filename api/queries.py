@@ -0,0 +1,67 @@
+from typing import Dict, NamedTuple, Optional, Sequence
+
+
+class Query(NamedTuple):
+    name: str
+    sql: str
+    filename: str
+    # arrow type per column for the columnar export formats, "dictionary:<type>" for dictionary-encoded ones
+    columns: Dict[str, str]
+    # "main" for switrs.sqlite, "summary" for the materialized summary tables (api.summaries)
+    source: str = "main"
+    # the same rows as sql, as the columns of `table` matching /aggregate-style filters, so the columnar formats
+    # can be cut from the snapshot (api.snapshot) instead
+    table: Optional[str] = None
+    where: Sequence[str] = ()
+    # the api.summaries summary holding the same rows, whose additive measures let the scan run partitioned
+    summary: Optional[str] = None
+
+
+PARTIES = Query(
+    name="parties",
+    sql="SELECT case_id, vehicle_year, party_sex, party_age, cellphone_in_use, party_race FROM parties "
+        "WHERE at_fault = 1",
+    filename="vehicle_data",
+    columns={
+        "case_id": "string",
+        "vehicle_year": "int16",
+        "party_sex": "dictionary:string",
+        "party_age": "int16",
+        "cellphone_in_use": "int8",
+        "party_race": "dictionary:string",
+    },
+    table="parties",
+    where=("at_fault:eq:1",),
+)
+
+TRAUMAS = Query(
+    name="traumas",
+    sql='''
+        SELECT CASE
+                   WHEN party_age >= 18 AND party_age <= 30 THEN 'youngs'
+                   WHEN party_age > 30 THEN 'adults'
+                   ELSE 'unknown'
+                   END                   AS age_group,
+               COUNT(*)                  AS total_people,
+               SUM(party_number_killed)  AS total_killed,
+               SUM(party_number_injured) AS total_injured
+        FROM parties
+        WHERE party_age >= 18 and at_fault == 1
+        GROUP BY age_group;
+        ''',
+    filename="vehicle_data",
+    columns={
+        "age_group": "string",
+        "total_people": "int64",
+        "total_killed": "int64",
+        "total_injured": "int64",
+    },
+    summary="traumas_by_age_group",
+)
+
+TRAUMAS_SUMMARY = TRAUMAS._replace(
+    sql="SELECT age_group, total_people, total_killed, total_injured FROM traumas_by_age_group ORDER BY age_group",
+    source="summary",
+)
+
+REGISTRY = {query.name: query for query in (PARTIES, TRAUMAS)}
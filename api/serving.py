@@ -0,0 +1,190 @@
+import argparse
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from api import config, inference, metrics
+from api.models.pyd import PartyData
+
+
+def _process_start() -> float:
+    # on the monotonic clock, so a worker's startup includes the interpreter and its imports
+    try:
+        with open('/proc/self/stat') as file:
+            ticks = int(file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as file:
+            uptime = float(file.read().split()[0])
+        return time.monotonic() - (uptime - ticks / os.sysconf('SC_CLK_TCK'))
+    except (OSError, ValueError, IndexError):
+        return time.monotonic()
+
+
+# when this process started: reset in each forked worker
+started = _process_start()
+# until the app's startup finished, set by report_ready
+startup_seconds: Optional[float] = None
+
+
+class Predictor:
+    # model.pkl and its folded fast path, loaded on first use or up front by the pre-fork parent,
+    # and warmed up with a dummy prediction before the worker reports ready
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.pipeline = None
+        self.fast: Optional[inference.FoldedLogit] = None
+
+    def load(self):
+        with self._lock:
+            if self.pipeline is not None:
+                return
+            start = time.perf_counter()
+            # joblib and the sklearn classes the pickle refers to are imported here, not when the app is
+            import joblib
+            pipeline = joblib.load(config.MODEL_PATH, mmap_mode=config.MODEL_MMAP_MODE or None)
+            self.fast = inference.fold(pipeline) if config.PREDICT_FAST_PATH else None
+            self.pipeline = pipeline
+            self.warmup()
+            logging.info('model loaded and warmed up in %.2fs', time.perf_counter() - start)
+
+    def warmup(self):
+        # the first predict pays for lazy imports and allocations inside sklearn and pandas
+        record = PartyData(age=30, sex='male', race='white')
+        inference.predict_many(self.pipeline, [record])
+        if self.fast is not None:
+            self.fast.predict_one(record)
+            self.fast.predict([record])
+
+    def predict_many(self, records: List[PartyData]) -> List[int]:
+        return inference.predict_many(self.pipeline, records)
+
+
+predictor = Predictor()
+
+
+def memory() -> Dict[str, int]:
+    # bytes; pss splits shared pages between the processes mapping them, private is what this worker alone costs
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    usage = {'rss': 0, 'pss': 0, 'private': 0}
+    try:
+        with open('/proc/self/smaps_rollup') as file:
+            for line in file:
+                key, _, value = line.partition(':')
+                if key in fields:
+                    usage[fields[key]] += int(value.split()[0]) * 1024
+    except FileNotFoundError:
+        import resource
+        # peak rather than current, and nothing about sharing, off linux
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        usage['rss'] = rss if sys.platform == 'darwin' else rss * 1024
+    return usage
+
+
+def report_ready():
+    global startup_seconds
+    startup_seconds = time.monotonic() - started
+    usage = memory()
+    logging.info('worker %d ready in %.2fs: rss %.0f MiB, pss %.0f MiB, private %.0f MiB', os.getpid(),
+                 startup_seconds, usage['rss'] / 1024 ** 2, usage['pss'] / 1024 ** 2, usage['private'] / 1024 ** 2)
+
+
+def _worker(app, sock: socket.socket, metrics_directory: str):
+    global started
+    started = time.monotonic()
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+    metrics.share(metrics_directory)
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, log_config=None, timeout_graceful_shutdown=30))
+    server.run(sockets=[sock])
+
+
+def serve(host: str, port: int, workers: int):
+    # pre-fork: the parent imports the app and loads the model once, then forks workers that share those pages
+    # copy-on-write and accept on the one listening socket
+    start = time.perf_counter()
+    from api.main import app
+    predictor.load()
+    # objects that exist now are never collected; without this the first gc pass in each worker writes to
+    # every tracked object's header and un-shares the pages holding them
+    gc.collect()
+    gc.freeze()
+    logging.info('parent ready in %.2fs, forking %d workers', time.perf_counter() - start, workers)
+    # where the workers' metrics meet, so a scrape of any one of them reports them all; whatever the parent counted
+    # so far goes in first, since the workers start theirs from zero
+    metrics_directory = tempfile.mkdtemp(prefix='switrs-metrics-')
+    metrics.save(os.path.join(metrics_directory, 'parent.json'), gauges=False)
+
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    children: Dict[int, float] = {}
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _worker(app, sock, metrics_directory)
+            finally:
+                os._exit(0)
+        children[pid] = time.monotonic()
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        born = children.pop(pid, None)
+        if not stopping and born is not None:
+            logging.warning('worker %d exited with code %d after %.0fs, replacing it', pid,
+                            os.waitstatus_to_exitcode(status), time.monotonic() - born)
+            # don't spin if workers die on startup
+            time.sleep(max(0.0, 1 - (time.monotonic() - born)))
+            spawn()
+    sock.close()
+    shutil.rmtree(metrics_directory, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m api.serving',
+                                     description='serve the api from pre-forked workers sharing one loaded model')
+    parser.add_argument('--host', default=config.API_HOST)
+    parser.add_argument('--port', type=int, default=config.API_PORT)
+    parser.add_argument('--workers', type=int, default=config.API_WORKERS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    serve(args.host, args.port, max(1, args.workers))
+
+
+if __name__ == '__main__':
+    # through the api.serving module, not __main__, so the predictor loaded here is the one api.main uses
+    from api import serving
+    serving.main()
@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+import threading
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from sqlalchemy import text
+
+from api import config, database
+from api.cache import artifacts
+
+# 2^14 registers: 16 KiB per column for a ~0.8% standard error on distinct counts
+HLL_PRECISION = 14
+# KLL accuracy parameter: ~1.3% normalized rank error at 99% confidence
+KLL_K = 200
+
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    # exact for uint64: frexp is exact on each 32-bit half once it is a float64
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, np.frexp(high)[1] + 32, np.frexp(low)[1])
+
+
+class HyperLogLog:
+    def __init__(self, precision: int = HLL_PRECISION, registers: Optional[np.ndarray] = None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+        self._estimate: Optional[float] = None
+
+    def update(self, hashes: np.ndarray):
+        self._estimate = None
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        # rank of the first set bit in the remaining 64 - p bits, with a sentinel bit so it's at most 64 - p + 1
+        rest = (hashes << p) | (np.uint64(1) << (p - np.uint64(1)))
+        rank = (65 - _bit_length(rest)).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def estimate(self) -> float:
+        if self._estimate is None:
+            self._estimate = self._compute_estimate()
+        return self._estimate
+
+    def _compute_estimate(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # linear counting is much more accurate while many registers are still empty
+            return m * math.log(m / zeros)
+        return float(raw)
+
+    @property
+    def relative_error(self) -> float:
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def to_dict(self) -> dict:
+        return {'precision': self.precision, 'registers': self.registers.tolist()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'HyperLogLog':
+        return cls(data['precision'], np.array(data['registers'], dtype=np.uint8))
+
+
+class KLL:
+    # quantile sketch: levels of sorted samples where an item on level h stands for 2^h values;
+    # a full level is sorted and every other item (random parity) is promoted to the next one
+
+    def __init__(self, k: int = KLL_K, seed: int = 0):
+        self.k = k
+        self.n = 0
+        self.levels: List[np.ndarray] = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+        # sorted values and their cumulative weights, built on the first query after an update
+        self._cdf = None
+
+    def _capacity(self, level: int) -> int:
+        return max(2, int(math.ceil(self.k * (2 / 3) ** (len(self.levels) - level - 1))))
+
+    def update(self, values: np.ndarray):
+        self._cdf = None
+        self.n += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values.astype(np.float64)])
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(self.levels[level])
+                # an odd item out stays behind so the promoted half carries exactly double weight
+                keep, items = items[:len(items) % 2], items[len(items) % 2:]
+                promoted = items[self._rng.integers(2)::2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.levels[level] = keep
+            level += 1
+
+    def quantiles(self, qs: Sequence[float]) -> List[Optional[float]]:
+        if not self.n:
+            return [None for _ in qs]
+        if self._cdf is None:
+            values = np.concatenate(self.levels)
+            weights = np.concatenate([np.full(len(items), 2 ** h, dtype=np.float64)
+                                      for h, items in enumerate(self.levels)])
+            order = np.argsort(values, kind='stable')
+            self._cdf = values[order], np.cumsum(weights[order])
+        values, cumulative = self._cdf
+        positions = np.searchsorted(cumulative, [q * cumulative[-1] for q in qs], side='left')
+        return [float(values[min(i, len(values) - 1)]) for i in positions]
+
+    @property
+    def rank_error(self) -> float:
+        # the two-sided normalized rank error at 99% confidence from the KLL reference implementation
+        return 2.296 / self.k ** 0.9723
+
+    def to_dict(self) -> dict:
+        return {'k': self.k, 'n': self.n, 'levels': [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'KLL':
+        sketch = cls(data['k'])
+        sketch.n = data['n']
+        sketch.levels = [np.array(items, dtype=np.float64) for items in data['levels']]
+        return sketch
+
+
+def numeric(declared_type: str) -> bool:
+    # sqlite's affinity rules
+    declared_type = declared_type.upper()
+    return any(word in declared_type for word in ('INT', 'REAL', 'FLOA', 'DOUB', 'NUM', 'DEC'))
+
+
+def build_table(table_name: str) -> dict:
+    # one streaming pass: exact row/null counts and min/max, a HyperLogLog per column and a KLL per numeric column
+    # pandas is only needed here, in the offline build, so serving doesn't import it
+    import pandas as pd
+    with database.SessionLocal() as db:
+        types = {row[1]: row[2] for row in db.execute(text(f'PRAGMA table_info({table_name})'))}
+        result = db.execute(text(f'SELECT * FROM {table_name}').execution_options(yield_per=config.EXPORT_CHUNK_ROWS))
+        columns = list(result.keys())
+        distinct = {c: HyperLogLog() for c in columns}
+        quantiles = {c: KLL() for c in columns if numeric(types.get(c, ''))}
+        counts = {c: 0 for c in columns}
+        bounds: Dict[str, list] = {c: [None, None] for c in quantiles}
+        rows = 0
+        for chunk in result.partitions(config.EXPORT_CHUNK_ROWS):
+            frame = pd.DataFrame.from_records(chunk, columns=columns)
+            rows += len(frame)
+            for column in columns:
+                present = frame[column].dropna()
+                counts[column] += len(present)
+                if column in quantiles:
+                    # a chunk can come back as int64, float64 or object depending on its nulls, so numbers are
+                    # hashed as float64 and anything else in the column as text
+                    parsed = pd.to_numeric(present, errors='coerce')
+                    numbers = parsed.dropna().to_numpy(dtype=np.float64)
+                    distinct[column].update(pd.util.hash_array(numbers))
+                    distinct[column].update(pd.util.hash_array(present[parsed.isna()].astype(str).to_numpy()))
+                    if len(numbers):
+                        quantiles[column].update(numbers)
+                        low, high = bounds[column]
+                        bounds[column] = [float(numbers.min()) if low is None else min(low, float(numbers.min())),
+                                          float(numbers.max()) if high is None else max(high, float(numbers.max()))]
+                else:
+                    distinct[column].update(pd.util.hash_array(present.astype(str).to_numpy()))
+    return {
+        'rows': rows,
+        'columns': {c: {
+            'count': counts[c],
+            'nulls': rows - counts[c],
+            'hll': distinct[c].to_dict(),
+            'kll': quantiles[c].to_dict() if c in quantiles else None,
+            'min': bounds[c][0] if c in bounds else None,
+            'max': bounds[c][1] if c in bounds else None,
+        } for c in columns},
+    }
+
+
+def build(names: Optional[Sequence[str]] = None) -> dict:
+    version = artifacts.db_version()
+    data = _read() or {}
+    if data.get('source_version') != version:
+        data = {'source_version': version, 'tables': {}}
+    for name in names or database.TABLES:
+        logging.info('building sketches for %s', name)
+        data['tables'][name] = build_table(name)
+    os.makedirs(os.path.dirname(os.path.abspath(config.SKETCHES_FILE)), exist_ok=True)
+    tmp_path = f'{config.SKETCHES_FILE}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(tmp_path, config.SKETCHES_FILE)
+    return data
+
+
+def _read() -> Optional[dict]:
+    try:
+        with open(config.SKETCHES_FILE) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+
+class Store:
+    # the sketches file deserialized once per change, answering from memory afterwards
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._tables: Dict[str, dict] = {}
+        self._version: Optional[str] = None
+
+    def _load(self):
+        try:
+            st = os.stat(config.SKETCHES_FILE)
+        except FileNotFoundError:
+            self._key, self._tables, self._version = None, {}, None
+            return
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if key == self._key:
+                return
+            data = _read()
+            self._tables = {
+                name: {'rows': table['rows'], 'columns': {c: {
+                    **{k: v for k, v in stats.items() if k not in ('hll', 'kll')},
+                    'hll': HyperLogLog.from_dict(stats['hll']),
+                    'kll': KLL.from_dict(stats['kll']) if stats['kll'] else None,
+                } for c, stats in table['columns'].items()}}
+                for name, table in data['tables'].items()}
+            self._key, self._version = key, data['source_version']
+
+    def table(self, name: str) -> Optional[dict]:
+        # None until sketches were built for the database file as it is now
+        self._load()
+        if self._version != artifacts.db_version():
+            return None
+        return self._tables.get(name)
+
+
+store = Store()
+
+
+def column_stats(stats: dict, qs: Sequence[float] = ()) -> dict:
+    hll, kll = stats['hll'], stats['kll']
+    output = {
+        'count': stats['count'],
+        'nulls': stats['nulls'],
+        'distinct': {'estimate': round(hll.estimate()), 'relative_error': hll.relative_error},
+        'min': stats['min'],
+        'max': stats['max'],
+    }
+    if kll is not None:
+        output['quantiles'] = dict(zip(map(str, qs), kll.quantiles(qs)))
+        output['rank_error'] = kll.rank_error
+    return output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m api.sketches',
+                                     description='distinct-count and quantile sketches of switrs.sqlite')
+    parser.add_argument('tables', nargs='*', metavar='table', help=f'any of {", ".join(database.TABLES)}')
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.tables if name not in database.TABLES]
+    if unknown:
+        parser.error(f'unknown tables: {", ".join(unknown)}')
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not config.check():
+        sys.exit(1)
+    data = build(args.tables or None)
+    for name, table in data['tables'].items():
+        print(f"{name:<12} {table['rows']} rows, {len(table['columns'])} columns")
+
+
+if __name__ == '__main__':
+    main()
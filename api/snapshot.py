@@ -0,0 +1,442 @@
+import argparse
+import datetime
+import json
+import logging
+import math
+import os
+import struct
+import sys
+import threading
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import text
+
+from api import config, database
+from api.cache import artifacts
+
+# the table the snapshot holds, the one every export and dashboard aggregate reads
+TABLE = 'parties'
+MAGIC = b'SWSNAP01'
+# every array starts on a cache line
+ALIGN = 64
+# group-by keys are combined into one integer; past this many possible groups they are np.unique'd instead
+DENSE_GROUPS = 1 << 24
+
+
+class Column(NamedTuple):
+    name: str
+    # the integer values, or for a dictionary-encoded column the codes into categories, -1 for null
+    # (pandas' Categorical convention)
+    values: np.ndarray
+    # True where an integer column is null, None when it has no nulls
+    nulls: Optional[np.ndarray]
+    # sorted utf-8 values of a dictionary-encoded column, so code order is sqlite's BINARY text order
+    categories: Optional[np.ndarray]
+
+    @property
+    def categorical(self) -> bool:
+        return self.categories is not None
+
+    def valid(self, rows: np.ndarray) -> Optional[np.ndarray]:
+        # which of `rows` are not null, None when all of them are
+        if self.categorical:
+            return self.values[rows] >= 0
+        return None if self.nulls is None else ~self.nulls[rows]
+
+    def label(self, value) -> object:
+        return self.categories[value].decode() if self.categorical else int(value)
+
+
+def _int_dtype(low: int, high: int) -> np.dtype:
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f'{low}..{high} does not fit in int64')
+
+
+def _profile(db, columns: Sequence[str]) -> Dict[str, dict]:
+    # one pass over the table for what every column holds: integer columns get the smallest dtype their range
+    # fits in, text columns a dictionary, anything else (reals, blobs, mixed) stays in sqlite only
+    selects = []
+    for column in columns:
+        quoted = f'"{column}"'
+        selects += [f"MIN(CASE WHEN typeof({quoted}) = 'integer' THEN {quoted} END)",
+                    f"MAX(CASE WHEN typeof({quoted}) = 'integer' THEN {quoted} END)",
+                    f"SUM(typeof({quoted}) = 'integer')", f"SUM(typeof({quoted}) = 'text')",
+                    f"SUM({quoted} IS NULL)"]
+    row = db.execute(text(f'SELECT COUNT(*), {", ".join(selects)} FROM {TABLE}')).one()
+    rows, values = row[0], iter(row[1:])
+    profile = {}
+    for column in columns:
+        low, high, integers, texts, nulls = (next(values) for _ in range(5))
+        integers, texts, nulls = integers or 0, texts or 0, nulls or 0
+        if integers and integers + nulls == rows:
+            profile[column] = {'kind': 'int', 'dtype': _int_dtype(low, high), 'nulls': bool(nulls)}
+        elif texts + nulls == rows:
+            profile[column] = {'kind': 'category'}
+        else:
+            logging.warning('snapshot: %s.%s holds reals, blobs or mixed types, leaving it out', TABLE, column)
+    return profile
+
+
+def _encode(profile: Dict[str, dict]) -> Tuple[int, Dict[str, Column]]:
+    parts: Dict[str, list] = {column: [] for column in profile}
+    nulls: Dict[str, list] = {column: [] for column in profile}
+    lookups: Dict[str, dict] = {column: {} for column in profile if profile[column]['kind'] == 'category'}
+    quoted = ', '.join(f'"{column}"' for column in profile)
+    rows = 0
+    with database.SessionLocal() as db:
+        result = db.execute(text(f'SELECT {quoted} FROM {TABLE} ORDER BY rowid')
+                            .execution_options(yield_per=config.EXPORT_CHUNK_ROWS))
+        for chunk in result.partitions(config.EXPORT_CHUNK_ROWS):
+            n = len(chunk)
+            rows += n
+            for column, values in zip(profile, zip(*chunk)):
+                if column in lookups:
+                    # provisional codes in order of appearance, sorted once every value has been seen
+                    lookup = lookups[column]
+                    parts[column].append(np.fromiter(
+                        (-1 if v is None else lookup.setdefault(v, len(lookup)) for v in values), np.int32, n))
+                else:
+                    parts[column].append(np.fromiter((0 if v is None else v for v in values),
+                                                     profile[column]['dtype'], n))
+                    if profile[column]['nulls']:
+                        nulls[column].append(np.fromiter((v is None for v in values), np.bool_, n))
+
+    columns = {}
+    for column in profile:
+        values = np.concatenate(parts.pop(column)) if rows else np.empty(0, np.int32)
+        if column in lookups:
+            ordered = sorted(lookups[column], key=lambda v: v.encode())
+            remap = np.empty(len(ordered) + 1, np.int64)
+            remap[[lookups[column][v] for v in ordered]] = np.arange(len(ordered))
+            remap[-1] = -1
+            values = remap[values].astype(_int_dtype(-1, max(len(ordered) - 1, 0)))
+            encoded = [v.encode() for v in ordered]
+            categories = np.array(encoded, dtype=f'S{max([len(v) for v in encoded] + [1])}')
+            columns[column] = Column(column, values, None, categories)
+        else:
+            column_nulls = np.concatenate(nulls[column]) if nulls[column] else None
+            columns[column] = Column(column, values.astype(profile[column]['dtype']), column_nulls, None)
+    return rows, columns
+
+
+def _aligned(position: int) -> int:
+    return -(-position // ALIGN) * ALIGN
+
+
+def write(path: str, rows: int, columns: Dict[str, Column], source_version: str):
+    # MAGIC, the header length, a json header, then every array aligned, at offsets relative to the data start
+    arrays = []
+    specs = []
+    offset = 0
+
+    def place(array: np.ndarray) -> dict:
+        nonlocal offset
+        offset = _aligned(offset)
+        spec = {'offset': offset, 'dtype': array.dtype.str, 'length': len(array)}
+        arrays.append((offset, array))
+        offset += array.nbytes
+        return spec
+
+    for column in columns.values():
+        specs.append({
+            'name': column.name,
+            'values': place(column.values),
+            'nulls': place(column.nulls) if column.nulls is not None else None,
+            'categories': place(column.categories) if column.categorical else None,
+        })
+    header = json.dumps({
+        'table': TABLE, 'rows': rows, 'source_version': source_version,
+        'built_at': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'columns': specs,
+    }).encode()
+    start = _aligned(len(MAGIC) + 8 + len(header))
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for position, array in arrays:
+            file.seek(start + position)
+            file.write(np.ascontiguousarray(array).data)
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    # the file memory-mapped read-only: the columns are views into the page cache, shared by every process
+    # that maps it and paged in as they are touched
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a {TABLE} snapshot')
+            length = struct.unpack('<Q', file.read(8))[0]
+            header = json.loads(file.read(length))
+        start = _aligned(len(MAGIC) + 8 + length)
+        self.rows: int = header['rows']
+        self.source_version: str = header['source_version']
+        self.built_at: str = header['built_at']
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+
+        def array(spec: Optional[dict]) -> Optional[np.ndarray]:
+            if spec is None:
+                return None
+            dtype = np.dtype(spec['dtype'])
+            begin = start + spec['offset']
+            return data[begin:begin + dtype.itemsize * spec['length']].view(dtype)
+
+        self.columns: Dict[str, Column] = {
+            spec['name']: Column(spec['name'], array(spec['values']), array(spec['nulls']), array(spec['categories']))
+            for spec in header['columns']}
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for c in self.columns.values() for a in c if isinstance(a, np.ndarray))
+
+    def comparable(self, filters: Sequence[Tuple[str, str, object]]) -> bool:
+        # whether where() can evaluate the filters: comparisons across types follow sqlite's affinity rules
+        # and are left to it
+        for column, op, value in filters:
+            categorical = self.columns[column].categorical
+            values = value if op == 'in' else [] if op in ('null', 'notnull') else [value]
+            for v in values:
+                if categorical != isinstance(v, str) or isinstance(v, float) and not math.isfinite(v):
+                    return False
+        return True
+
+    def where(self, filters: Sequence[Tuple[str, str, object]]) -> np.ndarray:
+        # the rows matching every (column, op, value), like the sql WHERE would
+        mask = np.ones(self.rows, dtype=np.bool_)
+        for column, op, value in filters:
+            mask &= self._match(self.columns[column], op, value)
+        return mask
+
+    def _match(self, column: Column, op: str, value) -> np.ndarray:
+        if op in ('null', 'notnull'):
+            null = column.values < 0 if column.categorical else column.nulls
+            if null is None:
+                null = np.zeros(self.rows, dtype=np.bool_)
+            return null if op == 'null' else ~null
+        if op == 'in':
+            matches = [self._match(column, 'eq', v) for v in value]
+            return np.logical_or.reduce(matches) if matches else np.zeros(self.rows, dtype=np.bool_)
+        if column.categorical:
+            return self._match_categories(column, op, value.encode())
+        matched = self._match_integers(column.values, op, value)
+        return matched if column.nulls is None else matched & ~column.nulls
+
+    def _match_categories(self, column: Column, op: str, value: bytes) -> np.ndarray:
+        # the dictionary is sorted, so every comparison is one on the codes
+        codes = column.values
+        left = int(np.searchsorted(column.categories, value, side='left'))
+        right = int(np.searchsorted(column.categories, value, side='right'))
+        if op == 'eq':
+            return codes == left if left < right else np.zeros(self.rows, dtype=np.bool_)
+        if op == 'ne':
+            return (codes >= 0) & (codes != left) if left < right else codes >= 0
+        if op == 'lt':
+            return (codes >= 0) & (codes < left)
+        if op == 'le':
+            return (codes >= 0) & (codes < right)
+        if op == 'gt':
+            return codes >= right
+        return codes >= left
+
+    def _match_integers(self, values: np.ndarray, op: str, value) -> np.ndarray:
+        # the bound turned into an integer one within the column's dtype, so int8/int16 columns are compared as
+        # they are instead of being widened
+        info = np.iinfo(values.dtype)
+        none, every = np.zeros(self.rows, dtype=np.bool_), np.ones(self.rows, dtype=np.bool_)
+        if op in ('eq', 'ne'):
+            if value != int(value) or not info.min <= value <= info.max:
+                return none if op == 'eq' else every
+            return values == value if op == 'eq' else values != value
+        if op in ('lt', 'le'):
+            high = math.ceil(value) - 1 if op == 'lt' else math.floor(value)
+            return none if high < info.min else every if high >= info.max else values <= high
+        low = math.floor(value) + 1 if op == 'gt' else math.ceil(value)
+        return none if low > info.max else every if low <= info.min else values >= low
+
+    def _groups(self, rows: np.ndarray, group_by: Sequence[str]) -> Optional[Tuple[np.ndarray, List[tuple]]]:
+        # a group index per row and the groups' key values, in sql's ORDER BY order (nulls first)
+        if not group_by:
+            return np.zeros(len(rows), dtype=np.int64), [()]
+        combined = np.zeros(len(rows), dtype=np.int64)
+        space = 1
+        decoders: List[Tuple[int, Callable[[np.ndarray], list]]] = []
+        for name in group_by:
+            column = self.columns[name]
+            values = column.values[rows]
+            if column.categorical:
+                # 0 for null, then code + 1
+                keys, size = values.astype(np.int64) + 1, len(column.categories) + 1
+                decode = (lambda c: lambda k: [None if i == 0 else c.label(i - 1) for i in k.tolist()])(column)
+            else:
+                valid = column.valid(rows)
+                present = values if valid is None else values[valid]
+                low, high = (int(present.min()), int(present.max())) if len(present) else (0, 0)
+                if high - low < DENSE_GROUPS:
+                    keys, size = values.astype(np.int64) - low + 1, high - low + 2
+                    decode = (lambda low: lambda k: [None if i == 0 else i - 1 + low for i in k.tolist()])(low)
+                else:
+                    unique, inverse = np.unique(values, return_inverse=True)
+                    keys, size = inverse.astype(np.int64) + 1, len(unique) + 1
+                    decode = (lambda u: lambda k: [None if i == 0 else int(u[i - 1]) for i in k.tolist()])(unique)
+                if valid is not None:
+                    keys[~valid] = 0
+            if space * size >= 1 << 62:
+                return None
+            combined = combined * size + keys
+            space *= size
+            decoders.append((size, decode))
+
+        if space <= DENSE_GROUPS:
+            counts = np.bincount(combined, minlength=space)
+            present = np.flatnonzero(counts)
+            lookup = np.zeros(space, dtype=np.int64)
+            lookup[present] = np.arange(len(present))
+            group = lookup[combined]
+        else:
+            present, group = np.unique(combined, return_inverse=True)
+        columns = []
+        remaining = present
+        for size, decode in reversed(decoders):
+            remaining, keys = np.divmod(remaining, size)
+            columns.append(decode(keys))
+        return group, list(zip(*reversed(columns)))
+
+    def aggregate(self, filters: Sequence[Tuple[str, str, object]], group_by: Sequence[str], aggregates,
+                  limit: int) -> Optional[List[dict]]:
+        # api.aggregate's statistics over the matching rows; None when something is better left to sqlite
+        for a in aggregates:
+            column = self.columns[a.column] if a.column else None
+            if column is not None and column.categorical and a.func not in ('count', 'min', 'max'):
+                return None
+        if not self.comparable(filters):
+            return None
+        rows = np.flatnonzero(self.where(filters))
+        grouped = self._groups(rows, group_by)
+        if grouped is None:
+            return None
+        group, keys = grouped
+        keys = keys[:limit]
+        n_groups = len(keys)
+        output = [dict(zip(group_by, key)) for key in keys]
+
+        for a in aggregates:
+            if a.column is None:
+                results = np.bincount(group, minlength=n_groups)[:n_groups].tolist()
+            else:
+                results = self._statistic(self.columns[a.column], rows, group, n_groups, a)
+            for item, result in zip(output, results):
+                item[a.name] = result
+        return output
+
+    @staticmethod
+    def _statistic(column: Column, rows: np.ndarray, group: np.ndarray, n_groups: int, a) -> list:
+        valid = column.valid(rows)
+        values = column.values[rows]
+        if valid is not None:
+            values, group = values[valid], group[valid]
+        # groups past the limit are dropped here, before any per-group work
+        kept = group < n_groups
+        values, group = values[kept], group[kept]
+        counts = np.bincount(group, minlength=n_groups)
+        if a.func == 'count':
+            return counts.tolist()
+        if a.func in ('sum', 'mean', 'std', 'var'):
+            totals = np.bincount(group, weights=values, minlength=n_groups)
+            if a.func == 'sum':
+                return [int(round(t)) if n else None for t, n in zip(totals.tolist(), counts.tolist())]
+            if a.func == 'mean':
+                return [t / n if n else None for t, n in zip(totals.tolist(), counts.tolist())]
+            squares = np.bincount(group, weights=values.astype(np.float64) ** 2, minlength=n_groups)
+            output = []
+            for n, total, square in zip(counts.tolist(), totals.tolist(), squares.tolist()):
+                variance = max((square - total * total / n) / (n - 1), 0.0) if n > 1 else None
+                output.append(variance if a.func == 'var' or variance is None else math.sqrt(variance))
+            return output
+
+        # min, max and quantiles from the values sorted within each group
+        ordered = values[np.lexsort((values, group))]
+        ends = np.cumsum(counts)
+        starts = ends - counts
+        output = []
+        for n, start, end in zip(counts.tolist(), starts.tolist(), ends.tolist()):
+            if not n:
+                output.append(None)
+            elif a.func == 'min':
+                output.append(column.label(ordered[start]))
+            elif a.func == 'max':
+                output.append(column.label(ordered[end - 1]))
+            else:
+                # interpolated like api.aggregate's sql quantiles
+                position = (n - 1) * a.quantile
+                low = int(position)
+                lower = int(ordered[start + low])
+                upper = int(ordered[start + min(low + 1, n - 1)])
+                output.append(lower + (position - low) * (upper - lower))
+        return output
+
+
+class Store:
+    # the snapshot mapped once per change of the file, and only handed out while it matches the database
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._snapshot: Optional[Snapshot] = None
+
+    def get(self, table: str = TABLE) -> Optional[Snapshot]:
+        if table != TABLE:
+            return None
+        try:
+            st = os.stat(config.SNAPSHOT_FILE)
+        except FileNotFoundError:
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if key != self._key:
+                try:
+                    self._snapshot = Snapshot(config.SNAPSHOT_FILE)
+                except (OSError, ValueError) as e:
+                    logging.warning('could not load snapshot %s: %s', config.SNAPSHOT_FILE, e)
+                    self._snapshot = None
+                self._key = key
+            snapshot = self._snapshot
+        if snapshot is None or snapshot.source_version != artifacts.db_version():
+            return None
+        return snapshot
+
+
+store = Store()
+
+
+def build() -> Snapshot:
+    version = artifacts.db_version()
+    with database.SessionLocal() as db:
+        columns = [row[1] for row in db.execute(text(f'PRAGMA table_info({TABLE})'))]
+        profile = _profile(db, columns)
+    rows, encoded = _encode(profile)
+    os.makedirs(os.path.dirname(os.path.abspath(config.SNAPSHOT_FILE)), exist_ok=True)
+    write(config.SNAPSHOT_FILE, rows, encoded, version)
+    logging.info('snapshot of %s written to %s', TABLE, config.SNAPSHOT_FILE)
+    return Snapshot(config.SNAPSHOT_FILE)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m api.snapshot',
+                                     description=f'compact columnar snapshot of the {TABLE} table of switrs.sqlite')
+    parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not config.check():
+        sys.exit(1)
+    snapshot = build()
+    for column in snapshot.columns.values():
+        kind = f'dictionary of {len(column.categories)}' if column.categorical else 'integer'
+        nulls = ', nullable' if column.nulls is not None else ''
+        print(f'{column.name:<24} {kind} ({column.values.dtype}{nulls})')
+    print(f'{snapshot.rows} rows in {snapshot.nbytes / 1024 ** 2:.1f} MiB')
+
+
+if __name__ == '__main__':
+    main()
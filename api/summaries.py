@@ -0,0 +1,234 @@
+import argparse
+import datetime
+import logging
+import os
+import sys
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from api import config, database, metadata, metrics, partitions
+from api.cache import artifacts
+
+
+class Summary(NamedTuple):
+    name: str
+    table: str
+    # (column, expression) pairs the summary is grouped by
+    keys: Sequence[Tuple[str, str]]
+    # (column, expression) pairs of additive aggregates, so deltas for new rows can be added to existing groups
+    measures: Sequence[Tuple[str, str]]
+    # /aggregate filters baked into the summary, in the same column:op:value form
+    filters: Sequence[str]
+    where: str
+
+
+REGISTRY = {s.name: s for s in (
+    Summary(
+        name='traumas_by_age_group',
+        table='parties',
+        keys=[('age_group', "CASE WHEN party_age >= 18 AND party_age <= 30 THEN 'youngs' "
+                            "WHEN party_age > 30 THEN 'adults' ELSE 'unknown' END")],
+        measures=[('total_people', 'COUNT(*)'), ('total_killed', 'SUM(party_number_killed)'),
+                  ('total_injured', 'SUM(party_number_injured)')],
+        filters=['party_age:ge:18', 'at_fault:eq:1'],
+        where='party_age >= 18 AND at_fault = 1',
+    ),
+    Summary(
+        name='parties_by_vehicle_year',
+        table='parties',
+        keys=[('vehicle_year', 'vehicle_year')],
+        measures=[('count', 'COUNT(*)')],
+        filters=['at_fault:eq:1'],
+        where='at_fault = 1',
+    ),
+    Summary(
+        name='parties_by_person',
+        table='parties',
+        keys=[('party_sex', 'party_sex'), ('party_race', 'party_race'), ('cellphone_in_use', 'cellphone_in_use'),
+              ('party_age', 'party_age')],
+        measures=[('count', 'COUNT(*)')],
+        filters=['at_fault:eq:1'],
+        where='at_fault = 1',
+    ),
+)}
+
+engine = create_engine(f'sqlite:///{config.SUMMARY_DB}', connect_args={"check_same_thread": False})
+metrics.instrument(engine)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def _setup(db):
+    db.execute(text('CREATE TABLE IF NOT EXISTS _summaries '
+                    '(name TEXT PRIMARY KEY, refreshed_at TEXT, source_version TEXT)'))
+    db.execute(text('CREATE TABLE IF NOT EXISTS _summary_years '
+                    '(name TEXT, db_year INTEGER, PRIMARY KEY (name, db_year))'))
+
+
+def source_query(summary: Summary, years: Optional[List[int]]):
+    columns = [f'{expr} AS {name}' for name, expr in (*summary.keys, *summary.measures)]
+    where = summary.where
+    params = {}
+    if years is not None:
+        # only the cases that arrived with the new database years
+        names = [f'y{i}' for i in range(len(years))]
+        where += f' AND case_id IN (SELECT case_id FROM case_ids WHERE db_year IN ({", ".join(":" + n for n in names)}))'
+        params = dict(zip(names, years))
+    group = ', '.join(name for name, _ in summary.keys)
+    return text(f'SELECT {", ".join(columns)} FROM {summary.table} WHERE {where} GROUP BY {group}'), params
+
+
+def _quote(column: str) -> str:
+    return f'"{column}"'
+
+
+def partitioned(summary: Summary) -> Optional[List[dict]]:
+    # the whole summary, grouped per rowid range on the api.partitions processes and added up; None when the table
+    # is small enough for the single query
+    table = metadata.catalog.tables()[summary.table]
+    if not partitions.enabled(table.row_count):
+        return None
+    columns = [name for name, _ in (*summary.keys, *summary.measures)]
+    rows = partitions.grouped(summary.table, table.max_rowid, [expr for _, expr in summary.keys],
+                              [(expr, 'sum') for _, expr in summary.measures], summary.where)
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _key_index(db, summary: Summary) -> str:
+    # a UNIQUE index tells NULLs apart, so NULL groups (unknown sex, missing year...) are indexed as an empty blob,
+    # which no key column holds; it is also the ON CONFLICT target of the merge
+    keys = ', '.join(f"IFNULL({_quote(name)}, x'')" for name, _ in summary.keys)
+    db.execute(text(f'CREATE UNIQUE INDEX IF NOT EXISTS {summary.name}_keys ON {summary.name} ({keys})'))
+    return keys
+
+
+def _merge(db, summary: Summary, rows: List[dict], fresh: bool):
+    # rows hold one group each; a freshly created table takes them as they are, otherwise they are added up with
+    # the existing groups
+    keys = [name for name, _ in summary.keys]
+    measures = [name for name, _ in summary.measures]
+    insert = (f'INSERT INTO {summary.name} ({", ".join(map(_quote, keys + measures))}) '
+              f'VALUES ({", ".join(":" + c for c in keys + measures)})')
+    if fresh:
+        if rows:
+            db.execute(text(insert), rows)
+        _key_index(db, summary)
+        return
+    target = _key_index(db, summary)
+    additions = ', '.join(f'{_quote(m)} = COALESCE({_quote(m)}, 0) + COALESCE(excluded.{_quote(m)}, 0)'
+                          for m in measures)
+    if rows:
+        db.execute(text(f'{insert} ON CONFLICT ({target}) DO UPDATE SET {additions}'), rows)
+
+
+def refresh(full: bool = False, names: Optional[Sequence[str]] = None) -> Dict[str, int]:
+    # folds every case_ids.db_year not yet seen into each summary; the first run (or --full) scans everything
+    refreshed = {}
+    os.makedirs(os.path.dirname(os.path.abspath(config.SUMMARY_DB)), exist_ok=True)
+    with database.SessionLocal() as source, SessionLocal() as db:
+        _setup(db)
+        years = [row[0] for row in source.execute(text('SELECT DISTINCT db_year FROM case_ids'))]
+        version = artifacts.db_version()
+        for name in names or REGISTRY:
+            summary = REGISTRY[name]
+            done = {row[0] for row in db.execute(text('SELECT db_year FROM _summary_years WHERE name = :n'),
+                                                 {'n': name})}
+            exists = db.execute(text('SELECT 1 FROM _summaries WHERE name = :n'), {'n': name}).first() is not None
+            fresh = full or not exists
+            if fresh:
+                db.execute(text(f'DROP TABLE IF EXISTS {name}'))
+                columns = [column for column, _ in (*summary.keys, *summary.measures)]
+                db.execute(text(f'CREATE TABLE {name} ({", ".join(map(_quote, columns))})'))
+                db.execute(text('DELETE FROM _summary_years WHERE name = :n'), {'n': name})
+                query, params = source_query(summary, None)
+                new_years = years
+                rows = partitioned(summary)
+            else:
+                new_years = [y for y in years if y not in done]
+                if not new_years:
+                    db.execute(text('UPDATE _summaries SET source_version = :v WHERE name = :n'),
+                               {'v': version, 'n': name})
+                    refreshed[name] = 0
+                    continue
+                query, params = source_query(summary, new_years)
+                rows = None
+
+            if rows is None:
+                rows = [dict(row._mapping) for row in source.execute(query, params)]
+            _merge(db, summary, rows, fresh)
+            db.execute(text('INSERT OR IGNORE INTO _summary_years (name, db_year) VALUES (:n, :y)'),
+                       [{'n': name, 'y': y} for y in new_years])
+            db.execute(text('INSERT OR REPLACE INTO _summaries (name, refreshed_at, source_version) '
+                            'VALUES (:n, :t, :v)'),
+                       {'n': name, 't': datetime.datetime.now(datetime.timezone.utc).isoformat(), 'v': version})
+            db.commit()
+            refreshed[name] = len(rows)
+            logging.info('summary %s refreshed with %d groups (years %s)', name, len(rows), new_years)
+        db.commit()
+    return refreshed
+
+
+def status() -> List[dict]:
+    if not os.path.exists(config.SUMMARY_DB):
+        return [{'name': name, 'refreshed_at': None, 'current': False, 'db_years': []} for name in REGISTRY]
+    version = artifacts.db_version()
+    with SessionLocal() as db:
+        _setup(db)
+        known = {row.name: row for row in db.execute(text('SELECT * FROM _summaries'))}
+        years = {}
+        for row in db.execute(text('SELECT name, db_year FROM _summary_years ORDER BY db_year')):
+            years.setdefault(row.name, []).append(row.db_year)
+    return [{
+        'name': name,
+        'refreshed_at': known[name].refreshed_at if name in known else None,
+        'current': name in known and known[name].source_version == version,
+        'db_years': years.get(name, []),
+    } for name in REGISTRY]
+
+
+def rows(name: str) -> List[dict]:
+    keys = ', '.join(_quote(column) for column, _ in REGISTRY[name].keys)
+    with SessionLocal() as db:
+        return [dict(row._mapping) for row in db.execute(text(f'SELECT * FROM {name} ORDER BY {keys}'))]
+
+
+def current(name: str) -> bool:
+    # a summary is only used while it reflects the database file as it is now
+    if not os.path.exists(config.SUMMARY_DB):
+        return False
+    with SessionLocal() as db:
+        try:
+            row = db.execute(text('SELECT source_version FROM _summaries WHERE name = :n'), {'n': name}).first()
+        except OperationalError:
+            return False
+    return row is not None and row[0] == artifacts.db_version()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m api.summaries',
+                                     description='materialized summary tables of switrs.sqlite')
+    commands = parser.add_subparsers(dest='command', required=True)
+    refresh_parser = commands.add_parser('refresh', help='fold new case_ids.db_year rows into the summaries')
+    refresh_parser.add_argument('--full', action='store_true', help='rebuild from scratch instead')
+    refresh_parser.add_argument('names', nargs='*', metavar='name', help=f'any of {", ".join(REGISTRY)}')
+    commands.add_parser('status', help='show when each summary was last refreshed')
+    args = parser.parse_args(argv)
+    unknown = [name for name in getattr(args, 'names', []) if name not in REGISTRY]
+    if unknown:
+        parser.error(f'unknown summaries: {", ".join(unknown)}')
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if not config.check():
+        sys.exit(1)
+    if args.command == 'refresh':
+        refresh(full=args.full, names=args.names or None)
+    for item in status():
+        state = 'current' if item['current'] else 'stale'
+        print(f"{item['name']:<24} {state:<8} refreshed {item['refreshed_at'] or 'never'} "
+              f"years {item['db_years']}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import argparse
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+
+
+def arg_parser(description: str, collisions: int = 200_000):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--db', help='existing switrs.sqlite to run against (a synthetic one is built otherwise)')
+    parser.add_argument('--collisions', type=int, default=collisions, help='size of the synthetic database')
+    parser.add_argument('--db-seed', type=int, default=0, help='seed of the synthetic database')
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser
+
+
+def prepare_db(args) -> str:
+    if args.db:
+        return os.path.abspath(args.db)
+    from bench import synthetic
+    path = os.path.join(tempfile.mkdtemp(prefix='switrs-bench-'), 'switrs.sqlite')
+    print(f'building synthetic database with {args.collisions} collisions at {path}')
+    return synthetic.build(path, collisions=args.collisions, seed=args.db_seed)
+
+
+def client(db_path: str, response_cache: bool = False):
+    # api.main reads DATABASE_URL at import time; the in-memory response cache is off unless asked for, since it
+    # would replay the repeated requests of a benchmark instead of running the endpoint being measured
+    os.environ['DATABASE_URL'] = db_path
+    if not response_cache:
+        os.environ['HTTP_CACHE_MAX_BYTES'] = '0'
+    from fastapi.testclient import TestClient
+    from api.main import app
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    return TestClient(app)
+
+
+def measure(fn, repeat: int):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def report(rows, header):
+    widths = [max(len(str(x)) for x in col) for col in zip(header, *rows)]
+    for row in (header, *rows):
+        print('  '.join(str(x).rjust(w) for x, w in zip(row, widths)))
@@ -0,0 +1,97 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from bench import common
+
+SLT_MAIN = os.path.join(os.path.dirname(common.API_DIR), 'slt', 'main.py')
+
+
+def run(repeat: int) -> dict:
+    # runs in a child process, since the dashboard reads its settings and keeps its caches per process
+    sys.path.insert(0, os.path.dirname(SLT_MAIN))
+    from streamlit.testing.v1 import AppTest
+
+    def render():
+        app = AppTest.from_file(SLT_MAIN, default_timeout=600)
+        start = time.perf_counter()
+        app.run()
+        elapsed = time.perf_counter() - start
+        assert not app.exception and not app.error, [e.value for e in (*app.exception, *app.error)]
+        return elapsed
+
+    # the first session fills the process caches (aggregates, charts), later ones
+    # are what a new visitor waits for
+    cold = render()
+    return {'cold': cold, 'warm': statistics.median(render() for _ in range(repeat))}
+
+
+def delayed_app():
+    # the api behind a network round trip: loopback is too fast for the number of calls to show
+    from api.main import app
+    delay = float(os.environ['BENCH_RTT_MS']) / 1000
+
+    async def delayed(scope, receive, send):
+        if scope['type'] == 'http':
+            await asyncio.sleep(delay)
+        await app(scope, receive, send)
+
+    return delayed
+
+
+def serve(db_path: str, port: int, rtt_ms: float) -> subprocess.Popen:
+    env = {**os.environ, 'DATABASE_URL': db_path, 'DATA_FOLDER': tempfile.mkdtemp(prefix='switrs-api-'),
+           'PYTHONPATH': os.path.dirname(common.API_DIR), 'BENCH_RTT_MS': str(rtt_ms),
+           # the renders after the first repeat the same calls, which the response cache would answer from memory
+           'HTTP_CACHE_MAX_BYTES': '0'}
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', '--factory', 'bench.dashboard_render:delayed_app',
+                               '--port', str(port)],
+                              cwd=common.API_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(600):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/data_info', timeout=1).raise_for_status()
+            return server
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('the api did not start')
+
+
+def main():
+    parser = common.arg_parser('dashboard time to first render with api calls one at a time and fanned out')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--rtt', type=float, default=20, help='milliseconds added to every api request')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.repeat)))
+        return
+
+    server = serve(common.prepare_db(args), args.port, args.rtt)
+    rows = []
+    try:
+        # the first pass only warms the api's own caches so both settings see the same server
+        for concurrency in ('8', '1', '8'):
+            env = {**os.environ, 'BASE_URL': f'http://127.0.0.1:{args.port}', 'API_CONCURRENCY': concurrency}
+            output = subprocess.run([sys.executable, '-m', 'bench.dashboard_render', '--child',
+                                     '--repeat', str(args.repeat)],
+                                    env=env, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            rows.append((concurrency, f"{result['cold'] * 1000:.0f}", f"{result['warm'] * 1000:.0f}"))
+    finally:
+        server.terminate()
+        server.wait()
+    common.report(rows[1:], ('api concurrency', 'first session ms', 'new session ms'))
+
+
+if __name__ == '__main__':
+    main()
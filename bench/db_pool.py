@@ -0,0 +1,67 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench import common
+
+# what the dashboard fires at once: table previews at various depths and a few group-bys
+REQUESTS = [
+    ('/head', {'table_name': 'parties', 'page': 0, 'page_size': 10}),
+    ('/head', {'table_name': 'collisions', 'page': 500, 'page_size': 50}),
+    ('/head', {'table_name': 'victims', 'page': 2_000, 'page_size': 10}),
+    ('/aggregate', {'table_name': 'parties', 'group_by': 'party_sex', 'agg': ['count', 'mean:party_age']}),
+    ('/aggregate', {'table_name': 'victims', 'group_by': 'victim_role', 'agg': 'count'}),
+    ('/aggregate', {'table_name': 'collisions', 'group_by': 'collision_severity', 'agg': 'count'}),
+]
+
+
+def run(db_path: str, concurrency: int, rounds: int) -> dict:
+    # runs in a child process, since the engine is configured when api.database is imported
+    client = common.client(db_path)
+
+    def call(i):
+        path, params = REQUESTS[i % len(REQUESTS)]
+        start = time.perf_counter()
+        assert client.get(path, params=params).status_code == 200
+        return time.perf_counter() - start
+
+    with client, ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(call, range(len(REQUESTS))))
+        start = time.perf_counter()
+        latencies = sorted(pool.map(call, range(rounds * len(REQUESTS))))
+        elapsed = time.perf_counter() - start
+    return {'p50': statistics.median(latencies), 'p99': latencies[int(len(latencies) * 0.99) - 1],
+            'throughput': len(latencies) / elapsed}
+
+
+def main():
+    parser = common.arg_parser('concurrent /head and /aggregate latency with and without DATABASE_READ_ONLY')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--rounds', type=int, default=20, help='passes over the request mix')
+    parser.add_argument('--child', choices=('0', '1'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(run(args.db, args.concurrency, args.rounds)))
+        return
+
+    db_path = common.prepare_db(args)
+    rows = []
+    for read_only in ('0', '1'):
+        env = {**os.environ, 'DATABASE_READ_ONLY': read_only}
+        output = subprocess.run([sys.executable, '-m', 'bench.db_pool', '--db', db_path, '--child', read_only,
+                                 '--concurrency', str(args.concurrency), '--rounds', str(args.rounds)],
+                                env=env, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        rows.append(('read-only' if read_only == '1' else 'default', f"{result['p50'] * 1000:.1f}",
+                     f"{result['p99'] * 1000:.1f}", f"{result['throughput']:.0f}"))
+    common.report(rows, ('connections', 'p50 ms', 'p99 ms', 'req/s'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import io
+import os
+import tempfile
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from bench import common
+
+ARROW_DTYPES = {pa.int8(): pd.Int8Dtype(), pa.int16(): pd.Int16Dtype(), pa.int64(): pd.Int64Dtype()}
+
+LOADERS = {
+    'csv': lambda data: pd.read_csv(io.BytesIO(data)),
+    'arrow': lambda data: pa.ipc.open_stream(data).read_all().to_pandas(types_mapper=ARROW_DTYPES.get),
+    'parquet': lambda data: pq.read_table(pa.BufferReader(data)).to_pandas(types_mapper=ARROW_DTYPES.get),
+}
+
+
+def main():
+    args = common.arg_parser('transfer size and client load time of /data in csv, arrow and parquet').parse_args()
+    os.environ['DATA_FOLDER'] = tempfile.mkdtemp(prefix='switrs-exports-')
+    client = common.client(common.prepare_db(args))
+
+    rows = []
+    for fmt, load in LOADERS.items():
+        start = time.perf_counter()
+        data = client.get('/data', params={'format': fmt}).content
+        cold = time.perf_counter() - start
+        cached = common.measure(lambda: client.get('/data', params={'format': fmt}), args.repeat)
+        load_time = common.measure(lambda: load(data), args.repeat)
+        df = load(data)
+        rows.append((fmt, f'{len(data) / 1024 ** 2:.1f}', f'{cold * 1000:.0f}', f'{cached * 1000:.0f}',
+                     f'{load_time * 1000:.0f}', f'{df.memory_usage(deep=True).sum() / 1024 ** 2:.1f}',
+                     str(df['party_age'].dtype)))
+
+    common.report(rows, ('format', 'size MB', 'export ms', 'cached ms', 'client load ms', 'frame MB', 'party_age'))
+
+
+if __name__ == '__main__':
+    main()
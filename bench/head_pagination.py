@@ -0,0 +1,39 @@
+import sqlite3
+
+from bench import common
+from api import pagination
+
+PAGES = (0, 1_000, 10_000, 50_000)
+
+
+def main():
+    args = common.arg_parser('deep-page latency of /head: OFFSET vs cursor').parse_args()
+    db_path = common.prepare_db(args)
+    client = common.client(db_path)
+    page_size = 10
+
+    con = sqlite3.connect(db_path)
+    rows = []
+    for table in ('parties', 'victims'):
+        for page in PAGES:
+            # the cursor a client would hold after walking to this page
+            last = con.execute(f'SELECT rowid FROM {table} ORDER BY rowid LIMIT 1 OFFSET ?',
+                               (page * page_size - 1,)).fetchone() if page else (0,)
+            if last is None:
+                continue
+            offset_params = {'table_name': table, 'page': page, 'page_size': page_size}
+            cursor_params = {'table_name': table, 'page_size': page_size,
+                             'cursor': pagination.encode_cursor(table, last[0])}
+            assert client.get('/head', params=offset_params).text == client.get('/head', params=cursor_params).text
+
+            offset_time = common.measure(lambda: client.get('/head', params=offset_params), args.repeat)
+            cursor_time = common.measure(lambda: client.get('/head', params=cursor_params), args.repeat)
+            rows.append((table, page, f'{offset_time * 1000:.2f}', f'{cursor_time * 1000:.2f}',
+                         f'{offset_time / cursor_time:.1f}x'))
+    con.close()
+
+    common.report(rows, ('table', 'page', 'offset ms', 'cursor ms', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
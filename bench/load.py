@@ -0,0 +1,195 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple
+
+from bench import common
+
+TABLES = ('case_ids', 'collisions', 'parties', 'victims')
+CHARTS = ('vehicle_year_box', 'cars_by_year', 'people_age_box', 'people_pies', 'traumas_comparison')
+# the dashboard's /aggregate calls
+AGGREGATES = [
+    {'table_name': 'parties', 'group_by': 'vehicle_year', 'where': 'at_fault:eq:1', 'agg': 'count'},
+    {'table_name': 'parties', 'group_by': 'party_age', 'where': 'at_fault:eq:1', 'agg': 'count'},
+    {'table_name': 'parties', 'where': ['at_fault:eq:1', 'vehicle_year:ge:1980', 'vehicle_year:le:2022'],
+     'agg': ['median:vehicle_year', 'mean:vehicle_year', 'std:vehicle_year']},
+    {'table_name': 'parties', 'where': 'at_fault:eq:1', 'agg': ['median:party_age', 'mean:party_age', 'std:party_age']},
+    {'table_name': 'parties', 'group_by': 'party_race', 'agg': ['count', 'mean:party_age']},
+]
+
+
+class Request(NamedTuple):
+    # route is the series the request is reported under
+    route: str
+    method: str
+    url: str
+    kwargs: dict
+
+
+def _person(rnd: random.Random) -> dict:
+    return {'age': rnd.randint(16, 90), 'sex': rnd.choice(('male', 'female')),
+            'race': rnd.choice(('white', 'black', 'asian', 'hispanic', 'other'))}
+
+
+def _head(rnd: random.Random) -> Request:
+    # mostly the first pages, sometimes deep in a table
+    page = rnd.choice((0, 0, 0, 1, 2, rnd.randint(0, 1_000)))
+    return Request('/head', 'GET', '/head', {'params': {'table_name': rnd.choice(TABLES), 'page': page}})
+
+
+# (weight, request) pairs: a dashboard visit is /data_info, four /head pages, the charts and aggregates and
+# the traumas table, while /predict comes from the form and from other clients
+MIX: List[tuple] = [
+    (3, lambda rnd: Request('/data_info', 'GET', '/data_info', {})),
+    (12, _head),
+    (8, lambda rnd: Request('/aggregate', 'GET', '/aggregate', {'params': rnd.choice(AGGREGATES)})),
+    (5, lambda rnd: Request('/charts/{name}', 'GET', f'/charts/{rnd.choice(CHARTS)}', {})),
+    (2, lambda rnd: Request('/traumas', 'GET', '/traumas', {'params': {'format': 'arrow'}})),
+    (1, lambda rnd: Request('/data', 'GET', '/data', {'params': {'format': 'csv'}})),
+    (2, lambda rnd: Request('/stats/{table_name}', 'GET', f'/stats/{rnd.choice(TABLES)}', {})),
+    (2, lambda rnd: Request('/theory', 'GET', '/theory', {})),
+    (20, lambda rnd: Request('/predict', 'POST', '/predict', {'json': _person(rnd)})),
+    (2, lambda rnd: Request('/predict/batch', 'POST', '/predict/batch',
+                            {'json': [_person(rnd) for _ in range(rnd.choice((10, 100, 1_000)))]})),
+]
+
+
+def plan(count: int, seed: int) -> List[Request]:
+    rnd = random.Random(seed)
+    weights = [weight for weight, _ in MIX]
+    return [make(rnd) for make in rnd.choices([make for _, make in MIX], weights, k=count)]
+
+
+def _summary(latencies: List[float], elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p99_ms': latencies[max(int(len(latencies) * 0.99) - 1, 0)] * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'throughput': len(latencies) / elapsed,
+    }
+
+
+def peak_rss() -> int:
+    # bytes; linux reports KiB, macOS bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run(db_path: str, concurrency: int, count: int, warmup: int, seed: int) -> dict:
+    # runs in a child process, so the rss is the api's alone and every run starts with cold caches; the response
+    # cache stays on, the replayed traffic is meant to be served like the dashboard's
+    client = common.client(db_path, response_cache=True)
+    errors: Dict[str, int] = {}
+    lock = threading.Lock()
+
+    def call(request: Request) -> float:
+        start = time.perf_counter()
+        response = client.request(request.method, request.url, **request.kwargs)
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            with lock:
+                errors[request.route] = errors.get(request.route, 0) + 1
+        return elapsed
+
+    requests = plan(warmup + count, seed)
+    with client, ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(call, requests[:warmup]))
+        start = time.perf_counter()
+        latencies = list(pool.map(call, requests[warmup:]))
+        elapsed = time.perf_counter() - start
+
+    routes: Dict[str, List[float]] = {}
+    for request, latency in zip(requests[warmup:], latencies):
+        routes.setdefault(request.route, []).append(latency)
+    return {
+        'total': _summary(latencies, elapsed),
+        'routes': {route: _summary(values, elapsed) for route, values in sorted(routes.items())},
+        'errors': errors,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(common.API_DIR), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def history(path: str):
+    # one row per run in a --output file, oldest first
+    with open(path) as file:
+        runs = [json.loads(line) for line in file if line.strip()]
+    rows = [(run['timestamp'], run['revision'], run['options']['requests'], run['options']['concurrency'],
+             f"{run['total']['p50_ms']:.2f}", f"{run['total']['p99_ms']:.2f}", f"{run['total']['throughput']:.0f}",
+             f"{run['peak_rss_bytes'] / 1024 ** 2:.0f}") for run in runs]
+    common.report(rows, ('timestamp', 'revision', 'requests', 'concurrency', 'p50 ms', 'p99 ms', 'req/s', 'rss MiB'))
+
+
+def main():
+    parser = common.arg_parser('replays a mix of dashboard and /predict traffic against the api in-process')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2_000)
+    parser.add_argument('--warmup', type=int, default=200, help='requests sent before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='append the result as one json line to this file')
+    parser.add_argument('--history', metavar='FILE', help='compare the runs recorded in an --output file and exit')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.db, args.concurrency, args.requests, args.warmup, args.seed)))
+        return
+    if args.history:
+        history(args.history)
+        return
+
+    db_path = common.prepare_db(args)
+    # a fresh artifact cache, so exports and charts are built during the run like after a deploy
+    env = {**os.environ, 'DATA_FOLDER': tempfile.mkdtemp(prefix='switrs-load-')}
+    output = subprocess.run([sys.executable, '-m', 'bench.load', '--child', '--db', db_path,
+                             '--concurrency', str(args.concurrency), '--requests', str(args.requests),
+                             '--warmup', str(args.warmup), '--seed', str(args.seed)],
+                            env=env, check=True, capture_output=True, text=True).stdout
+    result = {
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'database': {'path': db_path, 'bytes': os.path.getsize(db_path)},
+        'options': {'concurrency': args.concurrency, 'requests': args.requests, 'warmup': args.warmup,
+                    'seed': args.seed},
+        **json.loads(output.strip().splitlines()[-1]),
+    }
+
+    rows = [(route, stats['requests'], f"{stats['p50_ms']:.2f}", f"{stats['p99_ms']:.2f}",
+             result['errors'].get(route, 0)) for route, stats in result['routes'].items()]
+    total = result['total']
+    rows.append(('total', total['requests'], f"{total['p50_ms']:.2f}", f"{total['p99_ms']:.2f}",
+                 sum(result['errors'].values())))
+    common.report(rows, ('route', 'requests', 'p50 ms', 'p99 ms', 'errors'))
+    print(f"throughput {total['throughput']:.0f} req/s, peak rss {result['peak_rss_bytes'] / 1024 ** 2:.0f} MiB")
+
+    if args.output:
+        with open(args.output, 'a') as file:
+            file.write(json.dumps(result) + '\n')
+    else:
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
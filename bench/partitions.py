@@ -0,0 +1,55 @@
+import os
+import tempfile
+
+from bench import common
+from bench.load import AGGREGATES
+
+
+def main():
+    parser = common.arg_parser('wall time of the full-table exports, aggregates and summary builds on one connection '
+                               'vs split into rowid ranges over N scan processes')
+    parser.add_argument('--processes', type=int, nargs='+', default=sorted({2, 4, os.cpu_count() or 1}))
+    parser.set_defaults(repeat=3)
+    args = parser.parse_args()
+    db_path = common.prepare_db(args)
+    # api.config reads these at import time; no snapshot, so everything below scans parties
+    os.environ['DATABASE_URL'] = db_path
+    os.environ['DATA_FOLDER'] = tempfile.mkdtemp(prefix='switrs-partitions-')
+    os.environ['SCAN_MIN_ROWS'] = '0'
+    from api import aggregate, config, database, export, metadata, partitions, queries, summaries
+
+    metadata.catalog.load()
+
+    def listed(value) -> list:
+        return [value] if isinstance(value, str) else list(value)
+
+    def scan_aggregates():
+        with database.SessionLocal() as db:
+            for request in AGGREGATES:
+                params = (request['table_name'], listed(request.get('group_by', [])), listed(request.get('where', [])),
+                          listed(request['agg']), 10_000)
+                # past the summaries the refresh below builds
+                aggregate.partitioned(*params) or aggregate.scan(db, *params)
+
+    workloads = {
+        '/data.csv': lambda: sum(map(len, export.encode(queries.PARTIES, export.FORMATS['csv']))),
+        '/traumas.csv': lambda: sum(map(len, export.encode(queries.TRAUMAS, export.FORMATS['csv']))),
+        f'{len(AGGREGATES)} /aggregate': scan_aggregates,
+        'summaries refresh --full': lambda: summaries.refresh(full=True),
+    }
+    print(f'{os.cpu_count()} cpus, {metadata.catalog.tables()["parties"].row_count} parties')
+    timings = {}
+    for processes in [1, *args.processes]:
+        config.SCAN_PROCESSES = processes
+        partitions.shutdown()
+        # the first call pays for starting the pool
+        workloads['/traumas.csv']()
+        timings[processes] = {name: common.measure(fn, args.repeat) for name, fn in workloads.items()}
+    partitions.shutdown()
+    common.report([(name, *(f'{timings[p][name]:.2f} ({timings[1][name] / timings[p][name]:.1f}x)'
+                            for p in timings)) for name in workloads],
+                  ('workload', *(f'{p} process{"es" if p > 1 else ""} s' for p in timings)))
+
+
+if __name__ == '__main__':
+    main()
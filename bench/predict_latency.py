@@ -0,0 +1,50 @@
+import argparse
+import os
+import random
+import time
+
+import joblib
+
+from bench import common
+from api import inference
+from api.models.pyd import PartyData
+
+
+def per_call(fn, records):
+    start = time.perf_counter()
+    for record in records:
+        fn(record)
+    return (time.perf_counter() - start) / len(records)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='per-request /predict latency: sklearn pipeline vs folded lookup')
+    parser.add_argument('--requests', type=int, default=2_000)
+    parser.add_argument('--batch', type=int, default=10_000)
+    args = parser.parse_args()
+
+    model = joblib.load(os.path.join(common.API_DIR, 'model.pkl'))
+    folded = inference.FoldedLogit(model)
+    print(f'exhaustive equivalence check against model.predict: {"ok" if folded.verify() else "MISMATCH"}')
+
+    rnd = random.Random(0)
+    records = [PartyData(age=rnd.uniform(0, 100), sex=rnd.choice(['male', 'female']),
+                         race=rnd.choice(['white', 'black', 'asian', 'hispanic', 'other']))
+               for _ in range(max(args.requests, args.batch))]
+
+    pipeline_one = per_call(lambda r: inference.predict_many(model, [r]), records[:args.requests])
+    folded_one = per_call(folded.predict_one, records[:args.requests])
+    batch = records[:args.batch]
+    pipeline_batch = common.measure(lambda: inference.predict_many(model, batch), 5) / len(batch)
+    folded_batch = common.measure(lambda: folded.predict(batch), 5) / len(batch)
+    assert inference.predict_many(model, batch) == folded.predict(batch)
+
+    common.report([
+        ('single request', f'{pipeline_one * 1e6:.1f}', f'{folded_one * 1e6:.2f}', f'{pipeline_one / folded_one:.0f}x'),
+        (f'batch of {len(batch)}', f'{pipeline_batch * 1e6:.2f}', f'{folded_batch * 1e6:.2f}',
+         f'{pipeline_batch / folded_batch:.1f}x'),
+    ], ('path', 'pipeline us/row', 'folded us/row', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import tempfile
+
+from bench import common
+from bench.load import AGGREGATES
+
+
+def main():
+    parser = common.arg_parser('size of the parties table as pandas frames, exports and the columnar snapshot, and '
+                               '/aggregate latency over the snapshot vs sqlite')
+    args = parser.parse_args()
+    db_path = common.prepare_db(args)
+    # api.config reads these at import time; no summary tables, so /aggregate is a scan either way
+    os.environ['DATABASE_URL'] = db_path
+    os.environ['DATA_FOLDER'] = tempfile.mkdtemp(prefix='switrs-snapshot-')
+    import pandas as pd
+    from api import aggregate, database, export, metadata, queries, snapshot
+
+    snap = snapshot.build()
+    metadata.catalog.load()
+    mib = 1024 ** 2
+    with sqlite3.connect(db_path) as conn:
+        # what the dashboard used to download and hold: object strings, float64 wherever there are nulls
+        frame = pd.read_sql(queries.PARTIES.sql, conn)
+        table = pd.read_sql('SELECT * FROM parties', conn)
+    strings = queries.PARTIES._replace(columns={n: t.replace('dictionary:', '') for n, t in
+                                                queries.PARTIES.columns.items()})
+
+    def size(query, fmt, snap=None) -> str:
+        return f'{sum(len(chunk) for chunk in export.encode(query, export.FORMATS[fmt], snap)) / mib:.1f}'
+
+    def listed(value) -> list:
+        return [value] if isinstance(value, str) else list(value)
+
+    common.report([
+        ('parties table, pandas', f'{table.memory_usage(deep=True).sum() / mib:.1f}'),
+        ('parties table, snapshot', f'{snap.nbytes / mib:.1f}'),
+        ('/data rows, pandas', f'{frame.memory_usage(deep=True).sum() / mib:.1f}'),
+        ('/data csv', size(queries.PARTIES, 'csv')),
+        ('/data arrow, strings', size(strings, 'arrow')),
+        ('/data arrow, dictionaries', size(queries.PARTIES, 'arrow', snap)),
+    ], ('data', 'MiB'))
+
+    rows = []
+    with database.SessionLocal() as db:
+        for request in AGGREGATES:
+            params = (request['table_name'], listed(request.get('group_by', [])), listed(request.get('where', [])),
+                      listed(request['agg']), 10_000)
+            sqlite_time = common.measure(lambda: aggregate.scan(db, *params), args.repeat)
+            snapshot_time = common.measure(lambda: aggregate.precomputed(*params), args.repeat)
+            rows.append((' '.join(f'{k}={",".join(listed(v))}' for k, v in request.items() if k != 'table_name'),
+                         f'{sqlite_time * 1000:.1f}', f'{snapshot_time * 1000:.1f}',
+                         f'{sqlite_time / snapshot_time:.0f}x'))
+    common.report(rows, ('aggregate', 'sqlite ms', 'snapshot ms', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import os
+import random
+import sqlite3
+
+SCHEMA = '''
+CREATE TABLE case_ids (
+    case_id TEXT,
+    db_year INTEGER
+);
+CREATE TABLE collisions (
+    case_id TEXT PRIMARY KEY,
+    jurisdiction INTEGER,
+    county_location TEXT,
+    collision_severity TEXT,
+    killed_victims INTEGER,
+    injured_victims INTEGER,
+    party_count INTEGER
+);
+CREATE TABLE parties (
+    id INTEGER PRIMARY KEY,
+    case_id TEXT,
+    party_number INTEGER,
+    party_type TEXT,
+    at_fault INTEGER,
+    party_sex TEXT,
+    party_age INTEGER,
+    party_sobriety TEXT,
+    party_drug_physical TEXT,
+    direction_of_travel TEXT,
+    cellphone_in_use INTEGER,
+    party_number_killed INTEGER,
+    party_number_injured INTEGER,
+    vehicle_year INTEGER,
+    party_race TEXT
+);
+CREATE TABLE victims (
+    id INTEGER PRIMARY KEY,
+    case_id TEXT,
+    party_number INTEGER,
+    victim_role TEXT,
+    victim_sex TEXT,
+    victim_age INTEGER,
+    victim_degree_of_injury TEXT
+);
+'''
+
+SEXES = ['male', 'female', 'X', None]
+RACES = ['white', 'hispanic', 'black', 'asian', 'other', None]
+PARTY_TYPES = ['driver', 'pedestrian', 'bicyclist', 'parked vehicle', 'other']
+SOBRIETY = ['had not been drinking', 'had been drinking, under influence', 'impairment unknown', None]
+DIRECTIONS = ['north', 'south', 'east', 'west', None]
+COUNTIES = ['los angeles', 'orange', 'san diego', 'alameda', 'sacramento', 'kern']
+SEVERITIES = ['property damage only', 'pain', 'other injury', 'severe injury', 'fatal']
+ROLES = ['driver', 'passenger', 'pedestrian', 'bicyclist']
+INJURIES = ['complaint of pain', 'other visible injury', 'severe injury', 'killed']
+
+
+def _maybe(rnd, value, null_rate=0.05):
+    return None if rnd.random() < null_rate else value
+
+
+def build(path: str, collisions: int = 10_000, seed: int = 0, batch: int = 10_000):
+    if os.path.exists(path):
+        os.remove(path)
+    rnd = random.Random(seed)
+    con = sqlite3.connect(path)
+    con.executescript(SCHEMA)
+
+    case_rows, collision_rows, party_rows, victim_rows = [], [], [], []
+
+    def flush(force=False):
+        for table, rows, width in (('case_ids', case_rows, 2), ('collisions', collision_rows, 7),
+                                   ('parties', party_rows, 15), ('victims', victim_rows, 7)):
+            if rows and (force or len(rows) >= batch):
+                con.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * width)})", rows)
+                rows.clear()
+
+    party_id = victim_id = 0
+    for i in range(collisions):
+        case_id = f'{9000000000 + i}'
+        party_count = rnd.choice((1, 2, 2, 2, 3))
+        killed = injured = 0
+        case_rows.append((case_id, rnd.choice((2018, 2019, 2020, 2021))))
+        for number in range(1, party_count + 1):
+            party_id += 1
+            party_killed = int(rnd.random() < 0.01)
+            party_injured = rnd.choice((0, 0, 0, 1, 2))
+            killed += party_killed
+            injured += party_injured
+            party_rows.append((
+                party_id, case_id, number, rnd.choice(PARTY_TYPES), int(number == 1),
+                rnd.choice(SEXES), _maybe(rnd, rnd.randint(10, 95)), rnd.choice(SOBRIETY), None,
+                rnd.choice(DIRECTIONS), _maybe(rnd, int(rnd.random() < 0.03), 0.2),
+                party_killed, party_injured, _maybe(rnd, rnd.randint(1950, 2022), 0.1), rnd.choice(RACES),
+            ))
+            for _ in range(party_injured):
+                victim_id += 1
+                victim_rows.append((
+                    victim_id, case_id, number, rnd.choice(ROLES), rnd.choice(SEXES[:2]),
+                    _maybe(rnd, rnd.randint(0, 95)), rnd.choice(INJURIES),
+                ))
+        collision_rows.append((case_id, rnd.randint(1000, 9999), rnd.choice(COUNTIES), rnd.choice(SEVERITIES),
+                               killed, injured, party_count))
+        flush()
+    flush(force=True)
+    con.commit()
+    con.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='builds a synthetic switrs.sqlite with the schema of database.TABLES')
+    parser.add_argument('path')
+    parser.add_argument('--collisions', type=int, default=200_000,
+                        help='collisions to generate; parties and victims follow at about 2 and 1.2 per collision')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    build(args.path, collisions=args.collisions, seed=args.seed)
+    print(f'{args.path}: {os.path.getsize(args.path) / 1024 ** 2:.0f} MiB')
+
+
+if __name__ == '__main__':
+    main()
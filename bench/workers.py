@@ -0,0 +1,108 @@
+import os
+import re
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import requests
+
+from bench import common
+
+# logged by api.serving.report_ready once a worker's startup (model, catalog) is done
+READY = re.compile(r'worker (\d+) ready in ([\d.]+)s')
+COMMANDS = {
+    # what `uvicorn --workers` does: every worker is a fresh interpreter that imports the app and loads the model
+    'spawn': lambda port, workers: [sys.executable, '-m', 'uvicorn', 'api.main:app', '--port', str(port),
+                                    '--workers', str(workers)],
+    'fork': lambda port, workers: [sys.executable, '-m', 'api.serving', '--port', str(port),
+                                   '--workers', str(workers)],
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def memory(pid: int) -> Dict[str, int]:
+    fields = {'Rss': 'rss', 'Pss': 'pss', 'Private_Clean': 'private', 'Private_Dirty': 'private'}
+    usage = {'rss': 0, 'pss': 0, 'private': 0}
+    with open(f'/proc/{pid}/smaps_rollup') as file:
+        for line in file:
+            key, _, value = line.partition(':')
+            if key in fields:
+                usage[fields[key]] += int(value.split()[0]) * 1024
+    return usage
+
+
+def start(mode: str, workers: int, db_path: str) -> dict:
+    port = _free_port()
+    env = {**os.environ, 'DATABASE_URL': db_path, 'DATA_FOLDER': tempfile.mkdtemp(prefix='switrs-workers-'),
+           'PYTHONPATH': os.path.dirname(common.API_DIR)}
+    with tempfile.TemporaryFile('w+') as log:
+        began = time.perf_counter()
+        server = subprocess.Popen(COMMANDS[mode](port, workers), env=env, stdout=log, stderr=subprocess.STDOUT,
+                                  start_new_session=True)
+        try:
+            ready: Dict[int, float] = {}
+            while len(ready) < workers:
+                if server.poll() is not None or time.perf_counter() - began > 300:
+                    log.seek(0)
+                    raise RuntimeError(f'{mode} server did not start:\n{log.read()}')
+                time.sleep(0.01)
+                log.seek(0)
+                ready = {int(pid): float(seconds) for pid, seconds in READY.findall(log.read())}
+            # uvicorn binds its port only after the startup of a single worker
+            while True:
+                try:
+                    requests.post(f'http://127.0.0.1:{port}/predict', json={'age': 30, 'sex': 'male', 'race': 'white'},
+                                  timeout=30).raise_for_status()
+                    break
+                except requests.exceptions.ConnectionError:
+                    time.sleep(0.01)
+            all_ready = time.perf_counter() - began
+            # the parent's memory counts too: with fork it holds the pages the workers share
+            usage = {pid: memory(pid) for pid in [server.pid, *ready]}
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)
+            server.wait(30)
+    per_worker = [usage[pid] for pid in ready]
+    return {
+        'ready': all_ready,
+        'worker_startup': statistics.median(ready.values()),
+        'rss': statistics.median(u['rss'] for u in per_worker),
+        'pss': statistics.median(u['pss'] for u in per_worker),
+        'private': statistics.median(u['private'] for u in per_worker),
+        'total_pss': sum(u['pss'] for u in usage.values()),
+    }
+
+
+def main():
+    parser = common.arg_parser('startup time and per-worker memory of `uvicorn --workers` (spawn) vs the pre-fork '
+                               '`python -m api.serving` (fork)', collisions=10_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.set_defaults(repeat=3)
+    args = parser.parse_args()
+    db_path = common.prepare_db(args)
+
+    mib = 1024 ** 2
+    rows = []
+    for workers in args.workers:
+        for mode in COMMANDS:
+            runs: List[dict] = [start(mode, workers, db_path) for _ in range(args.repeat)]
+            result = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+            rows.append((mode, workers, f"{result['ready']:.2f}", f"{result['worker_startup']:.2f}",
+                         f"{result['rss'] / mib:.0f}", f"{result['pss'] / mib:.0f}", f"{result['private'] / mib:.0f}",
+                         f"{result['total_pss'] / mib:.0f}"))
+    common.report(rows, ('mode', 'workers', 'all ready s', 'worker startup s', 'rss MiB/worker', 'pss MiB/worker',
+                         'private MiB/worker', 'total pss MiB'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class ApiClient:
+    # one keep-alive connection pool to the api per process, shared by every session and by the background
+    # fetches, with timeouts on every call and retries for the calls that are safe to repeat
+
+    def __init__(self, base_url: str, pool_size: int = 16, concurrency: int = 8, timeout: Timeout = (3.05, 30),
+                 retries: int = 3, backoff: float = 0.2):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        # connection errors and gateway errors on GETs; POST /predict and 4xx responses are never repeated
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504),
+                      allowed_methods=frozenset({'GET', 'HEAD'}), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='api')
+
+    def get(self, endpoint: str, params=None, timeout: Optional[Timeout] = None, **kwargs) -> requests.Response:
+        response = self.session.get(self.base_url + endpoint, params=params, timeout=timeout or self.timeout,
+                                    **kwargs)
+        response.raise_for_status()
+        return response
+
+    def post(self, endpoint: str, json=None, timeout: Optional[Timeout] = None, **kwargs) -> requests.Response:
+        response = self.session.post(self.base_url + endpoint, json=json, timeout=timeout or self.timeout,
+                                     **kwargs)
+        response.raise_for_status()
+        return response
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        # fn runs on a pool thread: it must not call into streamlit
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def gather(self, *calls: Callable) -> List[Union[object, Exception]]:
+        # runs independent calls at once; like asyncio.gather(return_exceptions=True), a failed call
+        # gives its exception in place of a result so each caller can report its own error
+        futures = [self.submit(call) for call in calls]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
@@ -1,42 +1,80 @@
-import json
 import os
 import streamlit as st
 import requests
 import pandas as pd
 from io import StringIO
-from matplotlib import pyplot as plt
-import seaborn as sns
+
+import client
 
 BASE_URL = os.environ.get("BASE_URL", "http://localhost:8000")
+# how long a chart spec is used before asking the api for it again
+REVALIDATE_SECONDS = float(os.environ.get("REVALIDATE_SECONDS", 30))
+# keep-alive connections to the api per process
+API_POOL_SIZE = int(os.environ.get("API_POOL_SIZE", 16))
+# api calls a page makes at once; 1 runs them one after another
+API_CONCURRENCY = int(os.environ.get("API_CONCURRENCY", 8))
+# seconds to wait for a response, and how often a failed GET is retried
+API_TIMEOUT = float(os.environ.get("API_TIMEOUT", 30))
+API_RETRIES = int(os.environ.get("API_RETRIES", 3))
 
 
-def fetch_info():
-    try:
-        response = requests.get(BASE_URL + '/data_info')
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error fetching data from the API: {e}")
+@st.cache_resource
+def api_client():
+    # one per process, shared by all sessions
+    return client.ApiClient(BASE_URL, pool_size=API_POOL_SIZE, concurrency=API_CONCURRENCY,
+                            timeout=(3.05, API_TIMEOUT), retries=API_RETRIES)
+
+
+def resolve(result):
+    # a gathered result, or None once its error is shown
+    if isinstance(result, requests.exceptions.RequestException):
+        st.error(f"Error fetching data from the API: {result}")
         return None
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def request_info(api: client.ApiClient):
+    return api.get('/data_info').json()
+
+
+def request_head(api: client.ApiClient, table_name: str, page: int, page_size: int, cursor=None):
+    # no streamlit calls in here (api_client() included), prefetches run it off the script thread
+    params = {'table_name': table_name, 'page': page, 'page_size': page_size}
+    if cursor:
+        params['cursor'] = cursor
+    response = api.get('/head', params=params)
+    return response.text, response.headers.get('X-Next-Cursor')
 
 
-def fetch_head(table_name: str, page: int = 0, page_size: int = 10):
+def prefetch_head(table_name: str, page: int, page_size: int, cursor=None):
+    api = api_client()
+    st.session_state.setdefault('prefetched', {})[table_name] = (
+        (page, page_size), api.submit(request_head, api, table_name, page, page_size, cursor))
+
+
+def fetch_head(table_name: str, page: int = 0, page_size: int = 10, prefetch: bool = False):
+    # a prefetched page is only used for the exact page and size it was fetched for
+    prefetched = st.session_state.setdefault('prefetched', {}).pop(table_name, None)
     try:
-        response = requests.get(BASE_URL + '/head',
-                                params={'table_name': table_name, 'page': page, 'page_size': page_size})
-        response.raise_for_status()
-        return response.text
+        if prefetched is not None and prefetched[0] == (page, page_size):
+            text, next_cursor = prefetched[1].result()
+        else:
+            text, next_cursor = request_head(api_client(), table_name, page, page_size)
     except requests.exceptions.RequestException as e:
         st.error(f"Error fetching data from the API: {e}")
         return None
+    if prefetch and next_cursor:
+        # the page after this one, fetched by cursor while this one is being looked at
+        prefetch_head(table_name, page + 1, page_size, next_cursor)
+    return text
 
 
 @st.cache_data
 def fetch_theory():
     try:
-        response = requests.get(BASE_URL + '/theory')
-        response.raise_for_status()
-        return response.text
+        return api_client().get('/theory').text
     except requests.exceptions.RequestException as e:
         st.error(f"Error fetching data from the API: {e}")
         return None
@@ -45,141 +83,132 @@ def fetch_theory():
 @st.cache_data
 def fetch_analysis():
     try:
-        response = requests.get(BASE_URL + '/preview_message')
-        response.raise_for_status()
-        return response.text
+        return api_client().get('/preview_message').text
     except requests.exceptions.RequestException as e:
         st.error(f"Error fetching data from the API: {e}")
         return None
 
 
+AT_FAULT = 'at_fault:eq:1'
+
+
 @st.cache_data
-def download_parties_data():
-    st.text('downloading...')
-    data_folder = "./data"
-    os.makedirs(data_folder, exist_ok=True)
+def fetch_aggregate(table_name: str, group_by=(), where=(), agg=('count',)):
+    try:
+        response = api_client().get('/aggregate',
+                                    params={'table_name': table_name, 'group_by': list(group_by),
+                                            'where': list(where), 'agg': list(agg)})
+        return pd.DataFrame(response.json())
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error fetching data from the API: {e}")
+        return None
+
 
-    file_url = BASE_URL + '/data.csv'
+@st.cache_data(ttl=REVALIDATE_SECONDS, show_spinner=False)
+def fetch_chart(name: str):
+    # a Vega-Lite spec the api builds once per data version; the browser draws it
     try:
-        response = requests.get(file_url, stream=True)
-        response.raise_for_status()
+        return api_client().get(f'/charts/{name}').json()
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error fetching data from the API: {e}")
+        return None
 
-        total_size = int(response.headers.get('content-length', 0))
-        chunk_size = 8192
 
-        progress_bar = st.progress(0)
-        status_text = st.empty()
+def show_stats(column: str, where):
+    stats = fetch_aggregate('parties', where=where, agg=(f'median:{column}', f'mean:{column}', f'std:{column}'))
+    if stats is None:
+        # fetch_aggregate showed the error, the rest of the page still renders
+        return
+    stats = stats.iloc[0]
+    st.text(f"Median Year: {stats[f'q0.5_{column}']}")
+    st.text(f"Mean Year: {int(stats[f'mean_{column}'])}")
+    st.text(f"Standard Deviation: {stats[f'std_{column}']:.2f}")
 
-        with open(data_folder + "/data.csv", "wb") as file:
-            bytes_downloaded = 0
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    file.write(chunk)
-                    bytes_downloaded += len(chunk)
 
-                    progress = bytes_downloaded / total_size
-                    progress_bar.progress(min(progress, 1.0))
+def show_chart(name: str):
+    spec = fetch_chart(name)
+    if spec:
+        st.vega_lite_chart(spec, use_container_width=name not in ('vehicle_year_box', 'people_age_box'))
 
-                    status_text.text(f"progress: {bytes_downloaded / (1024 * 1024):.2f} MB of "
-                                     f"{total_size / (1024 * 1024):.2f} MB")
 
-        progress_bar.empty()
-        df = pd.read_csv(data_folder + "/data.csv")
-        return df
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error downloading the file: {e}")
+if 'pagination' not in st.session_state:
+    st.session_state.pagination = {}
 
 
-@st.cache_data
-def download_traumas_data():
-    st.text('downloading...')
-    data_folder = "./data"
-    os.makedirs(data_folder, exist_ok=True)
+def previous_page(table_name):
+    pagination = st.session_state.pagination[table_name]
+    pagination['page'] = max(pagination['page'] - 1, 0)
 
-    file_url = BASE_URL + '/traumas.csv'
-    try:
-        response = requests.get(file_url, stream=True)
-        response.raise_for_status()
 
-        total_size = int(response.headers.get('content-length', 0))
-        chunk_size = 8192
+def next_page(table_name):
+    st.session_state.pagination[table_name]['page'] += 1
 
-        progress_bar = st.progress(0)
-        status_text = st.empty()
 
-        with open(data_folder + "/traumas.csv", "wb") as file:
-            bytes_downloaded = 0
-            for chunk in response.iter_content(chunk_size=chunk_size):
-                if chunk:
-                    file.write(chunk)
-                    bytes_downloaded += len(chunk)
+def set_page_size(table_name):
+    st.session_state.pagination[table_name] = {'page': 0, 'page_size': st.session_state[f"page_size_{table_name}"]}
 
-                    progress = bytes_downloaded / total_size
-                    progress_bar.progress(min(progress, 1.0))
 
-                    status_text.text(f"progress: {bytes_downloaded / (1024 * 1024):.2f} MB of "
-                                     f"{total_size / (1024 * 1024):.2f} MB")
+@st.fragment
+def table_pager(table):
+    # reruns on its own: paging one table costs a single /head call, usually already prefetched
+    table_name = table['table_name']
+    st.write(table['description'])
 
-        progress_bar.empty()
-        df = pd.read_csv(data_folder + "/traumas.csv")
-        return df
-    except requests.exceptions.RequestException as e:
-        st.error(f"Error downloading the file: {e}")
+    if table_name not in st.session_state.pagination:
+        st.session_state.pagination[table_name] = {'page': 0, 'page_size': 10}
 
+    page = st.session_state.pagination[table_name]['page']
+    page_size = st.session_state.pagination[table_name]['page_size']
+    total_pages = max(-(-table['row_count'] // page_size), 1) if table.get('row_count') is not None else None
 
-if 'pagination' not in st.session_state:
-    st.session_state.pagination = {}
+    head = fetch_head(table_name, page, page_size, prefetch=True)
+    if head:
+        df = pd.read_csv(StringIO(head))
+        st.dataframe(df)
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.button(f"Previous ({table_name})", key=f"prev_{table_name}", disabled=page == 0,
+                      on_click=previous_page, args=(table_name,))
+
+        with col2:
+            st.text(f"Page: {page + 1} of {total_pages}" if total_pages else f"Page: {page + 1}")
+
+        with col3:
+            st.button(f"Next ({table_name})", key=f"next_{table_name}",
+                      disabled=total_pages is not None and page + 1 >= total_pages,
+                      on_click=next_page, args=(table_name,))
+
+        st.number_input(
+            f"Rows per page ({table_name})",
+            min_value=1,
+            max_value=100,
+            value=page_size,
+            key=f"page_size_{table_name}",
+            on_change=set_page_size,
+            args=(table_name,),
+        )
 
 
 def display_table_info(data):
     if data:
+        # the pagers render one after another, their pages are requested at once up front
         for table in data:
-            table_name = table['table_name']
-            st.subheader(table_name)
-            st.write(table['description'])
-
-            if table_name not in st.session_state.pagination:
-                st.session_state.pagination[table_name] = {'page': 0, 'page_size': 10}
-
-            page = st.session_state.pagination[table_name]['page']
-            page_size = st.session_state.pagination[table_name]['page_size']
-
-            head = fetch_head(table_name, page, page_size)
-            if head:
-                df = pd.read_csv(StringIO(head))
-                st.dataframe(df)
-
-                col1, col2, col3 = st.columns(3)
-                with col1:
-                    if st.button(f"Previous ({table_name})", key=f"prev_{table_name}"):
-                        if page > 0:
-                            st.session_state.pagination[table_name]['page'] -= 1
-
-                with col2:
-                    st.text(f"Page: {page + 1}")
-
-                with col3:
-                    if st.button(f"Next ({table_name})", key=f"next_{table_name}"):
-                        st.session_state.pagination[table_name]['page'] += 1
-
-                new_page_size = st.number_input(
-                    f"Rows per page ({table_name})",
-                    min_value=1,
-                    max_value=100,
-                    value=page_size,
-                    key=f"page_size_{table_name}"
-                )
-                if new_page_size != page_size:
-                    st.session_state.pagination[table_name]['page_size'] = new_page_size
-                    st.session_state.pagination[table_name]['page'] = 0
-            st.write("---")
+            pagination = st.session_state.pagination.get(table['table_name'], {'page': 0, 'page_size': 10})
+            if table['table_name'] not in st.session_state.get('prefetched', {}):
+                prefetch_head(table['table_name'], pagination['page'], pagination['page_size'])
+        for tab, table in zip(st.tabs([table['table_name'] for table in data]), data):
+            with tab:
+                table_pager(table)
     else:
         st.write("No data available.")
 
 
 st.title("Table Information")
 
-table_info = fetch_info()
+# the first render needs these and they don't depend on each other
+api = api_client()
+table_info, preview = map(resolve, api.gather(lambda: request_info(api), lambda: request_head(api, 'parties', 0, 5)[0]))
 display_table_info(table_info)
 
 st.title('My Theory')
@@ -195,159 +224,35 @@ This table has a lot of numeric fields. The most essential fields are `vehicle_y
 )
 
 st.title('Download Vehicle Data')
-data = download_parties_data()
-
-cars_df = data
-
-st.dataframe(cars_df[['case_id', 'vehicle_year']].head())
-
-
-@st.cache_resource
-def create_box_plot_year():
-    fig, ax = plt.subplots(figsize=(10, 6))
-    sns.boxplot(data=cars_df['vehicle_year'])
-    ax.set_title("Vehicle Year Distribution")
-    ax.set_ylim(1900, 2025)
-    ax.set_xlabel("Vehicle Year")
-    ax.set_ylabel("Frequency")
-
-    st.pyplot(fig)
+if preview:
+    st.dataframe(pd.read_csv(StringIO(preview))[['case_id', 'vehicle_year']])
 
-
-create_box_plot_year()
+show_chart('vehicle_year_box')
 
 st.text(
     "as we can see, there are a lot of outliers and most of them are below 1980 year. => we can take all vehicles from 1980 to 2022 (since database is from 2022)")
 
-cars_df = cars_df[
-    (cars_df['vehicle_year'].notna()) &
-    (cars_df['vehicle_year'] >= 1980) &
-    (cars_df['vehicle_year'] <= 2022)
-    ]
-
-car_counts = cars_df['vehicle_year'].value_counts().sort_index()
-
-
-@st.cache_resource
-def create_bar_plot_cars():
-    fig, ax = plt.subplots(figsize=(14, 6))
-    sns.barplot(x=car_counts.index, y=car_counts.values, color='skyblue', ax=ax)
-    ax.set_title('Number of Cars by Manufacture Year Involved in Accidents')
-    ax.set_xlabel('Car Manufacture Year')
-    ax.set_ylabel('Number of Incidents')
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45)  # Rotate x-axis labels
-    st.pyplot(fig)
-
+show_chart('cars_by_year')
 
-create_bar_plot_cars()
-
-st.text(f"Median Year: {cars_df['vehicle_year'].median()}")
-st.text(f"Mean Year: {int(cars_df['vehicle_year'].mean())}")
-st.text(f"Standard Deviation: {cars_df['vehicle_year'].std():.2f}")
+show_stats('vehicle_year', (AT_FAULT, 'vehicle_year:ge:1980', 'vehicle_year:le:2022'))
 
 st.markdown("#### as we can see, vehicles made in 2000 collide the most")
 st.markdown("#### that's probably because there are more cars of that year, then any other")
 
-peoples_age_df = data
-
-
-@st.cache_resource
-def create_people_age_distribution():
-    fig, ax = plt.subplots(figsize=(10, 6))
-    sns.boxplot(data=peoples_age_df['party_age'])
-    ax.set_title("People Age Distribution")
-    ax.set_ylabel("Age")
-    st.pyplot(fig)
-
-
-create_people_age_distribution()
+show_chart('people_age_box')
 
 st.text(
     "obviously, we should not take into account people younger than 12 and older than 90, since they do not really drive.")
 st.text("we can also see that in data there are a lot of outliers that we need to get rid of. ")
 
-
-def clean_peoples_age():
-    global peoples_age_df
-    peoples_age_df = peoples_age_df[
-        (peoples_age_df['party_age'].notna()) &
-        (peoples_age_df['party_age'] >= 12) &
-        (peoples_age_df['party_age'] <= 90)
-        ]
-
-
-peoples_age_counts = peoples_age_df['party_age'].value_counts().sort_index()
-
-
-@st.cache_resource
-def create_bar_plot_people():
-    fig, ax = plt.subplots(figsize=(24, 6))
-    sns.barplot(x=peoples_age_counts.index, y=peoples_age_counts.values, color='skyblue')
-    ax.set_title('Peoples Age Distribution')
-    ax.set_xlabel('Age')
-    ax.set_ylabel('Number of Incidents')
-    ax.set_xticklabels(ax.get_xticklabels(), rotation=45)
-    st.pyplot(fig)
-
-
-st.text(f"Median Year: {peoples_age_df['party_age'].median()}")
-st.text(f"Mean Year: {int(peoples_age_df['party_age'].mean())}")
-st.text(f"Standard Deviation: {peoples_age_df['party_age'].std():.2f}")
+show_stats('party_age', (AT_FAULT,))
 
 st.text("as we can see, the most dangerous drivers are young: 18 to 30 yo.")
 st.text("as the person gets older, the less likely they are to get into accident.")
 
 st.title("People's description")
 
-people_info_df = data[
-    ((data['party_sex'] == 'female') | (data['party_sex'] == 'male')) &
-    (data['party_age'].notna()) &
-    (data['cellphone_in_use'].notna()) &
-    (data['party_race'].notna())
-    ]
-
-people_info_df.head()
-
-male_count = people_info_df[people_info_df['party_sex'] == 'male'].shape[0]
-female_count = people_info_df[people_info_df['party_sex'] == 'female'].shape[0]
-
-race_counts = people_info_df['party_race'].value_counts()
-phone_usage = people_info_df['cellphone_in_use'].value_counts()
-
-
-@st.cache_resource
-def create_pie_charts():
-    fig, axes = plt.subplots(1, 3, figsize=(12, 6))
-
-    axes[0].pie(
-        [male_count, female_count],
-        labels=['Male', 'Female'],
-        autopct='%1.1f%%',
-        colors=['blue', 'pink']
-    )
-    axes[0].set_title('Gender Distribution')
-
-    axes[1].pie(
-        race_counts,
-        labels=race_counts.index,
-        autopct='%1.1f%%',
-        startangle=140
-    )
-    axes[1].set_title('Race Distribution')
-
-    axes[2].pie(
-        phone_usage,
-        labels=['Not Used', 'Used'],
-        autopct='%1.1f%%',
-        startangle=140
-    )
-    axes[2].set_title('Phone Usage Distribution')
-
-    plt.tight_layout()
-    st.pyplot(fig)
-
-
-create_pie_charts()
+show_chart('people_pies')
 
 st.markdown("""1. men get into accidents twice as much are women.  
 2. white and hispanic races are much more likely to get into accidents then asian and black.
@@ -355,40 +260,7 @@ st.markdown("""1. men get into accidents twice as much are women.
 
 st.title("Now lets see whether young (18-30) people kill people more often then old (30+)")
 
-traumas_df = download_traumas_data()
-traumas_df.head()
-traumas_df['fatality_prob'] = traumas_df['total_killed'] / traumas_df['total_people']
-traumas_df['trauma_prob'] = traumas_df['total_injured'] / traumas_df['total_people']
-traumas_df['fatality_prob'] = traumas_df['fatality_prob'].round(5)
-traumas_df['trauma_prob'] = traumas_df['trauma_prob'].round(5)
-traumas_df.head()
-
-
-@st.cache_resource
-def create_data_comparison():
-    fig, axes = plt.subplots(1, 3, figsize=(15, 6))
-
-    sns.barplot(x='age_group', y='total_killed', data=traumas_df, ax=axes[0], palette=['#66C2A5', '#FC8D62', '#8DA0CB'],
-                hue='total_killed')
-    axes[0].set_xlabel('Age Group')
-    axes[0].set_ylabel('Total Killed')
-    axes[0].set_title('Total People Killed by Age Group')
-
-    sns.barplot(x='age_group', y='fatality_prob', data=traumas_df, ax=axes[1], palette='coolwarm', hue='fatality_prob')
-    axes[1].set_xlabel('Age Group')
-    axes[1].set_ylabel('Fatality Probability')
-    axes[1].set_title('Fatality Probability')
-
-    sns.barplot(x='age_group', y='trauma_prob', data=traumas_df, ax=axes[2], palette='viridis', hue='trauma_prob')
-    axes[2].set_xlabel('Age Group')
-    axes[2].set_ylabel('Trauma Probability')
-    axes[2].set_title('Trauma Probability by Age Group')
-
-    plt.tight_layout()
-    st.pyplot(fig)
-
-
-create_data_comparison()
+show_chart('traumas_comparison')
 
 st.markdown('''as we can see, adults kill more people in general. that's simply because this group is the largest.  
 however, adults are much more likely to unalive people.  
@@ -403,39 +275,40 @@ st.markdown('''## Theory Conclusion
 
 Therefore, the theory is only proven true partially.''')
 
-with st.form("predict_form"):
-    st.title("Will the person get into accident? Hm...")
-
-    party_age = st.number_input("Enter Age", min_value=0.0, max_value=100.0, value=25.0)
-    party_sex = st.selectbox("Select Gender", ["male", "female"])
-    party_race = st.selectbox("Enter Race", ["white", "black", "asian", "hispanic", "other"])
-
-    submit_button = st.form_submit_button()
-
-
-    def send_request(age, sex, race):
-        url = f"{BASE_URL}/predict"
-        payload = {
-            "age": age,
-            "sex": sex,
-            "race": race
-        }
-        try:
-            response = requests.post(url, json=payload)
-            if response.status_code == 200:
-                return response.json()
+@st.fragment
+def predict_form():
+    # submitting only reruns the form, not the analysis above it
+    with st.form("predict_form"):
+        st.title("Will the person get into accident? Hm...")
+
+        party_age = st.number_input("Enter Age", min_value=0.0, max_value=100.0, value=25.0)
+        party_sex = st.selectbox("Select Gender", ["male", "female"])
+        party_race = st.selectbox("Enter Race", ["white", "black", "asian", "hispanic", "other"])
+
+        submit_button = st.form_submit_button()
+
+        def send_request(age, sex, race):
+            payload = {
+                "age": age,
+                "sex": sex,
+                "race": race
+            }
+            try:
+                return api_client().post('/predict', json=payload).json()
+            except requests.exceptions.HTTPError as e:
+                return {"error": f"Server responded with status code {e.response.status_code}"}
+            except Exception as e:
+                return {"error": str(e)}
+
+        if submit_button:
+            result = send_request(party_age, party_sex, party_race)
+            if "error" in result:
+                st.error(result["error"])
             else:
-                return {"error": f"Server responded with status code {response.status_code}"}
-        except Exception as e:
-            return {"error": str(e)}
+                if result["at_fault"]:
+                    st.write("Yeah, this person is very likely to get into accident")
+                else:
+                    st.write("No, this person is not likely to get into accident")
 
 
-    if submit_button:
-        result = send_request(party_age, party_sex, party_race)
-        if "error" in result:
-            st.error(result["error"])
-        else:
-            if result["at_fault"]:
-                st.write("Yeah, this person is very likely to get into accident")
-            else:
-                st.write("No, this person is not likely to get into accident")
+predict_form()
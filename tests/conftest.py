@@ -0,0 +1,20 @@
+import os
+import tempfile
+
+import pytest
+
+from bench import synthetic
+
+# api.config reads these at import time, so they are set before any test imports the api
+_folder = tempfile.mkdtemp(prefix='switrs-tests-')
+os.environ['DATABASE_URL'] = synthetic.build(os.path.join(_folder, 'switrs.sqlite'), collisions=2_000)
+os.environ['DATA_FOLDER'] = os.path.join(_folder, 'data')
+os.environ['HTTP_CACHE_MAX_BYTES'] = '0'
+
+
+@pytest.fixture(scope='session')
+def client():
+    from fastapi.testclient import TestClient
+    from api.main import app
+    with TestClient(app) as client:
+        yield client
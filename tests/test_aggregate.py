@@ -0,0 +1,93 @@
+import pytest
+
+
+@pytest.mark.parametrize('agg', ['median:party_sex', 'q0.9:party_race', 'mean:party_sex', 'sum:party_race',
+                                 'std:party_sex', 'var:party_sex'])
+def test_numeric_aggregate_of_text(client, agg):
+    response = client.get('/aggregate', params={'table_name': 'parties', 'agg': agg})
+    assert response.status_code == 400
+    assert 'not a numeric column' in response.json()['detail']
+
+
+@pytest.mark.parametrize('agg', ['count:party_sex', 'min:party_sex', 'max:party_race'])
+def test_other_aggregates_of_text(client, agg):
+    response = client.get('/aggregate', params={'table_name': 'parties', 'group_by': 'at_fault', 'agg': agg})
+    assert response.status_code == 200
+
+
+# requests the summary tables, the snapshot, the partitioned scan and a plain scan of switrs.sqlite can all answer
+QUERIES = [
+    (['party_sex'], ['at_fault:eq:1'], ['count', 'mean:party_age', 'median:party_age', 'std:party_age']),
+    (['party_race', 'party_sex'], ['at_fault:eq:1', 'party_age:ge:30'], ['count', 'min:party_age', 'q0.9:party_age']),
+    ([], ['at_fault:eq:1', 'party_sex:in:male|female'], ['count:party_age', 'sum:party_age', 'var:party_age']),
+    (['cellphone_in_use'], ['at_fault:eq:1', 'party_race:null'], ['count', 'max:party_age', 'q0:party_age']),
+]
+# and ones every backend rejects the same way
+BAD_QUERIES = [
+    (['party_sex'], ['at_fault:eq:1'], ['mean:party_sex']),
+    ([], ['at_fault:eq:1'], ['median:party_race']),
+    ([], ['at_fault:eq:1'], ['count:nope']),
+    ([], ['at_fault:like:1'], ['count']),
+]
+# backend and the X-Aggregate-Source it reports
+BACKENDS = {'scan': 'table:', 'partitioned': 'partitions:', 'summary': 'summary:', 'snapshot': 'snapshot:'}
+
+
+@pytest.fixture(scope='module')
+def backends(client):
+    from api import config, snapshot, summaries
+    summaries.refresh(full=True)
+    snapshot.build()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr(config, 'SCAN_PROCESSES', 2)
+        patch.setattr(config, 'SCAN_MIN_ROWS', 0)
+        yield
+    from api import partitions
+    partitions.shutdown()
+
+
+def run(backend: str, group_by, where, agg):
+    from api import aggregate, database, summaries
+    args = ('parties', group_by, where, agg, 10_000)
+    if backend == 'scan':
+        with database.SessionLocal() as db:
+            return aggregate.scan(db, *args)
+    if backend == 'partitioned':
+        return aggregate.partitioned(*args)
+    if backend == 'summary':
+        return aggregate.precomputed(*args)
+    with pytest.MonkeyPatch.context() as patch:
+        # past the summary tables
+        patch.setattr(summaries, 'current', lambda name: False)
+        return aggregate.precomputed(*args)
+
+
+@pytest.mark.parametrize('group_by, where, agg', QUERIES)
+def test_backends_agree(backends, group_by, where, agg):
+    expected, _ = run('scan', group_by, where, agg)
+    assert expected
+    for backend, prefix in BACKENDS.items():
+        rows, source = run(backend, group_by, where, agg)
+        assert source.startswith(prefix)
+        assert rows == [pytest.approx(row) for row in expected], backend
+
+
+@pytest.mark.parametrize('group_by, where, agg', BAD_QUERIES)
+def test_backends_reject(backends, group_by, where, agg):
+    from fastapi import HTTPException
+    for backend in BACKENDS:
+        with pytest.raises(HTTPException) as raised:
+            run(backend, group_by, where, agg)
+        assert raised.value.status_code == 400, backend
+
+
+@pytest.mark.parametrize('limit', [0, -1])
+def test_bad_limit(client, limit):
+    response = client.get('/aggregate', params={'table_name': 'parties', 'group_by': 'party_sex', 'limit': limit})
+    assert response.status_code == 422
+
+
+def test_limit(client):
+    response = client.get('/aggregate', params={'table_name': 'parties', 'group_by': 'party_sex', 'limit': 2})
+    assert response.status_code == 200
+    assert len(response.json()) == 2
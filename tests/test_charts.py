@@ -0,0 +1,15 @@
+import json
+
+
+def test_charts(client):
+    for name in client.get('/charts').json():
+        response = client.get(f'/charts/{name}')
+        assert response.status_code == 200, name
+        assert json.loads(response.content)['$schema'].startswith('https://vega.github.io/schema/vega-lite/')
+
+
+def test_gender_colors(client):
+    gender = json.loads(client.get('/charts/people_pies').content)['hconcat'][0]
+    # male blue and female pink whatever order vega-lite puts the labels in
+    scale = gender['encoding']['color']['scale']
+    assert dict(zip(scale['domain'], scale['range'])) == {'Male': 'blue', 'Female': 'pink'}
@@ -0,0 +1,42 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import anyio
+
+from api import export
+from api.cache import artifacts
+
+PLAIN = {'accept-encoding': 'identity'}
+
+
+def test_csv(client):
+    first = client.get('/data.csv', headers=PLAIN)
+    assert first.status_code == 200
+    assert first.text.startswith('case_id,')
+    # from the artifact cache now, with the same validators
+    second = client.get('/data.csv', headers=PLAIN)
+    assert second.content == first.content
+    assert second.headers['etag'] == first.headers['etag']
+    assert client.get('/data.csv', headers={**PLAIN, 'if-none-match': first.headers['etag']}).status_code == 304
+
+
+def test_waiting_holds_no_thread(client):
+    # requests waiting for another producer of the same export wait on the event loop, not on a thread
+    from api.main import traumas_query
+    path = export.plan(traumas_query(), export.FORMATS['csv'], None).cache_path
+    assert artifacts.acquire(path, 0)
+    with ThreadPoolExecutor(20) as pool:
+        try:
+            responses = [pool.submit(client.get, '/traumas.csv', headers=PLAIN) for _ in range(20)]
+            deadline = time.monotonic() + 10
+            while len(artifacts._waiters.get(path, ())) < 20:
+                assert time.monotonic() < deadline
+                time.sleep(0.01)
+            threads = client.portal.call(lambda: anyio.to_thread.current_default_thread_limiter().borrowed_tokens)
+            assert threads == 0
+            assert export.limiter().borrowed_tokens == 0
+        finally:
+            artifacts.release(path)
+        bodies = {response.result().content for response in responses}
+    assert len(bodies) == 1
+    assert bodies.pop().startswith(b'age_group,')
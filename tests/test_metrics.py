@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+
+from api import metrics
+
+
+def test_client_metrics(client):
+    client.get('/theory')
+    text = client.get('/metrics').text
+    assert 'http_request_duration_seconds_count{method="GET",route="/theory",status="200"}' in text
+    assert 'process_resident_memory_bytes ' in text
+
+
+def test_shared(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, 'REGISTRY', [])
+    counter = metrics.Counter('test_total', 'Test counter', ('kind',))
+    histogram = metrics.Histogram('test_seconds', 'Test histogram', buckets=(1, 10))
+    metrics.Gauge('test_bytes', 'Test gauge', lambda: 5)
+    counter.inc(2, kind='a')
+    histogram.observe(0.5)
+
+    exited = subprocess.Popen(['true'])
+    exited.wait()
+    # another worker as of its last flush, one that has exited since, and the parent, which has no gauges
+    others = {
+        'live': {'pid': os.getppid(), 'values': {'test_total': [[['a'], 3], [['b'], 1]],
+                                                 'test_seconds': [[[], [0, 1, 0, 5.0]]]}, 'gauges': {'test_bytes': 7}},
+        'exited': {'pid': exited.pid, 'values': {'test_total': [[['a'], 4]]}, 'gauges': {'test_bytes': 9}},
+        'parent': {'pid': os.getppid(), 'values': {'test_total': [[['a'], 1]]}, 'gauges': {}},
+    }
+    for name, state in others.items():
+        (tmp_path / f'{name}.json').write_text(json.dumps(state))
+    monkeypatch.setattr(metrics, '_directory', str(tmp_path))
+    monkeypatch.setattr(metrics, '_file', str(tmp_path / 'self.json'))
+    metrics.flush()
+
+    lines = metrics.render().splitlines()
+    assert 'test_total{kind="a"} 10' in lines
+    assert 'test_total{kind="b"} 1' in lines
+    assert 'test_seconds_bucket{le="1.0"} 1' in lines
+    assert 'test_seconds_bucket{le="10.0"} 2' in lines
+    assert 'test_seconds_count 2' in lines
+    assert 'test_seconds_sum 5.5' in lines
+    assert sorted(line for line in lines if line.startswith('test_bytes')) == [
+        f'test_bytes{{worker="{os.getppid()}"}} 7', f'test_bytes{{worker="{os.getpid()}"}} 5']
@@ -0,0 +1,18 @@
+PARTY = {'age': 30, 'sex': 'male', 'race': 'white'}
+
+
+def test_batch(client):
+    response = client.post('/predict/batch', json=[PARTY, {**PARTY, 'age': 17}])
+    assert response.status_code == 200
+    assert len(response.json()['at_fault']) == 2
+
+
+def test_batch_invalid_json(client):
+    response = client.post('/predict/batch', content=b'[{"age": 30,', headers={'content-type': 'application/json'})
+    assert response.status_code == 422
+
+
+def test_batch_invalid_ndjson(client):
+    response = client.post('/predict/batch', content=b'{"age": 30}\nnot json\n',
+                           headers={'content-type': 'application/x-ndjson'})
+    assert response.status_code == 422